@@ -0,0 +1,156 @@
+"""Measure height noise and loop frequency of a connected fluxpad at different ADC sample counts.
+
+Every reading averages a number of ADC samples per key. More samples mean less noise, but they
+take longer to read and slow the main loop down once reading all keys takes longer than a loop
+period. This sets the sample count to each value in turn, streams raw readings with the keys at
+rest and reports the noise against the loop period, so the count can be picked from data.
+
+Needs firmware that supports the adc_n override. Keep the keys released while it runs.
+
+usage: python adc_benchmark.py [--samples 8 16 32 ...] [--seconds S] [--max-noise MM] [--output results.csv]
+"""
+import argparse
+import csv
+import pathlib
+import sys
+import time
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+import telemetry
+from fluxpad_interface import Fluxpad, find_fluxpad_ports
+
+DEFAULT_SAMPLE_COUNTS = (1, 2, 4, 8, 16, 22, 32, 48, 64, 110, 160, 256)
+DEFAULT_SECONDS = 2.0
+SETTLE_S = 0.2  # Skipped after changing the sample count
+# Faster than the main loop, so every loop sends a message and their spacing is the loop period
+STREAM_RATE_HZ = 4000
+ADC_SAMPLE_TIME_US = 2.0  # RP2040 ADC at 500 ksps
+DEFAULT_MAX_NOISE_MM = 0.01
+
+
+class BenchmarkResult(NamedTuple):
+    adc_samples: int
+    loop_hz: float  # Median over the run
+    noise_mm: np.ndarray  # Height standard deviation of every key
+    noise_adc: np.ndarray  # Reading standard deviation of every key
+    message_count: int
+
+    @property
+    def loop_period_ms(self) -> float:
+        return 1000 / self.loop_hz
+
+    @property
+    def acquisition_us(self) -> float:
+        """Time spent reading the ADC for all keys every loop"""
+        return self.adc_samples * len(self.noise_mm) * ADC_SAMPLE_TIME_US
+
+
+def measure(fluxpad: Fluxpad, adc_samples: int, duration_s: float = DEFAULT_SECONDS) -> BenchmarkResult:
+    """Noise and loop frequency with the fluxpad averaging adc_samples samples per reading"""
+    fluxpad.set_adc_samples(adc_samples)
+    calibrations = telemetry.read_calibrations(fluxpad)
+    batches: List[telemetry.RawDatastreamBatch] = []
+    start_s = time.monotonic()
+    stream = telemetry.stream_raw(fluxpad, calibrations, rate_hz=STREAM_RATE_HZ)
+    try:
+        for batch in stream:
+            elapsed_s = time.monotonic() - start_s
+            if elapsed_s >= SETTLE_S:
+                batches.append(batch)
+            if elapsed_s >= SETTLE_S + duration_s:
+                break
+    finally:
+        stream.close()
+    assert batches, "No datastream messages received"
+
+    device_time_us = np.concatenate([batch.device_time_us for batch in batches])
+    raw_adc = np.concatenate([batch.raw_adc for batch in batches])
+    height_mm = np.concatenate([batch.height_mm for batch in batches])
+    # Messages dropped on the way show up as long gaps, the median ignores them
+    loop_hz = 1e6 / float(np.median(np.diff(device_time_us)))
+    return BenchmarkResult(adc_samples, loop_hz, height_mm.std(axis=0), raw_adc.std(axis=0), len(device_time_us))
+
+
+def run_benchmark(fluxpad: Fluxpad, sample_counts: Sequence[int] = DEFAULT_SAMPLE_COUNTS, duration_s: float = DEFAULT_SECONDS) -> List[BenchmarkResult]:
+    """Measure every sample count, the fluxpad is put back to its default afterwards"""
+    results = []
+    try:
+        for adc_samples in sample_counts:
+            results.append(measure(fluxpad, adc_samples, duration_s))
+    finally:
+        fluxpad.set_adc_samples(0)
+    return results
+
+
+def recommend(results: Sequence[BenchmarkResult], max_noise_mm: float = DEFAULT_MAX_NOISE_MM) -> Optional[BenchmarkResult]:
+    """Fastest setting whose noisiest key stays within max_noise_mm, fewest samples if loop rates tie"""
+    quiet = [result for result in results if result.noise_mm.max() <= max_noise_mm]
+    if not quiet:
+        return None
+    return min(quiet, key=lambda result: (round(result.loop_period_ms, 2), result.adc_samples))
+
+
+def format_report(results: Sequence[BenchmarkResult], recommended: Optional[BenchmarkResult] = None) -> str:
+    keys = len(results[0].noise_mm) if results else 0
+    lines = [f"{'samples':>8} {'loop Hz':>9} {'period ms':>10} {'adc us':>8} " + " ".join(f"{f'key {i + 1} mm':>10}" for i in range(keys))
+             + " " + " ".join(f"{f'key {i + 1} adc':>10}" for i in range(keys))]
+    for result in results:
+        marker = "  <-" if result is recommended else ""
+        lines.append(f"{result.adc_samples:>8} {result.loop_hz:>9.0f} {result.loop_period_ms:>10.3f} {result.acquisition_us:>8.0f} "
+                     + " ".join(f"{noise:>10.4f}" for noise in result.noise_mm) + " "
+                     + " ".join(f"{noise:>10.2f}" for noise in result.noise_adc) + marker)
+    return "\n".join(lines)
+
+
+def save_results(results: Sequence[BenchmarkResult], path: pathlib.Path):
+    keys = len(results[0].noise_mm) if results else 0
+    with open(path, "w", newline="") as file:
+        writer = csv.writer(file)
+        writer.writerow(["adc_samples", "loop_hz", "acquisition_us", "messages"]
+                        + [f"noise_mm_{i + 1}" for i in range(keys)] + [f"noise_adc_{i + 1}" for i in range(keys)])
+        for result in results:
+            writer.writerow([result.adc_samples, result.loop_hz, result.acquisition_us, result.message_count]
+                            + result.noise_mm.tolist() + result.noise_adc.tolist())
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark height noise against loop frequency for ADC sample counts")
+    parser.add_argument("--samples", type=int, nargs="+", default=list(DEFAULT_SAMPLE_COUNTS), help="Sample counts to measure")
+    parser.add_argument("--seconds", type=float, default=DEFAULT_SECONDS, help=f"Measuring time per sample count (default {DEFAULT_SECONDS})")
+    parser.add_argument("--max-noise", type=float, default=DEFAULT_MAX_NOISE_MM, help=f"Height noise in mm to recommend a sample count for (default {DEFAULT_MAX_NOISE_MM})")
+    parser.add_argument("--output", type=pathlib.Path, help="Also save the results as CSV")
+    args = parser.parse_args(argv)
+
+    for adc_samples in args.samples:
+        if not 1 <= adc_samples <= Fluxpad.ADC_SAMPLES_MAX:
+            parser.error(f"Sample counts must be between 1 and {Fluxpad.ADC_SAMPLES_MAX}")
+
+    ports = find_fluxpad_ports()
+    if not ports:
+        print("No fluxpads found", file=sys.stderr)
+        return 1
+    serial_number, port = next(iter(ports.items()))
+    fluxpad = Fluxpad(port, serial_number)
+    fluxpad.open()
+    try:
+        print(f"Benchmarking {serial_number}, keep the keys released")
+        results = run_benchmark(fluxpad, args.samples, args.seconds)
+    finally:
+        fluxpad.close()
+
+    recommended = recommend(results, args.max_noise)
+    print(format_report(results, recommended))
+    if recommended is None:
+        print(f"No sample count keeps the noise under {args.max_noise} mm")
+    else:
+        print(f"Fastest under {args.max_noise} mm of noise: {recommended.adc_samples} samples at {recommended.loop_hz:.0f} Hz")
+    if args.output is not None:
+        save_results(results, args.output)
+        print(f"Saved results to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+"""Capture and statistics for analog key calibration"""
+import math
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+from fluxpad_interface import AnalogCalibrationMessage, AnalogReadMessage, Fluxpad
+
+# Samples further than this many scaled MADs from the median are rejected as outliers.
+# 1.4826 scales the MAD to the standard deviation of normally distributed samples
+MAD_TO_STD_DEV = 1.4826
+OUTLIER_THRESHOLD = 3.5
+# Floor for the MAD in ADC counts, so samples within a couple of counts of the median are never outliers
+MIN_MAD = 0.5
+
+MAX_REJECTED_FRACTION = 0.2
+
+# Batch calibration of every analog key from one capture
+PLATEAU_WINDOW = 16  # Samples of one key that must be steady to count as a plateau
+PLATEAU_MAX_STD_DEV = 50  # ADC counts, bottomed out keys are noisier than released ones
+PLATEAU_TOLERANCE = 30  # ADC counts from the highest or lowest steady level that still belong to it
+# Window medians within this many standard errors of the plateau's median belong to it, or MIN_PLATEAU_BAND counts
+PLATEAU_BAND_STD_DEVS = 5.0
+MIN_PLATEAU_BAND = 2.0
+MIN_PLATEAU_SAMPLES = 48
+MIN_TRAVEL_ADC = 300  # Between the rest and bottom out plateaus
+BATCH_TIMEOUT_S = 20.0
+BATCH_CHECK_INTERVAL = 150  # Responses between looking for plateaus
+
+
+class Welford:
+    """Online mean and variance, same as WelfordAlgorithm in the firmware"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+
+    def update(self, value: float):
+        self.count += 1
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+
+    def update_many(self, values: Sequence[float]):
+        """Add a batch of values at once by merging its statistics (Chan et al.)"""
+        values = np.asarray(values, dtype=np.float64)
+        if len(values) == 0:
+            return
+        count = self.count + len(values)
+        batch_mean = float(values.mean())
+        delta = batch_mean - self.mean
+        self.m2 += float(((values - batch_mean) ** 2).sum()) + delta * delta * self.count * len(values) / count
+        self.mean += delta * len(values) / count
+        self.count = count
+
+    def get_mean(self) -> float:
+        return self.mean if self.count > 0 else math.nan
+
+    def get_variance(self) -> float:
+        """Sample variance"""
+        return self.m2 / (self.count - 1) if self.count > 1 else math.nan
+
+    def get_standard_deviation(self) -> float:
+        return math.sqrt(self.get_variance()) if self.count > 1 else math.nan
+
+
+class CalibrationStatistics(NamedTuple):
+    mean: float  # Of the samples that were kept
+    standard_deviation: float
+    median: float
+    mad: float  # Median absolute deviation of all samples
+    sample_count: int
+    rejected_count: int
+
+    @property
+    def rejected_fraction(self) -> float:
+        return self.rejected_count / self.sample_count if self.sample_count else 0.0
+
+
+def robust_statistics(samples: Sequence[float], threshold: float = OUTLIER_THRESHOLD) -> CalibrationStatistics:
+    """Mean and standard deviation of the samples after rejecting outliers with the median and MAD"""
+    samples = np.asarray(samples, dtype=np.float64)
+    assert len(samples) > 0, "No samples"
+    median = float(np.median(samples))
+    mad = float(np.median(np.abs(samples - median)))
+    kept = samples[np.abs(samples - median) <= threshold * MAD_TO_STD_DEV * max(mad, MIN_MAD)]
+
+    welford = Welford()
+    welford.update_many(kept)
+    standard_deviation = welford.get_standard_deviation() if welford.count > 1 else 0.0
+    return CalibrationStatistics(welford.get_mean(), standard_deviation, median, mad, len(samples), len(samples) - len(kept))
+
+
+class CalibrationLimits(NamedTuple):
+    max_std_dev: float
+    min_adc: float
+    max_adc: float
+
+
+UP_LIMITS = CalibrationLimits(max_std_dev=10, min_adc=1600, max_adc=2000)
+DOWN_LIMITS = CalibrationLimits(max_std_dev=50, min_adc=0, max_adc=1300)
+
+
+def check_statistics(stats: CalibrationStatistics, is_up: bool) -> Optional[str]:
+    """Reason the samples are not a usable up or down calibration, None if they are"""
+    limits = UP_LIMITS if is_up else DOWN_LIMITS
+    if stats.mean > limits.max_adc:
+        return f"Reading is too high: {stats.mean:.0f} > {limits.max_adc}, is the key fully {'released' if is_up else 'depressed'}?"
+    if stats.mean < limits.min_adc:
+        return f"Reading is too low: {stats.mean:.0f} < {limits.min_adc}, is the key fully {'released' if is_up else 'depressed'}?"
+    if stats.standard_deviation > limits.max_std_dev:
+        return f"Std Deviation is too high: {stats.standard_deviation} > {limits.max_std_dev}"
+    if stats.rejected_fraction > MAX_REJECTED_FRACTION:
+        return f"Too many outliers: {stats.rejected_count} of {stats.sample_count} samples, did the key move?"
+    return None
+
+
+class KeyPlateaus(NamedTuple):
+    """Steady readings of one key found in a capture, None until the key has been there long enough"""
+    up: Optional[CalibrationStatistics]  # Released, at rest
+    down: Optional[CalibrationStatistics]  # Bottomed out
+    released: bool  # Key is back at rest at the end of the samples
+
+    @property
+    def is_complete(self) -> bool:
+        return self.up is not None and self.down is not None and self.released
+
+
+def find_plateaus(samples: Sequence[float], window: int = PLATEAU_WINDOW) -> KeyPlateaus:
+    """Find the rest and bottom out plateaus in raw ADC samples of a key that was pressed all the way down
+    and released a few times. Readings fall as the key goes down, so rest is the highest steady level
+    and bottom out the lowest one"""
+    samples = np.asarray(samples, dtype=np.float64)
+    if len(samples) < window:
+        return KeyPlateaus(None, None, False)
+
+    windows = np.lib.stride_tricks.sliding_window_view(samples, window)
+    deviations = windows.std(axis=1)
+    steady = deviations <= PLATEAU_MAX_STD_DEV
+    if not steady.any():
+        return KeyPlateaus(None, None, False)
+    # Medians of steady windows barely move with noise but do with the key, so they decide which level a window is at
+    levels = np.where(steady, np.median(windows, axis=1), np.nan)
+    top = np.nanmax(levels)
+    bottom = np.nanmin(levels)
+
+    def plateau_statistics(near_level: np.ndarray) -> Optional[CalibrationStatistics]:
+        # Slow moving windows at the start and end of a press can be near the level too,
+        # only keep those whose median is as close to the level as the noise allows
+        center = np.median(levels[near_level])
+        noise = np.median(deviations[near_level])
+        on_level = near_level & (np.abs(levels - center) <= max(PLATEAU_BAND_STD_DEVS * noise / np.sqrt(window), MIN_PLATEAU_BAND))
+        # Every sample covered by a window at the level
+        plateau_samples = samples[np.convolve(on_level, np.ones(window, dtype=np.int64)) > 0]
+        return robust_statistics(plateau_samples) if len(plateau_samples) >= MIN_PLATEAU_SAMPLES else None
+
+    up = plateau_statistics(levels >= top - PLATEAU_TOLERANCE)
+    down = plateau_statistics(levels <= bottom + PLATEAU_TOLERANCE) if top - bottom >= MIN_TRAVEL_ADC else None
+
+    released = up is not None and np.median(samples[-window:]) >= top - PLATEAU_TOLERANCE
+    return KeyPlateaus(up, down, bool(released))
+
+
+class CaptureCancelled(Exception):
+    pass
+
+
+def capture_raw_adc(fluxpad: Fluxpad, key_id: int, count: int,
+                    on_progress: Optional[Callable[[int], None]] = None,
+                    cancel: Optional[threading.Event] = None) -> List[float]:
+    """Read count raw ADC samples of an analog key as fast as the fluxpad answers.
+    Keeps as many reads in flight as the fluxpad allows instead of waiting for each one.
+    on_progress is called with the number of samples so far, from the calling thread"""
+    samples: List[float] = []
+    in_flight: Deque = deque()
+    message = AnalogReadMessage()
+    message.raw_adc = 0
+    message.key_id = key_id
+
+    with fluxpad.pipelined():
+        try:
+            while len(samples) < count:
+                if cancel is not None and cancel.is_set():
+                    raise CaptureCancelled()
+                if len(samples) + len(in_flight) < count and len(in_flight) < Fluxpad.MAX_IN_FLIGHT:
+                    in_flight.append(fluxpad.submit_read_request(message))
+                    continue
+                response = fluxpad.wait_for_response(in_flight.popleft())
+                samples.append(response.raw_adc)
+                if on_progress is not None:
+                    on_progress(len(samples))
+        finally:
+            # Collect the responses to reads still in flight when cancelled or failed
+            for future in in_flight:
+                try:
+                    fluxpad.wait_for_response(future)
+                except Exception:
+                    pass
+    return samples
+
+
+def capture_all_keys(fluxpad: Fluxpad, key_ids: Sequence[int] = Fluxpad.ANALOG_KEY_IDS, timeout_s: float = BATCH_TIMEOUT_S,
+                     on_progress: Optional[Callable[[Dict[int, KeyPlateaus]], None]] = None,
+                     cancel: Optional[threading.Event] = None) -> Dict[int, KeyPlateaus]:
+    """Read raw ADC samples of all keys round robin while each one is pressed all the way down and released.
+    Stops once the rest and bottom out plateaus of every key were found and every key is released again,
+    or after timeout_s. on_progress is called with the plateaus found so far, from the calling thread"""
+    samples: Dict[int, List[float]] = {key_id: [] for key_id in key_ids}
+    plateaus = {key_id: KeyPlateaus(None, None, False) for key_id in key_ids}
+    messages = []
+    for key_id in key_ids:
+        message = AnalogReadMessage()
+        message.raw_adc = 0
+        message.key_id = key_id
+        messages.append(message)
+
+    in_flight: Deque[Tuple[int, object]] = deque()
+    next_key = 0
+    responses = 0
+    end_time = time.monotonic() + timeout_s
+    with fluxpad.pipelined():
+        try:
+            while True:
+                if cancel is not None and cancel.is_set():
+                    raise CaptureCancelled()
+                if len(in_flight) < Fluxpad.MAX_IN_FLIGHT:
+                    message = messages[next_key]
+                    in_flight.append((message.key_id, fluxpad.submit_read_request(message)))
+                    next_key = (next_key + 1) % len(messages)
+                    continue
+                key_id, future = in_flight.popleft()
+                samples[key_id].append(fluxpad.wait_for_response(future).raw_adc)
+                responses += 1
+
+                if responses % BATCH_CHECK_INTERVAL == 0:
+                    plateaus = {key_id: find_plateaus(key_samples) for key_id, key_samples in samples.items()}
+                    if on_progress is not None:
+                        on_progress(plateaus)
+                    if all(key_plateaus.is_complete for key_plateaus in plateaus.values()) or time.monotonic() > end_time:
+                        break
+        finally:
+            for _, future in in_flight:
+                try:
+                    fluxpad.wait_for_response(future)
+                except Exception:
+                    pass
+    return plateaus
+
+
+def write_calibrations(fluxpad: Fluxpad, calibrations: Dict[int, Tuple[float, float]]):
+    """Write the (down, up) calibration in ADC counts of several keys at once and check them by reading them back"""
+    with fluxpad.pipelined():
+        futures = []
+        for key_id, (calibration_down, calibration_up) in calibrations.items():
+            message = AnalogCalibrationMessage()
+            message.key_id = key_id
+            message.calibration_down = calibration_down
+            message.calibration_up = calibration_up
+            futures.append(fluxpad.submit_write_request(message))
+        for future in futures:
+            fluxpad.wait_for_response(future)
+
+        futures = []
+        for key_id in calibrations:
+            message = AnalogCalibrationMessage()
+            message.set_zeros()
+            message.key_id = key_id
+            futures.append(fluxpad.submit_read_request(message))
+        for (calibration_down, calibration_up), future in zip(calibrations.values(), futures):
+            echo = fluxpad.wait_for_response(future)
+            assert math.isclose(calibration_down, echo.calibration_down, rel_tol=1e-4), f"{calibration_down} not equal to {echo.calibration_down}"
+            assert math.isclose(calibration_up, echo.calibration_up, rel_tol=1e-4), f"{calibration_up} not equal to {echo.calibration_up}"
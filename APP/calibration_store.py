@@ -0,0 +1,230 @@
+"""Local history of every calibration and rest position sample, per fluxpad and analog key.
+
+Kept in a SQLite database indexed by USB serial number and key id, so the drift of a key since its
+last calibration is a lookup instead of a re-calibration, and the fleet tooling can list just the
+fluxpads that need to be re-calibrated.
+
+usage: python calibration_store.py sample [--database PATH]
+       python calibration_store.py drift SERIAL [--key 2 3 4] [--database PATH]
+       python calibration_store.py flagged [--threshold ADC] [--database PATH]
+"""
+import argparse
+import logging
+import pathlib
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, NamedTuple, Optional, Union
+
+import calibration
+from fluxpad_interface import AnalogCalibrationMessage, Fluxpad, find_fluxpad_ports
+
+DEFAULT_PATH = pathlib.Path.home() / ".fluxapp" / "calibration.sqlite3"
+SCHEMA_VERSION = 1
+
+# Rest readings this far from the calibrated up position in ADC counts need a new calibration
+DEFAULT_DRIFT_THRESHOLD_ADC = 20.0
+REST_SAMPLE_COUNT = 200
+
+PathLike = Union[str, pathlib.Path]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS calibrations (
+    id INTEGER PRIMARY KEY,
+    serial_number TEXT NOT NULL,
+    key_id INTEGER NOT NULL,
+    is_up INTEGER NOT NULL,
+    time REAL NOT NULL,
+    mean REAL NOT NULL,
+    standard_deviation REAL NOT NULL,
+    sample_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS calibrations_by_key ON calibrations (serial_number, key_id, is_up, time);
+
+CREATE TABLE IF NOT EXISTS rest_samples (
+    id INTEGER PRIMARY KEY,
+    serial_number TEXT NOT NULL,
+    key_id INTEGER NOT NULL,
+    time REAL NOT NULL,
+    mean REAL NOT NULL,
+    standard_deviation REAL NOT NULL,
+    sample_count INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS rest_samples_by_key ON rest_samples (serial_number, key_id, time);
+"""
+
+# Latest up calibration and latest rest sample of every key, SQLite takes the other columns from the row with the MAX()
+DRIFTED_QUERY = """
+SELECT c.serial_number, c.key_id, c.mean, c.time, r.mean, r.time
+FROM (SELECT serial_number, key_id, mean, MAX(time) AS time FROM calibrations WHERE is_up = 1 GROUP BY serial_number, key_id) AS c
+JOIN (SELECT serial_number, key_id, mean, MAX(time) AS time FROM rest_samples GROUP BY serial_number, key_id) AS r
+ON r.serial_number = c.serial_number AND r.key_id = c.key_id AND r.time >= c.time
+WHERE ABS(r.mean - c.mean) > ?
+ORDER BY ABS(r.mean - c.mean) DESC
+"""
+
+
+class CalibrationRecord(NamedTuple):
+    serial_number: str
+    key_id: int
+    is_up: bool
+    time: float  # Unix time
+    mean: float  # ADC counts
+    standard_deviation: float
+    sample_count: int
+
+
+class Drift(NamedTuple):
+    serial_number: str
+    key_id: int
+    calibration_up: float  # ADC counts
+    calibrated_time: float
+    rest_adc: float  # Latest rest sample since the calibration
+    sampled_time: float
+
+    @property
+    def drift_adc(self) -> float:
+        return self.rest_adc - self.calibration_up
+
+
+class CalibrationStore:
+    """Calibration history database, safe to share between threads"""
+
+    def __init__(self, path: PathLike = DEFAULT_PATH) -> None:
+        self.path = pathlib.Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(self.path, check_same_thread=False)
+        with self._connection:
+            self._connection.executescript(SCHEMA)
+            self._connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def record_calibration(self, serial_number: str, key_id: int, is_up: bool, stats: calibration.CalibrationStatistics, time_s: Optional[float] = None):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO calibrations (serial_number, key_id, is_up, time, mean, standard_deviation, sample_count) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (serial_number, key_id, int(is_up), time.time() if time_s is None else time_s, stats.mean, stats.standard_deviation, stats.sample_count))
+
+    def record_rest_sample(self, serial_number: str, key_id: int, stats: calibration.CalibrationStatistics, time_s: Optional[float] = None):
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO rest_samples (serial_number, key_id, time, mean, standard_deviation, sample_count) VALUES (?, ?, ?, ?, ?, ?)",
+                (serial_number, key_id, time.time() if time_s is None else time_s, stats.mean, stats.standard_deviation, stats.sample_count))
+
+    def calibrations(self, serial_number: str, key_id: int) -> List[CalibrationRecord]:
+        """Every calibration of a key, oldest first"""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT serial_number, key_id, is_up, time, mean, standard_deviation, sample_count FROM calibrations "
+                "WHERE serial_number = ? AND key_id = ? ORDER BY time", (serial_number, key_id)).fetchall()
+        return [CalibrationRecord(row[0], row[1], bool(row[2]), *row[3:]) for row in rows]
+
+    def drift(self, serial_number: str, key_id: int) -> Optional[Drift]:
+        """How far the rest position of a key has moved since its last up calibration, None if it hasn't been sampled since"""
+        with self._lock:
+            calibrated = self._connection.execute(
+                "SELECT mean, time FROM calibrations WHERE serial_number = ? AND key_id = ? AND is_up = 1 ORDER BY time DESC LIMIT 1",
+                (serial_number, key_id)).fetchone()
+            if calibrated is None:
+                return None
+            sampled = self._connection.execute(
+                "SELECT mean, time FROM rest_samples WHERE serial_number = ? AND key_id = ? AND time >= ? ORDER BY time DESC LIMIT 1",
+                (serial_number, key_id, calibrated[1])).fetchone()
+        if sampled is None:
+            return None
+        return Drift(serial_number, key_id, calibrated[0], calibrated[1], sampled[0], sampled[1])
+
+    def drifted(self, threshold_adc: float = DEFAULT_DRIFT_THRESHOLD_ADC) -> List[Drift]:
+        """Every key whose latest rest sample is further than threshold_adc from its last up calibration, worst first"""
+        with self._lock:
+            rows = self._connection.execute(DRIFTED_QUERY, (threshold_adc,)).fetchall()
+        return [Drift(*row) for row in rows]
+
+
+def sample_rest_positions(fluxpad: Fluxpad, store: CalibrationStore, count: int = REST_SAMPLE_COUNT) -> Dict[int, Optional[calibration.CalibrationStatistics]]:
+    """Sample the rest position of every analog key and record it, keys that are pressed or moving are skipped.
+    Returns the recorded statistics, None for skipped keys"""
+    assert fluxpad.serial_number is not None, "Fluxpad has no serial number"
+    results = {}
+    for key_id in Fluxpad.ANALOG_KEY_IDS:
+        message = AnalogCalibrationMessage()
+        message.set_zeros()
+        message.key_id = key_id
+        calibrated = fluxpad.send_read_request(message)
+        stats = calibration.robust_statistics(calibration.capture_raw_adc(fluxpad, key_id, count))
+
+        # Readings fall as the key goes down, closer to the down calibration means it's being pressed
+        is_pressed = stats.mean < (calibrated.calibration_up + calibrated.calibration_down) / 2
+        if is_pressed or stats.standard_deviation > calibration.UP_LIMITS.max_std_dev or stats.rejected_fraction > calibration.MAX_REJECTED_FRACTION:
+            logging.info(f"Skipped rest sample of key {key_id} on {fluxpad.serial_number}, mean {stats.mean:.1f} std dev {stats.standard_deviation:.1f}")
+            results[key_id] = None
+            continue
+        store.record_rest_sample(fluxpad.serial_number, key_id, stats)
+        results[key_id] = stats
+    return results
+
+
+def format_drift(drift: Drift) -> str:
+    return (f"{drift.serial_number} key {drift.key_id}: {drift.drift_adc:+.1f} ADC since calibration on "
+            f"{time.ctime(drift.calibrated_time)} ({drift.calibration_up:.1f} -> {drift.rest_adc:.1f})")
+
+
+def sample(store: CalibrationStore) -> int:
+    """Record rest samples of every attached fluxpad"""
+    ports = find_fluxpad_ports()
+    if not ports:
+        print("No fluxpads found", file=sys.stderr)
+        return 1
+    for serial_number, port in ports.items():
+        fluxpad = Fluxpad(port, serial_number)
+        fluxpad.open()
+        try:
+            results = sample_rest_positions(fluxpad, store)
+        finally:
+            fluxpad.close()
+        for key_id, stats in results.items():
+            print(f"{serial_number} key {key_id}: " + (f"{stats.mean:.1f} ADC" if stats is not None else "skipped, key pressed or moving"))
+            drift = store.drift(serial_number, key_id)
+            if drift is not None:
+                print(f"    {format_drift(drift)}")
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Calibration history and rest position drift of fluxpads")
+    parser.add_argument("--database", type=pathlib.Path, default=DEFAULT_PATH)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("sample", help="Record the rest position of every key of the attached fluxpads")
+    drift_parser = subparsers.add_parser("drift", help="Drift of a fluxpad's keys since their last calibration")
+    drift_parser.add_argument("serial_number")
+    drift_parser.add_argument("--key", type=int, nargs="+", default=list(Fluxpad.ANALOG_KEY_IDS))
+    flagged_parser = subparsers.add_parser("flagged", help="List keys that drifted past the threshold and need calibrating")
+    flagged_parser.add_argument("--threshold", type=float, default=DEFAULT_DRIFT_THRESHOLD_ADC, help=f"ADC counts (default {DEFAULT_DRIFT_THRESHOLD_ADC})")
+    args = parser.parse_args(argv)
+
+    with CalibrationStore(args.database) as store:
+        if args.command == "sample":
+            return sample(store)
+        if args.command == "drift":
+            for key_id in args.key:
+                drift = store.drift(args.serial_number, key_id)
+                print(format_drift(drift) if drift is not None else f"{args.serial_number} key {key_id}: not sampled since last calibration")
+            return 0
+        for drift in store.drifted(args.threshold):
+            print(format_drift(drift))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
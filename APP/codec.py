@@ -0,0 +1,371 @@
+"""Wire codecs for the fluxpad serial protocol.
+
+JsonCodec is the original protocol, one JSON object per message.
+BinaryCodec packs the same messages into a compact frame:
+
+    sync (2 bytes) | payload length (uint16) | payload | checksum (uint8)
+
+The payload is a sequence of fields, each a one byte field id followed by the value
+in the fixed struct format of that field (see BINARY_FIELDS). Settings in mm and ADC
+counts are sent as the Q22.10 fixed point integers the firmware stores them as.
+Lists, like the per key readings of datastream messages, have field ids of their own
+and are sent as a uint8 count followed by the values.
+"""
+import json
+import logging
+import re
+import struct
+import time
+from typing import Dict, Iterator, NamedTuple, Tuple, Union
+
+import serial
+
+
+class FrameDecoder:
+    """Incremental decoder that splits the incoming byte stream into JSON frames.
+
+    Everything waiting on the port is read in one go into a preallocated buffer.
+    Brace depth and string state are tracked so nested objects and braces inside
+    strings are handled, and text between frames (eg. "Loop freq: ..." lines) is skipped.
+    Frames are yielded as memoryviews into the buffer, which are only valid until the next read"""
+
+    BUFFER_SIZE = 4096
+
+    _SOP = ord("{")
+    _EOP = ord("}")
+    _QUOTE = ord('"')
+    _FRAME_CHARS = re.compile(rb'[{}"]')
+    _STRING_CHARS = re.compile(rb'["\\]')
+
+    def __init__(self, buffer_size: int = BUFFER_SIZE) -> None:
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._end = 0  # End of valid data in buffer
+        self._scan = 0  # Next byte to scan
+        self._frame_start = -1  # Start of the frame being decoded, -1 if between frames
+        self._depth = 0
+        self._in_string = False
+
+    def reset(self):
+        """Drop any buffered data and partially decoded frame"""
+        self._end = 0
+        self._scan = 0
+        self._frame_start = -1
+        self._depth = 0
+        self._in_string = False
+
+    def _compact(self):
+        """Move unprocessed data to the start of the buffer to make space for new data"""
+        keep_from = self._frame_start if self._frame_start >= 0 else self._scan
+        if keep_from > 0:
+            length = self._end - keep_from
+            self._buffer[:length] = self._buffer[keep_from:self._end]
+            self._scan -= keep_from
+            self._end = length
+            if self._frame_start >= 0:
+                self._frame_start = 0
+        elif self._end == len(self._buffer):
+            logging.warning(f"Dropping frame larger than {len(self._buffer)} bytes")
+            self.reset()
+
+    def read_from(self, port: serial.Serial) -> Iterator[memoryview]:
+        """Read everything waiting on the port and yield the complete frames.
+        Blocks for up to the port timeout if nothing is waiting"""
+        self._compact()
+        size = min(max(port.in_waiting, 1), len(self._buffer) - self._end)
+        self._end += port.readinto(self._view[self._end:self._end + size])
+        return self._decode()
+
+    def feed(self, data: bytes) -> Iterator[memoryview]:
+        """Add received bytes and yield the complete frames"""
+        data = memoryview(data)
+        while len(data):
+            self._compact()
+            size = min(len(data), len(self._buffer) - self._end)
+            self._view[self._end:self._end + size] = data[:size]
+            self._end += size
+            data = data[size:]
+            yield from self._decode()
+
+    def _decode(self) -> Iterator[memoryview]:
+        buffer = self._buffer
+        while self._scan < self._end:
+            if self._frame_start < 0:
+                # Skip noise between frames
+                start = buffer.find(self._SOP, self._scan, self._end)
+                if start < 0:
+                    self._scan = self._end
+                    return
+                self._frame_start = start
+                self._scan = start
+                self._depth = 0
+                self._in_string = False
+
+            # Jump between the characters that change the decoder state
+            pattern = self._STRING_CHARS if self._in_string else self._FRAME_CHARS
+            match = pattern.search(buffer, self._scan, self._end)
+            if match is None:
+                self._scan = self._end
+                return
+            index = match.start()
+            char = buffer[index]
+            self._scan = index + 1
+
+            if self._in_string:
+                if char == self._QUOTE:
+                    self._in_string = False
+                elif self._scan < self._end:
+                    self._scan += 1  # Skip escaped character
+                else:
+                    self._scan = index  # Escape split across reads, look at it again later
+                    return
+            elif char == self._QUOTE:
+                self._in_string = True
+            elif char == self._SOP:
+                self._depth += 1
+            else:
+                self._depth -= 1
+                if self._depth == 0:
+                    frame = self._view[self._frame_start:self._scan]
+                    self._frame_start = -1
+                    yield frame
+
+
+
+class BinaryFrameDecoder(FrameDecoder):
+    """Incremental decoder that splits the incoming byte stream into binary codec frames.
+    Bytes that aren't part of a frame with a valid checksum are skipped.
+    Yields the frame payloads as memoryviews into the buffer, which are only valid until the next read"""
+
+    SYNC = b"\xa5\x5a"
+    _HEADER = struct.Struct("<2sH")
+    _CHECKSUM_SIZE = 1
+
+    def _decode(self) -> Iterator[memoryview]:
+        buffer = self._buffer
+        while self._scan < self._end:
+            if self._frame_start < 0:
+                start = buffer.find(self.SYNC, self._scan, self._end)
+                if start < 0:
+                    # Keep a trailing byte that could be the start of a split sync
+                    self._scan = max(self._scan, self._end - len(self.SYNC) + 1)
+                    return
+                self._frame_start = start
+                self._scan = start
+
+            header_end = self._frame_start + self._HEADER.size
+            if header_end > self._end:
+                return
+            _, length = self._HEADER.unpack_from(buffer, self._frame_start)
+            frame_end = header_end + length + self._CHECKSUM_SIZE
+            if frame_end > self._end:
+                if frame_end - self._frame_start > len(buffer):
+                    logging.warning(f"Dropping frame larger than {len(buffer)} bytes")
+                    self._scan = self._frame_start + 1
+                    self._frame_start = -1
+                return
+
+            payload = self._view[header_end:frame_end - self._CHECKSUM_SIZE]
+            if buffer[frame_end - 1] != BinaryCodec.checksum(payload):
+                # Not a real frame, look for the next sync after this one
+                self._scan = self._frame_start + 1
+                self._frame_start = -1
+                continue
+
+            self._scan = frame_end
+            self._frame_start = -1
+            yield payload
+
+
+LIST_SUFFIX = "[]"
+
+
+class BinaryField(NamedTuple):
+    """Wire format of one message field in the binary codec"""
+    field_id: int
+    key: str
+    format: str  # struct format, "q" for Q22.10 fixed point and "s" for a length prefixed string, "[]" after it for a list
+
+
+# Field ids are part of the wire format, only ever append to this table
+BINARY_FIELDS = [
+    BinaryField(0x01, "cmd", "c"),
+    BinaryField(0x02, "tkn", "B"),
+    BinaryField(0x03, "V", "B"),
+    BinaryField(0x04, "key", "B"),
+    BinaryField(0x05, "k_t", "B"),
+    BinaryField(0x06, "k_c", "H"),
+    BinaryField(0x07, "h_a", "q"),
+    BinaryField(0x08, "h_r", "q"),
+    BinaryField(0x09, "p_a", "q"),
+    BinaryField(0x0A, "p_r", "q"),
+    BinaryField(0x0B, "rt", "?"),
+    BinaryField(0x0C, "adc", "q"),
+    BinaryField(0x0D, "ht", "q"),
+    BinaryField(0x0E, "d_a", "H"),
+    BinaryField(0x0F, "d_r", "H"),
+    BinaryField(0x10, "a_s", "H"),
+    BinaryField(0x11, "c_u", "q"),
+    BinaryField(0x12, "c_d", "q"),
+    BinaryField(0x13, "dstrm", "H"),
+    BinaryField(0x14, "dstrm_freq", "H"),
+    BinaryField(0x15, "l_m", "B"),
+    BinaryField(0x16, "l_b", "B"),
+    BinaryField(0x17, "l_d", "I"),
+    BinaryField(0x18, "rgb_m", "B"),
+    BinaryField(0x19, "rgb_b", "B"),
+    BinaryField(0x1A, "rgb_s", "f"),
+    BinaryField(0x1B, "rgb_c1", "I"),
+    BinaryField(0x1C, "rgb_c2", "I"),
+    BinaryField(0x1D, "rgb_c3", "I"),
+    BinaryField(0x1E, "clear", "H"),
+    BinaryField(0x1F, "cdc", "B"),
+    BinaryField(0x20, "adc_n", "H"),
+    BinaryField(0x21, "crc", "I"),
+    BinaryField(0x22, "t", "I"),
+    BinaryField(0x23, "adc", "q[]"),
+    BinaryField(0x24, "ht", "q[]"),
+    BinaryField(0x25, "p", "B[]"),
+    BinaryField(0x26, "dstrm_raw", "?"),
+    BinaryField(0x27, "raw", "s"),
+    BinaryField(0x28, "p", "I"),  # Bitmask of the pressed keys in raw datastream messages
+    BinaryField(0x7F, "error", "s"),
+]
+
+
+class JsonCodec:
+    """Original JSON protocol"""
+
+    NAME = "json"
+    CODEC_ID = 0
+
+    def encode(self, data: dict) -> bytes:
+        return json.dumps(data, indent=None, separators=(',', ':')).encode("ASCII")
+
+    def decode(self, frame: Union[bytes, memoryview]) -> dict:
+        return json.loads(bytes(frame))
+
+    def new_frame_decoder(self) -> FrameDecoder:
+        return FrameDecoder()
+
+
+class BinaryCodec:
+    """Compact binary protocol, see module docstring for the frame layout"""
+
+    NAME = "binary"
+    CODEC_ID = 1
+
+    Q22_10_SCALE = 1024
+
+    _FIELDS_BY_KEY: Dict[str, BinaryField] = {field.key: field for field in BINARY_FIELDS if not field.format.endswith(LIST_SUFFIX)}
+    _LIST_FIELDS_BY_KEY: Dict[str, BinaryField] = {field.key: field for field in BINARY_FIELDS if field.format.endswith(LIST_SUFFIX)}
+    _FIELDS_BY_ID: Dict[int, BinaryField] = {field.field_id: field for field in BINARY_FIELDS}
+    _STRUCTS = {format: struct.Struct("<" + ("i" if format == "q" else format))
+                for format in {field.format.replace(LIST_SUFFIX, "") for field in BINARY_FIELDS} if format != "s"}
+    _HEADER = BinaryFrameDecoder._HEADER
+
+    @staticmethod
+    def checksum(payload: Union[bytes, memoryview]) -> int:
+        return sum(payload) & 0xFF
+
+    def _encode_value(self, payload: bytearray, format: str, value):
+        if format == "s":
+            encoded = str(value).encode("utf-8")[:0xFF]
+            payload.append(len(encoded))
+            payload += encoded
+        elif format == "q":
+            # Truncate like the firmware's FLOAT_TO_Q22_10
+            payload += self._STRUCTS["q"].pack(int(value * self.Q22_10_SCALE))
+        elif format == "c":
+            payload += self._STRUCTS["c"].pack(value.encode("ASCII"))
+        else:
+            payload += self._STRUCTS[format].pack(value)
+
+    def encode(self, data: dict) -> bytes:
+        payload = bytearray()
+        for key, value in data.items():
+            is_list = isinstance(value, (list, tuple))
+            field = (self._LIST_FIELDS_BY_KEY if is_list else self._FIELDS_BY_KEY).get(key)
+            if field is None:
+                raise ValueError(f"Key {key} has no binary encoding{' as a list' if is_list else ''}")
+            payload.append(field.field_id)
+            if is_list:
+                if len(value) > 0xFF:
+                    raise ValueError(f"List {key} too long to encode: {len(value)} values")
+                payload.append(len(value))
+                element_format = field.format[:-len(LIST_SUFFIX)]
+                for element in value:
+                    self._encode_value(payload, element_format, element)
+            else:
+                self._encode_value(payload, field.format, value)
+        if len(payload) > 0xFFFF:
+            raise ValueError(f"Message too long to encode: {len(payload)} bytes")
+        return self._HEADER.pack(BinaryFrameDecoder.SYNC, len(payload)) + payload + bytes((self.checksum(payload),))
+
+    def _decode_value(self, frame: Union[bytes, memoryview], index: int, format: str) -> Tuple[object, int]:
+        """Value at index and the index after it"""
+        if format == "s":
+            length = frame[index]
+            return bytes(frame[index + 1:index + 1 + length]).decode("utf-8", errors="replace"), index + 1 + length
+        field_struct = self._STRUCTS[format]
+        value, = field_struct.unpack_from(frame, index)
+        if format == "q":
+            value = value / self.Q22_10_SCALE
+        elif format == "c":
+            value = value.decode("ASCII")
+        return value, index + field_struct.size
+
+    def decode(self, frame: Union[bytes, memoryview]) -> dict:
+        data = dict()
+        index = 0
+        try:
+            while index < len(frame):
+                field = self._FIELDS_BY_ID.get(frame[index])
+                if field is None:
+                    raise ValueError(f"Unknown field id {frame[index]:#04x}")
+                index += 1
+                if not field.format.endswith(LIST_SUFFIX):
+                    data[field.key], index = self._decode_value(frame, index, field.format)
+                    continue
+                element_format = field.format[:-len(LIST_SUFFIX)]
+                count = frame[index]
+                index += 1
+                values = []
+                for _ in range(count):
+                    value, index = self._decode_value(frame, index, element_format)
+                    values.append(value)
+                data[field.key] = values
+        except (struct.error, IndexError) as e:
+            raise ValueError(f"Truncated binary frame: {e}") from e
+        return data
+
+    def new_frame_decoder(self) -> FrameDecoder:
+        return BinaryFrameDecoder()
+
+
+AnyCodec = Union[JsonCodec, BinaryCodec]
+CODECS: Dict[int, type] = {JsonCodec.CODEC_ID: JsonCodec, BinaryCodec.CODEC_ID: BinaryCodec}
+
+
+def benchmark(iterations: int = 100000):
+    """Compare message size and round trip time of the codecs on analog read polling"""
+    request = {"cmd": "r", "tkn": 42, "key": 2, "adc": 0, "ht": 0}
+    response = {"cmd": "r", "key": 2, "adc": 1834.5, "ht": 2.3505859375, "tkn": 42}
+    for codec in (JsonCodec(), BinaryCodec()):
+        encoded_request = codec.encode(request)
+        encoded_response = codec.encode(response)
+        decoder = codec.new_frame_decoder()
+        assert [codec.decode(frame) for frame in decoder.feed(encoded_response)] == [response]
+
+        start_s = time.perf_counter()
+        for _ in range(iterations):
+            codec.encode(request)
+            for frame in decoder.feed(encoded_response):
+                codec.decode(frame)
+        elapsed_s = time.perf_counter() - start_s
+        print(f"{codec.NAME:>6}: request {len(encoded_request):>3} bytes, response {len(encoded_response):>3} bytes, "
+              f"round trip {elapsed_s / iterations * 1e6:.2f} us")
+
+
+if __name__ == "__main__":
+    benchmark()
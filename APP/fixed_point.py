@@ -0,0 +1,124 @@
+"""Bit exact model of the firmware's Q22.10 fixed point height conversion (AnalogSwitch.h).
+
+Every function works on NumPy arrays as well as single values and uses the same integer math,
+truncation and wrap around as the firmware, so results match what the fluxpad computes exactly.
+Q22.10 values are held in int64 arrays.
+"""
+import numpy as np
+
+FRAC_BITS = 10
+SCALE = 1 << FRAC_BITS
+UINT32_MASK = 0xFFFFFFFF
+
+ADC_BITS = 12
+LUT_BITS = 4
+LUT_SHIFT = ADC_BITS - LUT_BITS
+
+# adc_to_dist_lut, mm at every 256 ADC counts from 0 to 4096
+ADC_TO_DIST_LUT_MM = (0.0, 0.6, 1.8, 2.42, 2.65, 2.79, 2.95, 3.15, 3.4, 3.71, 4.05, 4.55, 5.31, 6.55, 9.0, 9.5, 10.0)
+
+# Heights the calibration maps the calibrated up and down positions to
+REFERENCE_UP_MM = 6.0
+REFERENCE_DOWN_MM = 2.0
+REFERENCE_UP_ADC = 3214
+REFERENCE_DOWN_ADC = 594
+
+# Firmware default calibration of a key that has never been calibrated
+DEFAULT_CALIBRATION_UP_ADC = 1650
+DEFAULT_CALIBRATION_DOWN_ADC = 1100
+
+ADC_SAMPLES_N = 110  # Samples averaged for every reading
+
+
+def to_q22_10(value) -> np.ndarray:
+    """FLOAT_TO_Q22_10 on a float, truncates towards zero"""
+    return np.trunc(np.asarray(value, dtype=np.float32) * np.float32(SCALE)).astype(np.int64)
+
+
+def int_to_q22_10(value) -> np.ndarray:
+    """INT_TO_Q22_10"""
+    return (np.asarray(value, dtype=np.int64) << FRAC_BITS) & UINT32_MASK
+
+
+def q22_10_to_float(value) -> np.ndarray:
+    """Q22_10_TO_FLOAT, what the fluxpad sends back in messages"""
+    return (np.asarray(value, dtype=np.int64) / np.float32(SCALE)).astype(np.float32)
+
+
+def round_to_q22_10(value) -> np.ndarray:
+    """Q22.10 value of a number the fluxpad sent, undoing any rounding from printing it as JSON"""
+    return np.rint(np.asarray(value, dtype=np.float64) * SCALE).astype(np.int64)
+
+
+LUT_SIZE = (1 << LUT_BITS) + 1
+LUT_STEP = 1 << LUT_SHIFT  # ADC counts between table entries
+ADC_TO_DIST_LUT = to_q22_10(ADC_TO_DIST_LUT_MM)
+# The firmware reads one past the end of the table for a reading of exactly 4096, but weights it by 0
+_LUT_PADDED = np.append(ADC_TO_DIST_LUT, 0)
+
+ADC_CLAMP_MIN = int(int_to_q22_10(0))
+ADC_CLAMP_MAX = int(int_to_q22_10(1 << ADC_BITS))
+
+
+def take_avg_reading(samples, axis: int = -1) -> np.ndarray:
+    """AnalogSwitch::takeAvgReading, averages raw 12 bit ADC samples along axis"""
+    samples = np.asarray(samples, dtype=np.int64)
+    total = int_to_q22_10(samples).sum(axis=axis) & UINT32_MASK
+    return total // samples.shape[axis]
+
+
+def _divide_truncating(numerator: np.ndarray, denominator: np.ndarray) -> np.ndarray:
+    """C integer division, rounds towards zero instead of down"""
+    quotient = np.abs(numerator) // np.abs(denominator)
+    return np.where((numerator < 0) != (denominator < 0), -quotient, quotient)
+
+
+def lerp2(x, y0, y1, x0, x1) -> np.ndarray:
+    """AnalogSwitch::lerp2, maps x0..x1 to y0..y1 with 64 bit intermediates"""
+    x, y0, y1, x0, x1 = (np.asarray(value, dtype=np.int64) for value in (x, y0, y1, x0, x1))
+    term_a = y0 * (x1 - x)
+    term_b = y1 * (x - x0)
+    term_c = x1 - x0
+    assert np.all(term_c != 0), "Calibration up and down can't be the same"
+    return _divide_truncating(term_a + term_b, term_c) & UINT32_MASK
+
+
+def apply_calibration(reading, calibration_down_adc, calibration_up_adc) -> np.ndarray:
+    """AnalogSwitch::apply_calibration, all arguments in Q22.10"""
+    return lerp2(reading, int_to_q22_10(REFERENCE_DOWN_ADC), int_to_q22_10(REFERENCE_UP_ADC), calibration_down_adc, calibration_up_adc)
+
+
+def lerp(a, b, t) -> np.ndarray:
+    """AnalogSwitch::lerp, t is in Q22.10 between 0 and 1"""
+    a_weight = (a * (SCALE - t) & UINT32_MASK) >> FRAC_BITS
+    b_weight = (b * t & UINT32_MASK) >> FRAC_BITS
+    return (a_weight + b_weight) & UINT32_MASK
+
+
+def lut(x, table=None) -> np.ndarray:
+    """AnalogSwitch::lut, x must be between 0 and 4096 counts.
+    table replaces adc_to_dist_lut with LUT_SIZE Q22.10 values"""
+    x = np.asarray(x, dtype=np.int64)
+    padded = _LUT_PADDED if table is None else np.append(np.asarray(table, dtype=np.int64), 0)
+    lut_index = (x >> FRAC_BITS) >> LUT_SHIFT
+    x_floored = int_to_q22_10(lut_index << LUT_SHIFT)
+    fraction = (x - x_floored) >> LUT_SHIFT
+    return lerp(padded[lut_index], padded[lut_index + 1], fraction)
+
+
+def adc_counts_to_distance_mm(counts, table=None) -> np.ndarray:
+    """AnalogSwitch::adcCountsToDistanceMM, clamps as unsigned so wrapped negative counts become 4096"""
+    return lut(np.clip(np.asarray(counts, dtype=np.int64) & UINT32_MASK, ADC_CLAMP_MIN, ADC_CLAMP_MAX), table)
+
+
+def reading_to_height(reading, calibration_down_adc, calibration_up_adc, table=None) -> np.ndarray:
+    """Averaged ADC reading to height like AnalogSwitch::mainLoopService, all in Q22.10"""
+    return adc_counts_to_distance_mm(apply_calibration(reading, calibration_down_adc, calibration_up_adc), table)
+
+
+def raw_adc_to_height_mm(raw_adc, calibration_down_adc: float = DEFAULT_CALIBRATION_DOWN_ADC, calibration_up_adc: float = DEFAULT_CALIBRATION_UP_ADC, table_mm=None) -> np.ndarray:
+    """Heights in mm the fluxpad computes from readings it reported as "adc".
+    The calibration is in ADC counts as in AnalogCalibrationMessage, table_mm replaces adc_to_dist_lut"""
+    table = None if table_mm is None else to_q22_10(table_mm)
+    height = reading_to_height(round_to_q22_10(raw_adc), to_q22_10(calibration_down_adc), to_q22_10(calibration_up_adc), table)
+    return q22_10_to_float(height)
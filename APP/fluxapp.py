@@ -3,17 +3,19 @@ import tkinter as tk
 from tkinter import colorchooser
 from tkinter import ttk
 from typing import Union, Optional, Callable, List, Type
-from collections import deque
 import logging
 import platform
-import statistics
 from tkinter import font
 import pathlib
 import time
 import threading
+import concurrent.futures
 from tkinter import messagebox
 from tkinter import filedialog
+from tkinter import simpledialog
 import math
+import copy
+import abc
 import traceback
 import sys
 from PIL import Image, ImageTk
@@ -26,6 +28,12 @@ import darkdetect
 from scancode_to_hid_code import (ScanCodeList, ScanCode, get_name_list,
                                   pynput_event_to_scancode, key_name_to_scancode, key_type_and_code_to_scancode)
 import fluxpad_interface
+import fixed_point
+import calibration
+import calibration_store
+import settings_cache
+import profile_library
+import settings_schema
 import use_sv_ttk
 from ttk_slider import SliderSetting
 import firmware_updater
@@ -395,12 +403,12 @@ class AnalogSettingsPanel(ttk.Labelframe):
         self.release_debounce.set_value(message.release_debounce)
         self.press_hysteresis.set_value(message.actuate_hysteresis)
         self.release_hysteresis.set_value(message.release_hysteresis)
-        self.actuation_point.set_value(message.actuate_point - 2)  # Bottom out is 2mm in settings, while it's 0mm in GUI
+        self.actuation_point.set_value(message.actuate_point - fixed_point.REFERENCE_DOWN_MM)  # Bottom out is 2mm in settings, while it's 0mm in GUI
 
         if self.is_rapid_trigger.get():
-            self.upper_deadzone.set_value(6 - message.release_point)
+            self.upper_deadzone.set_value(fixed_point.REFERENCE_UP_MM - message.release_point)
         else:
-            self.release_point.set_value(message.release_point - 2)
+            self.release_point.set_value(message.release_point - fixed_point.REFERENCE_DOWN_MM)
         self.on_rapid_trigger_change()
 
     def to_settings_message(self, message: fluxpad_interface.AnalogSettingsMessage):
@@ -409,11 +417,11 @@ class AnalogSettingsPanel(ttk.Labelframe):
         message.release_debounce = self.release_debounce.value
         message.actuate_hysteresis = self.press_hysteresis.value
         message.release_hysteresis = self.release_hysteresis.value
-        message.actuate_point = 2 + self.actuation_point.value  # Bottom out is 2mm in settings, while it's 0mm in GUI
+        message.actuate_point = fixed_point.REFERENCE_DOWN_MM + self.actuation_point.value  # Bottom out is 2mm in settings, while it's 0mm in GUI
         if message.rapid_trigger:
-            message.release_point = 6 - self.upper_deadzone.value
+            message.release_point = fixed_point.REFERENCE_UP_MM - self.upper_deadzone.value
         else:
-            message.release_point = 2 + self.release_point.value
+            message.release_point = fixed_point.REFERENCE_DOWN_MM + self.release_point.value
 
 class DigitalSettingsPanel(ttk.Labelframe):
 
@@ -1079,6 +1087,9 @@ class CalibrationLabelframe(ttk.Labelframe):
         self.notebook.add(self.analog_cal_frame_list[2], text="Analog Key 3")
         self.notebook.grid(row=1, column=1, sticky="EW")
 
+        self.btn_calibrate_all = ttk.Button(self, text="Calibrate All Keys")
+        self.btn_calibrate_all.grid(row=2, column=1, sticky="W", padx=PADDING, pady=PADDING)
+
         self.notebook.bind("<<NotebookTabChanged>>", self.on_notebook_tab_changed)
         self.current_selected_analog_key = 0
 
@@ -1112,33 +1123,93 @@ class UtilitiesFrame(ttk.Frame):
 
 
 
-class CalibrationTopLevel(tk.Toplevel):
-    """Top Level window that holds the calibration routine"""
+def record_calibration(store: Optional[calibration_store.CalibrationStore], fluxpad: fluxpad_interface.Fluxpad, key_id: int, is_up: bool, stats: calibration.CalibrationStatistics):
+    """Add a calibration to the history, if there is one and the fluxpad has a serial number"""
+    if store is None or fluxpad.serial_number is None:
+        return
+    try:
+        store.record_calibration(fluxpad.serial_number, key_id, is_up, stats)
+    except Exception:
+        logging.error("Failed to record calibration", exc_info=True)
 
-    # Calibration settings and validation constants
-    NUMBER_OF_SAMPLES = 20
-    SAMPLE_PERIOD_S = 0.05
 
-    UP_MAX_STD_DEV = 10
-    UP_MAX_ADC = 2000
-    UP_MIN_ADC = 1600
+class CalibrationCaptureTopLevel(tk.Toplevel, abc.ABC):
+    """Top Level window that runs a calibration capture on the session thread and polls it for progress and the result"""
+
+    CAPTURE_POLL_PERIOD_MS = 50
+
+    def __init__(self, master, session: fluxpad_interface.FluxpadSession,
+                 store: Optional[calibration_store.CalibrationStore] = None, *args, **kwargs):
+        super().__init__(master, *args, **kwargs)
+        assert isinstance(session, fluxpad_interface.FluxpadSession)
+
+        self.session = session
+        self.store = store
+        self.fluxpad = session.fluxpad
+
+        self.cancel_event = threading.Event()
+        self.capture_future: Optional[concurrent.futures.Future] = None
+        self.poll_id = None
+
+    def on_cancel(self):
+        logging.info("Canceled Calibration")
+        self.cancel_event.set()
+        if self.poll_id is not None:
+            self.after_cancel(self.poll_id)
+        self.destroy()
+
+    def start_capture(self, capture: Callable, *args):
+        """Run capture(fluxpad, *args, on_progress, cancel) on the session thread and start polling it"""
+        self.capture_future = self.session.submit(
+            capture, self.fluxpad, *args, on_progress=self._on_capture_progress, cancel=self.cancel_event)
+        self.poll_id = self.after(self.CAPTURE_POLL_PERIOD_MS, self._poll_capture)
+
+    @abc.abstractmethod
+    def _on_capture_progress(self, progress):
+        """Runs on the session thread, only hand over the progress, the UI picks it up in show_progress"""
+
+    @abc.abstractmethod
+    def show_progress(self):
+        """Update the window with the progress handed over so far"""
+
+    @abc.abstractmethod
+    def finish_calibration(self, result):
+        """Validate the capture result and write the calibration"""
+
+    def _poll_capture(self):
+        self.show_progress()
+        if not self.capture_future.done():
+            self.poll_id = self.after(self.CAPTURE_POLL_PERIOD_MS, self._poll_capture)
+            return
+        self.poll_id = None
+
+        try:
+            result = self.capture_future.result()
+        except Exception:
+            logging.error("Error gathering data during calibration", exc_info=True)
+            messagebox.showerror("Calibration Error", f"Exception {traceback.format_exc()}")
+            self.destroy()
+            return
+        self.finish_calibration(result)
 
-    DOWN_MAX_STD_DEV = 50
-    DOWN_MAX_ADC = 1300
-    DOWN_MIN_ADC = 0
+
+class CalibrationTopLevel(CalibrationCaptureTopLevel):
+    """Top Level window that holds the calibration routine"""
+
+    # Calibration settings and validation constants
+    NUMBER_OF_SAMPLES = 400
 
     INSTRUCTION_WIDTH = 500
     INSTRUCTION_HEIGHT = 240
 
-    def __init__(self, master, is_up: int, fluxpad: fluxpad_interface.Fluxpad, key_id: int, *args, **kwargs):
-        super().__init__(master, *args, **kwargs)
+    def __init__(self, master, is_up: int, session: fluxpad_interface.FluxpadSession, key_id: int,
+                 store: Optional[calibration_store.CalibrationStore] = None, *args, **kwargs):
+        super().__init__(master, session, store, *args, **kwargs)
         assert isinstance(is_up, int)
         assert isinstance(key_id, int)
-        assert isinstance(fluxpad, fluxpad_interface.Fluxpad)
 
         self.is_up = is_up
         self.key_id = key_id
-        self.fluxpad = fluxpad
         if self.is_up: 
             self.title("Calibrate Up Positon")
         else:
@@ -1175,72 +1246,36 @@ class CalibrationTopLevel(tk.Toplevel):
         self.btn_calibrate = ttk.Button(self, text="Calibrate", command=self.on_calibrate)
         self.btn_calibrate.grid(row=3, column=2, sticky="EW", padx=PADDING, pady=PADDING)
 
-        # Checks
-        assert not self.fluxpad.port.is_open, "Port is still open!"
+        self.samples_captured = 0
+
         self.grab_set()
         self.update()
         self.update_idletasks()
 
-    def on_cancel(self):
-        logging.info("Canceled Calibration")
-        self.destroy()
-    
     def on_calibrate(self):
-        """Callback that runs when calibrate button is pressed"""
-        self.btn_cancel.state(["disabled"])
-        self.update()
-        self.update_idletasks()
-        pb_step_size = 100/self.NUMBER_OF_SAMPLES
-        message = fluxpad_interface.AnalogReadMessage()
-        message.raw_adc = 0
-        message.key_id = self.key_id
-
-        # Collect raw adc samples
-        read_adc_queue = deque()
-        try:
-            with self.fluxpad.port:
-                for i in range(self.NUMBER_OF_SAMPLES):
-                    response = self.fluxpad.send_read_request(message)
-                    read_adc_queue.append(response.raw_adc)
-                    self.pb.step(pb_step_size)
-                    time.sleep(self.SAMPLE_PERIOD_S)
-                    self.update()
-
-        except Exception:
-            logging.error("Error gathering data during calibration", exc_info=True)
-            messagebox.showerror("Calibration Error", f"Exception {traceback.format_exc()}")
-            self.destroy()
-            return
+        """Callback that runs when calibrate button is pressed, starts capturing samples on the session thread"""
+        self.btn_calibrate.state(["disabled"])
+        self.pb.configure(mode="determinate", value=0)
+        self.samples_captured = 0
+        self.start_capture(calibration.capture_raw_adc, self.key_id, self.NUMBER_OF_SAMPLES)
 
-        # Prepare calibration validation
-        if self.is_up:
-            max_std_dev = self.UP_MAX_STD_DEV
-            max_adc = self.UP_MAX_ADC
-            min_adc = self.UP_MIN_ADC
+    def _on_capture_progress(self, samples_captured: int):
+        self.samples_captured = samples_captured
 
-        else:
-            max_std_dev = self.DOWN_MAX_STD_DEV
-            max_adc = self.DOWN_MAX_ADC
-            min_adc = self.DOWN_MIN_ADC
+    def show_progress(self):
+        self.pb.configure(value=100 * self.samples_captured / self.NUMBER_OF_SAMPLES)
 
+    def finish_calibration(self, samples: List[float]):
+        """Validate the captured samples and write the calibration"""
         # Run calibration validation
-        std_dev = statistics.pstdev(read_adc_queue)
-        mean = statistics.mean(read_adc_queue)
-        logging.info(f"Std dev: {std_dev}, Mean: {mean}")
-        error_str = None
-        if std_dev > max_std_dev:
-            error_str = f"Std Deviation is too high: {std_dev} > {max_std_dev}"
-            logging.error(error_str)
-
-        if mean > max_adc:
-            error_str = f"Reading is too high: {mean:.0f} > {max_adc}, is the key fully released?"
-            logging.error(error_str)
-        
-        if mean < min_adc:
-            error_str = f"Reading is too low: {mean:.0f} < {min_adc}, is the key fully depressed?"
-            logging.error(error_str)
-                    
+        stats = calibration.robust_statistics(samples)
+        std_dev = stats.standard_deviation
+        mean = stats.mean
+        logging.info(f"Std dev: {std_dev}, Mean: {mean}, Median: {stats.median}, MAD: {stats.mad}, "
+                     f"Rejected {stats.rejected_count}/{stats.sample_count}")
+        error_str = calibration.check_statistics(stats, self.is_up)
         if error_str is not None:
+            logging.error(error_str)
             messagebox.showerror("Calibration Error", f"Failed to calibrate:\n{error_str}")
             self.destroy()
             return
@@ -1255,27 +1290,138 @@ class CalibrationTopLevel(tk.Toplevel):
 
         # Send calibration message
         try:
-            with self.fluxpad.port:
-                self.fluxpad.send_write_request(calibrate_message)
-                calibrate_echo = self.fluxpad.send_read_request(calibrate_message)
-                if self.is_up:
-                    assert math.isclose(mean, calibrate_echo.calibration_up, rel_tol=1e-4), f"{mean} not equal to {calibrate_echo.calibration_up}"
-                else:
-                    assert math.isclose(mean, calibrate_echo.calibration_down, rel_tol=1e-4), f"{mean} not equal to {calibrate_echo.calibration_down}"
+            self.session.run(self.fluxpad.send_write_request, calibrate_message)
+            calibrate_echo = self.session.run(self.fluxpad.send_read_request, calibrate_message)
+            if self.is_up:
+                assert math.isclose(mean, calibrate_echo.calibration_up, rel_tol=1e-4), f"{mean} not equal to {calibrate_echo.calibration_up}"
+            else:
+                assert math.isclose(mean, calibrate_echo.calibration_down, rel_tol=1e-4), f"{mean} not equal to {calibrate_echo.calibration_down}"
         except Exception:
             messagebox.showerror("Calibration Error", f"Exception {traceback.format_exc()}")
             self.destroy()
             return
         
 
+        record_calibration(self.store, self.fluxpad, self.key_id, self.is_up, stats)
         messagebox.showinfo("Calibration Complete", f"Analog Key {self.key_id-1} {'up' if self.is_up else 'down'} position calibrated to\n{mean:.0f} ADC counts")
         self.destroy()
 
 
+class BatchCalibrationTopLevel(CalibrationCaptureTopLevel):
+    """Top Level window that calibrates the up and down positions of every analog key from one capture"""
+
+    CAPTURE_POLL_PERIOD_MS = 100
+    INSTRUCTIONS = ("Press each analog key all the way down, hold it for a moment and release it.\n"
+                    "Keys can be pressed in any order, calibration finishes once every key has been pressed.")
+
+    def __init__(self, master, session: fluxpad_interface.FluxpadSession,
+                 store: Optional[calibration_store.CalibrationStore] = None, *args, **kwargs):
+        super().__init__(master, session, store, *args, **kwargs)
+
+        self.key_ids = fluxpad_interface.Fluxpad.ANALOG_KEY_IDS
+        self.title("Calibrate All Keys")
+
+        self.columnconfigure(1, weight=1)
+        self.columnconfigure(2, weight=1)
+
+        self.instructions = ttk.Label(self, text=self.INSTRUCTIONS, wraplength=400)
+        self.instructions.grid(row=1, column=1, columnspan=2, sticky="EW", padx=PADDING, pady=PADDING)
+
+        # Progress of every key
+        self.key_status_labels = {}
+        for row, key_id in enumerate(self.key_ids, start=2):
+            ttk.Label(self, text=f"Analog Key {key_id-1}").grid(row=row, column=1, sticky="W", padx=PADDING, pady=PADDING)
+            self.key_status_labels[key_id] = ttk.Label(self, text="Waiting")
+            self.key_status_labels[key_id].grid(row=row, column=2, sticky="W", padx=PADDING, pady=PADDING)
+
+        # Progress bar counts down the capture timeout
+        row = 2 + len(self.key_ids)
+        self.pb = ttk.Progressbar(self, maximum=100, length=200, orient='horizontal', mode='determinate')
+        self.pb.grid(row=row, column=1, columnspan=2, sticky="EW", padx=PADDING, pady=PADDING)
+
+        self.btn_cancel = ttk.Button(self, text="Cancel", command=self.on_cancel)
+        self.btn_cancel.grid(row=row+1, column=1, sticky="EW", padx=PADDING, pady=PADDING)
+        self.btn_calibrate = ttk.Button(self, text="Start", command=self.on_calibrate)
+        self.btn_calibrate.grid(row=row+1, column=2, sticky="EW", padx=PADDING, pady=PADDING)
+
+        self.plateaus = {}
+        self.start_time = 0.0
+
+        self.grab_set()
+        self.update()
+        self.update_idletasks()
+
+    def on_calibrate(self):
+        """Callback that runs when start button is pressed, starts capturing samples on the session thread"""
+        self.btn_calibrate.state(["disabled"])
+        self.start_time = time.monotonic()
+        self.start_capture(calibration.capture_all_keys, self.key_ids)
+
+    def _on_capture_progress(self, plateaus):
+        self.plateaus = plateaus
+
+    def show_progress(self):
+        self.pb.configure(value=min(100, 100 * (time.monotonic() - self.start_time) / calibration.BATCH_TIMEOUT_S))
+        for key_id, key_plateaus in self.plateaus.items():
+            if key_plateaus.is_complete:
+                status = "Done"
+            elif key_plateaus.down is not None:
+                status = "Bottom out found, release the key"
+            elif key_plateaus.up is not None:
+                status = "Released position found, press the key all the way down"
+            else:
+                status = "Waiting"
+            self.key_status_labels[key_id].configure(text=status)
+
+    def finish_calibration(self, plateaus):
+        """Validate the plateaus of every key and write all calibrations, or none if any key failed"""
+        errors = []
+        calibrations = {}
+        for key_id, key_plateaus in plateaus.items():
+            key_errors = []
+            for is_up, stats in ((True, key_plateaus.up), (False, key_plateaus.down)):
+                if stats is None:
+                    key_errors.append(f"{'Released' if is_up else 'Bottom out'} position not found")
+                    continue
+                logging.info(f"Key {key_id} {'up' if is_up else 'down'} std dev: {stats.standard_deviation}, Mean: {stats.mean}, "
+                             f"Rejected {stats.rejected_count}/{stats.sample_count}")
+                error_str = calibration.check_statistics(stats, is_up)
+                if error_str is not None:
+                    key_errors.append(error_str)
+            if key_errors:
+                errors.extend(f"Analog Key {key_id-1}: {error_str}" for error_str in key_errors)
+            else:
+                calibrations[key_id] = (key_plateaus.down.mean, key_plateaus.up.mean)
+
+        if errors:
+            error_str = "\n".join(errors)
+            logging.error(error_str)
+            messagebox.showerror("Calibration Error", f"Failed to calibrate:\n{error_str}")
+            self.destroy()
+            return
+
+        try:
+            self.session.run(calibration.write_calibrations, self.fluxpad, calibrations)
+        except Exception:
+            messagebox.showerror("Calibration Error", f"Exception {traceback.format_exc()}")
+            self.destroy()
+            return
+
+        for key_id in calibrations:
+            record_calibration(self.store, self.fluxpad, key_id, True, plateaus[key_id].up)
+            record_calibration(self.store, self.fluxpad, key_id, False, plateaus[key_id].down)
+        summary = "\n".join(f"Analog Key {key_id-1}: up {up:.0f}, down {down:.0f} ADC counts" for key_id, (down, up) in calibrations.items())
+        messagebox.showinfo("Calibration Complete", f"All analog keys calibrated\n\n{summary}")
+        self.destroy()
+
+
 class Application(ttk.Frame):
     """Top Level application frame"""
 
     CALIBRATION_MODE_UPDATE_PERIOD_S = 0.05
+    REST_SAMPLE_PERIOD_S = 15 * 60
+    SETTINGS_REFRESH_POLL_PERIOD_MS = 100
+    MAX_SHOWN_FILE_ERRORS = 10
 
     def __init__(self, master=None):
         super().__init__(master=master)
@@ -1322,6 +1468,11 @@ class Application(ttk.Frame):
         self.save_menu.add_command(label="Save to File", command=self.on_save_to_file)
         self.save_menu.add_command(label="Save to FLUXPAD", command=self.on_save_to_fluxpad)
 
+        # Profiles menu, rebuilt from the library every time it opens
+        self.profile_menu = tk.Menu(self.menubar, tearoff=0, postcommand=self._build_profile_menu)
+        self.menubar.add_cascade(label="Profiles", menu=self.profile_menu)
+        self.delete_profile_menu = tk.Menu(self.profile_menu, tearoff=0)
+
         # Wire calibration button to callback
         self.frame_utilities.calibration_labelframe.analog_cal_frame_list[0].btn_set_up.configure(command=lambda: self.on_calibrate_button(is_up=True, key_id=2))
         self.frame_utilities.calibration_labelframe.analog_cal_frame_list[0].btn_set_down.configure(command=lambda: self.on_calibrate_button(is_up=False, key_id=2))
@@ -1332,6 +1483,8 @@ class Application(ttk.Frame):
         self.frame_utilities.calibration_labelframe.analog_cal_frame_list[2].btn_set_up.configure(command=lambda: self.on_calibrate_button(is_up=True, key_id=4))
         self.frame_utilities.calibration_labelframe.analog_cal_frame_list[2].btn_set_down.configure(command=lambda: self.on_calibrate_button(is_up=False, key_id=4))
 
+        self.frame_utilities.calibration_labelframe.btn_calibrate_all.configure(command=self.on_calibrate_all_button)
+
         # Wire calibration listener callback
         self.frame_utilities.firmware_update_frame.set_stop_listener_callback(self.on_fw_upload_button)
 
@@ -1339,26 +1492,57 @@ class Application(ttk.Frame):
         self.master.configure(menu=self.menubar)
 
         # Default GUI state to fluxpad disconnected
+        self.session: Optional[fluxpad_interface.FluxpadSession] = None
         self.on_disconnected()
 
+        # Calibration history, the app works without it
+        self.calibration_store: Optional[calibration_store.CalibrationStore] = None
+        try:
+            self.calibration_store = calibration_store.CalibrationStore()
+        except Exception:
+            logging.error("Failed to open calibration history", exc_info=True)
+        self.next_rest_sample_time = 0.0
+
+        # Settings last read from every fluxpad, shown on connect while they are checked against the fluxpad
+        self.settings_cache: Optional[settings_cache.SettingsCache] = None
+        try:
+            self.settings_cache = settings_cache.SettingsCache()
+        except Exception:
+            logging.error("Failed to open settings cache", exc_info=True)
+        self.settings_refresh_future: Optional[concurrent.futures.Future] = None
+        self.shown_cached_settings: Optional[dict] = None  # What the GUI showed from the cache, to tell if it was edited since
+
+        self.profile_library: Optional[profile_library.ProfileLibrary] = None
+        try:
+            self.profile_library = profile_library.ProfileLibrary()
+        except Exception:
+            logging.error("Failed to open profile library", exc_info=True)
+
         # Setup Fluxpad interface and connection listener
         self.fluxpad_settings = fluxpad_interface.FluxpadSettings()
         self._save_to_settings()
         self.fluxpad: Optional[fluxpad_interface.Fluxpad] = None
+        self.on_calibration_tab = False
         self.listener = fluxpad_interface.FluxpadListener(self.on_connected, self.on_disconnected)
         self.listener.start()
 
         self.calibration_worker_thread = threading.Thread(target=self._calibration_worker, daemon=True)
         self.calibration_worker_thread.start()
-        self.worker_busy = True
 
     def on_connected(self, fluxpad: fluxpad_interface.Fluxpad):
         logging.info(f"Fluxpad Connected on port {fluxpad.port.name}")
         self.fluxpad = fluxpad
+        self.session = fluxpad_interface.FluxpadSession(fluxpad)
+        self.session.start()
+        self.next_rest_sample_time = time.monotonic()
+        self.fluxpad_settings.invalidate_device_state()
         self._on_connected_gui()
 
     def on_disconnected(self):
         logging.info("Fluxpad Disconnected")
+        if self.session is not None:
+            self.session.stop()
+        self.session = None
         self.fluxpad = None
         self._on_disconnected_gui()
     
@@ -1366,7 +1550,8 @@ class Application(ttk.Frame):
         self.btn_upload.state(["!disabled"])
         self.save_menu.entryconfigure(1, state=tk.NORMAL)
         self.load_menu.entryconfigure(1, state=tk.NORMAL)
-        self.ask_load_from_fluxpad()
+        if not self.show_cached_settings():
+            self.ask_load_from_fluxpad()
 
         # Wire firmware update button to callback
         self.frame_utilities.firmware_update_frame.enable_update()
@@ -1379,51 +1564,114 @@ class Application(ttk.Frame):
         self.frame_utilities.firmware_update_frame.disable_update()
         self.frame_utilities.firmware_update_frame.set_fluxpad(None)
 
+    def _running_session(self) -> fluxpad_interface.FluxpadSession:
+        """Session for the connected fluxpad, restarted if it was handed over to the firmware updater"""
+        assert self.session is not None, "Fluxpad not connected"
+        self.session.start()
+        return self.session
+
     def ask_load_from_fluxpad(self):
         should_load = messagebox.askyesno("Fluxpad Connected", "Load settings from connected FLUXPAD?")
         if should_load:
             self.on_load_from_fluxpad()
 
+    def show_cached_settings(self) -> bool:
+        """Show the cached settings of the connected fluxpad right away and check them in the background.
+        Returns False if there are none"""
+        if self.settings_cache is None or self.fluxpad.serial_number is None:
+            return False
+        cached = self.settings_cache.load(self.fluxpad.serial_number)
+        if cached is None:
+            return False
+        logging.info(f"Showing settings of {cached.serial_number} cached {time.ctime(cached.time)}")
+        self.fluxpad_settings = cached.to_fluxpad_settings()
+        self._fix_adc_samples()
+        self._update_from_settings()
+        self.shown_cached_settings = self._gui_settings_dict()
+
+        self.settings_refresh_future = self._running_session().submit(settings_cache.load_current_settings, self.fluxpad, self.settings_cache)
+        self.after(self.SETTINGS_REFRESH_POLL_PERIOD_MS, self._poll_settings_refresh, self.settings_refresh_future)
+        return True
+
+    def _poll_settings_refresh(self, future: concurrent.futures.Future):
+        if future is not self.settings_refresh_future:
+            return  # Reconnected since
+        if not future.done():
+            self.after(self.SETTINGS_REFRESH_POLL_PERIOD_MS, self._poll_settings_refresh, future)
+            return
+        self.settings_refresh_future = None
+        try:
+            settings, from_cache = future.result()
+        except Exception:
+            logging.error("Failed to check cached settings against FLUXPAD", exc_info=True)
+            return
+        if self.session is None:
+            return
+        if from_cache:
+            # Same settings, now known to be what the fluxpad has. Edits made meanwhile stay in the GUI
+            self.fluxpad_settings = settings
+            self._fix_adc_samples()
+            return
+
+        # Changed on the fluxpad since they were cached, only replace what is shown if it hasn't been edited
+        logging.info("Settings changed since they were cached")
+        if self._gui_settings_dict() != self.shown_cached_settings:
+            should_load = messagebox.askyesno("Settings Changed on FLUXPAD",
+                                              "The settings on the FLUXPAD changed since it was last connected.\n"
+                                              "Load them and discard the changes made here?")
+            if not should_load:
+                # Keep the edits, against what the fluxpad really has so saving writes the right differences
+                self.fluxpad_settings = settings
+                self._fix_adc_samples()
+                self._save_to_settings()
+                return
+        self.fluxpad_settings = settings
+        self._fix_adc_samples()
+        self._update_from_settings()
+
+    def _update_settings_cache(self):
+        """Keep the settings cache in step with what was just read from or written to the fluxpad"""
+        if self.settings_cache is None or self.fluxpad is None:
+            return
+        try:
+            self._running_session().run(settings_cache.update_cache, self.fluxpad, self.settings_cache, self.fluxpad_settings)
+        except Exception:
+            logging.error("Failed to update settings cache", exc_info=True)
+
     def _calibration_worker(self):
         while True:
 
-            # Wait for fluxpad connection and calibration tap open
-            if self.fluxpad is not None and self.on_calibration_tab:
-                while True:
-                    
-                    if self.fluxpad is None or not self.on_calibration_tab:
-                        logging.info("Stopping")
-                        try:
-                            if self.fluxpad is not None and self.fluxpad.port.is_open:
-                                self.fluxpad.port.close()
-                        except fluxpad_interface.serial.SerialException:
-                            logging.info(f"Serial exception {self.fluxpad.port.name}")
-                        else:
-                            logging.info(f"Closed port")
-                        break
-
-                    self.worker_busy = True
-                    try:
-                        if not self.fluxpad.port.is_open:
-                            self.fluxpad.port.open()
-                            logging.info(f"Opened port {self.fluxpad.port.name}")
-                        selected_analog_key = self.frame_utilities.calibration_labelframe.current_selected_analog_key
-                        message = fluxpad_interface.AnalogReadMessage()
-                        message.height_mm = 0
-                        message.key_id = selected_analog_key + 2  # convert from analog key name (ie analog key 1 or 2) to key id
-                        response = self.fluxpad.send_read_request(message)
-                        if self.on_calibration_tab:  # only do tkinter update if we're still on calibrate window, otherwise risk race condition
-                            self.frame_utilities.calibration_labelframe.analog_cal_frame_list[selected_analog_key].update_height(response.height_mm - 2)
-                    except fluxpad_interface.serial.SerialException:
-                        logging.info(f"Serial exception {self.fluxpad.port.name}")
-                        self.on_calibration_tab = False
-                        break
-                    except Exception:
-                        logging.error("Exception at calibration worker", exc_info=1)
-                    finally:
-                        self.worker_busy = False
-                    time.sleep(self.CALIBRATION_MODE_UPDATE_PERIOD_S)
-                
+            # Poll the selected key height while the calibration tab is open
+            session = self.session
+            if session is not None and session.is_running and self.on_calibration_tab:
+                try:
+                    selected_analog_key = self.frame_utilities.calibration_labelframe.current_selected_analog_key
+                    message = fluxpad_interface.AnalogReadMessage()
+                    message.height_mm = 0
+                    message.key_id = selected_analog_key + 2  # convert from analog key name (ie analog key 1 or 2) to key id
+                    response = session.run(session.fluxpad.send_read_request, message)
+                    if self.on_calibration_tab:  # only do tkinter update if we're still on calibrate window, otherwise risk race condition
+                        self.frame_utilities.calibration_labelframe.analog_cal_frame_list[selected_analog_key].update_height(response.height_mm - fixed_point.REFERENCE_DOWN_MM)
+                except (ConnectionError, fluxpad_interface.serial.SerialException):
+                    logging.info(f"Serial exception {session.fluxpad.port.name}")
+                    self.on_calibration_tab = False
+                except Exception:
+                    logging.error("Exception at calibration worker", exc_info=1)
+
+            elif (session is not None and session.is_running and self.calibration_store is not None
+                    and session.fluxpad.serial_number is not None and time.monotonic() >= self.next_rest_sample_time):
+                # Sample the rest position of the keys every so often to track drift
+                self.next_rest_sample_time = time.monotonic() + self.REST_SAMPLE_PERIOD_S
+                try:
+                    session.run(calibration_store.sample_rest_positions, session.fluxpad, self.calibration_store)
+                    for key_id in fluxpad_interface.Fluxpad.ANALOG_KEY_IDS:
+                        drift = self.calibration_store.drift(session.fluxpad.serial_number, key_id)
+                        if drift is not None and abs(drift.drift_adc) > calibration_store.DEFAULT_DRIFT_THRESHOLD_ADC:
+                            logging.warning(f"Analog Key {key_id-1} needs calibrating: {calibration_store.format_drift(drift)}")
+                except (ConnectionError, fluxpad_interface.serial.SerialException):
+                    logging.info(f"Serial exception {session.fluxpad.port.name}")
+                except Exception:
+                    logging.error("Exception sampling rest positions", exc_info=1)
 
             time.sleep(self.CALIBRATION_MODE_UPDATE_PERIOD_S)
 
@@ -1431,23 +1679,30 @@ class Application(ttk.Frame):
         logging.info("Calibration button clicked")
         assert 2 <= key_id <=4, "Invalid key id"
         self.on_calibration_tab = False
-        while self.fluxpad.port.is_open or self.worker_busy:
-            self.on_calibration_tab = False
-            logging.debug(f"Waiting for port to close, isopen {self.fluxpad.port.is_open}, busy {self.worker_busy}")
-            time.sleep(0.1)
-        newWindow = CalibrationTopLevel(self, is_up, self.fluxpad, key_id)
+        newWindow = CalibrationTopLevel(self, is_up, self._running_session(), key_id, self.calibration_store)
         newWindow.wait_window()
         self.grab_set()
         logging.info("Calibration complete")
+        self._update_settings_cache()
+        self.on_notebook_tab_changed(tk.Event())
+        self.update()
+
+    def on_calibrate_all_button(self):
+        logging.info("Calibrate all keys button clicked")
+        self.on_calibration_tab = False
+        newWindow = BatchCalibrationTopLevel(self, self._running_session(), self.calibration_store)
+        newWindow.wait_window()
+        self.grab_set()
+        logging.info("Calibration complete")
+        self._update_settings_cache()
         self.on_notebook_tab_changed(tk.Event())
         self.update()
 
     def on_fw_upload_button(self):
+        """Hand the port over to the firmware updater"""
         self.on_calibration_tab = False
-        while self.fluxpad.port.is_open or self.worker_busy:
-            self.on_calibration_tab = False
-            logging.debug(f"Waiting for port to close, isopen {self.fluxpad.port.is_open}, busy {self.worker_busy}")
-            time.sleep(0.1)
+        if self.session is not None:
+            self.session.stop()
 
     def on_notebook_tab_changed(self, event: tk.Event):
         """"Turn on and off keyboard listener and calibration worker based on which tab is active"""
@@ -1469,12 +1724,20 @@ class Application(ttk.Frame):
         self.frame_lighting.load_from_fluxpad_settings(self.fluxpad_settings)
         self.frame_rgb.load_from_fluxpad_settings(self.fluxpad_settings)
 
-    def _save_to_settings(self):
-        """Take all settings currently set in the GUI and load them to the self.fluxpad_settings object"""
-        self.frame_keymap.save_to_settings(self.fluxpad_settings)
-        self.frame_settings.save_to_fluxpad_settings(self.fluxpad_settings)
-        self.frame_lighting.save_to_fluxpad_settings(self.fluxpad_settings)
-        self.frame_rgb.save_to_fluxpad_settings(self.fluxpad_settings)
+    def _save_to_settings(self, fluxpad_settings: Optional[fluxpad_interface.FluxpadSettings] = None):
+        """Take all settings currently set in the GUI and load them to the given settings, self.fluxpad_settings by default"""
+        if fluxpad_settings is None:
+            fluxpad_settings = self.fluxpad_settings
+        self.frame_keymap.save_to_settings(fluxpad_settings)
+        self.frame_settings.save_to_fluxpad_settings(fluxpad_settings)
+        self.frame_lighting.save_to_fluxpad_settings(fluxpad_settings)
+        self.frame_rgb.save_to_fluxpad_settings(fluxpad_settings)
+
+    def _gui_settings_dict(self) -> dict:
+        """Settings as currently set in the GUI, leaves self.fluxpad_settings as it is"""
+        gui_settings = copy.deepcopy(self.fluxpad_settings)
+        self._save_to_settings(gui_settings)
+        return gui_settings.to_dict()
 
 
     def _fix_adc_samples(self):
@@ -1495,6 +1758,11 @@ class Application(ttk.Frame):
             self.fluxpad_settings.load_from_file(pathlib.Path(load_file))
             self._fix_adc_samples()
             self._update_from_settings()
+        except settings_schema.SettingsFileError as e:
+            logging.error(str(e))
+            shown_errors = "\n".join(e.errors[:self.MAX_SHOWN_FILE_ERRORS])
+            more = len(e.errors) - self.MAX_SHOWN_FILE_ERRORS
+            messagebox.showerror("Invalid settings file", f"{load_file} was not loaded:\n{shown_errors}" + (f"\nand {more} more" if more > 0 else ""))
         except Exception:
             logging.error("Exception occoured while loading from fluxpad", exc_info=True)
             messagebox.showerror("Error Loading from fluxpad", f"Exception:\n{traceback.format_exc()}")
@@ -1503,8 +1771,9 @@ class Application(ttk.Frame):
 
     def on_load_from_fluxpad(self):
         try:
-            with self.fluxpad.port:
-                self.fluxpad_settings.load_from_keypad(self.fluxpad)
+            self.settings_refresh_future = None
+            self._running_session().run(self.fluxpad_settings.load_from_keypad, self.fluxpad)
+            self._update_settings_cache()
             self._fix_adc_samples()
             self._update_from_settings()
         except Exception:
@@ -1531,11 +1800,63 @@ class Application(ttk.Frame):
         else:
             messagebox.showinfo("Saved settings", f"Saved settings to {save_file}")
 
+    def _build_profile_menu(self):
+        self.profile_menu.delete(0, tk.END)
+        self.delete_profile_menu.delete(0, tk.END)
+        if self.profile_library is None:
+            self.profile_menu.add_command(label="Profile library unavailable", state=tk.DISABLED)
+            return
+        self.profile_menu.add_command(label="Save as Profile...", command=self.on_save_profile)
+        self.profile_menu.add_separator()
+        names = self.profile_library.names()
+        for name in names:
+            self.profile_menu.add_command(label=name, command=lambda name=name: self.on_switch_profile(name))
+            self.delete_profile_menu.add_command(label=name, command=lambda name=name: self.on_delete_profile(name))
+        if not names:
+            self.profile_menu.add_command(label="No profiles", state=tk.DISABLED)
+        self.profile_menu.add_separator()
+        self.profile_menu.add_cascade(label="Delete Profile", menu=self.delete_profile_menu, state=tk.NORMAL if names else tk.DISABLED)
+
+    def on_save_profile(self):
+        name = simpledialog.askstring("Save Profile", "Profile name:", parent=self)
+        if not name:
+            logging.info("Canceled save profile")
+            return
+        if name in self.profile_library.names() and not messagebox.askyesno("Save Profile", f"Replace profile {name}?"):
+            return
+        try:
+            self._save_to_settings()
+            self.profile_library.save(name, self.fluxpad_settings)
+        except Exception:
+            logging.error("Exception occoured while saving profile", exc_info=True)
+            messagebox.showerror("Error Saving Profile", f"Exception:\n{traceback.format_exc()}")
+        else:
+            logging.info(f"Saved profile {name}")
+
+    def on_switch_profile(self, name: str):
+        """Show a profile and write whatever differs from it to the connected fluxpad"""
+        try:
+            if self.session is None:
+                self.profile_library.load_into(name, self.fluxpad_settings)
+            else:
+                self.settings_refresh_future = None
+                self._running_session().run(profile_library.switch_profile, self.fluxpad, self.profile_library, name, self.fluxpad_settings)
+                self._update_settings_cache()
+            self._update_from_settings()
+        except Exception:
+            logging.error(f"Exception occoured while switching to profile {name}", exc_info=True)
+            messagebox.showerror("Error Switching Profile", f"Exception:\n{traceback.format_exc()}")
+
+    def on_delete_profile(self, name: str):
+        if messagebox.askyesno("Delete Profile", f"Delete profile {name}?"):
+            self.profile_library.delete(name)
+
     def on_save_to_fluxpad(self):
         try:
+            self.settings_refresh_future = None  # What the fluxpad has is about to be known anyway
             self._save_to_settings()
-            with self.fluxpad.port:
-                self.fluxpad_settings.save_to_fluxpad(self.fluxpad)
+            self._running_session().run(self.fluxpad_settings.save_to_fluxpad, self.fluxpad)
+            self._update_settings_cache()
         except Exception:
             logging.error("Exception occoured while saving to FLUXPAD", exc_info=True)
             messagebox.showerror("Error Saving to FLUXPAD", f"Exception:\n{traceback.format_exc()}")
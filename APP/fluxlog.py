@@ -0,0 +1,321 @@
+"""Recording format for long captures of analog key telemetry.
+
+A .fluxlog file is a fixed size header, then fixed width records written a chunk at a time,
+then an index with the first timestamps of every chunk:
+
+    header | chunk 0 records | chunk 1 records | ... | chunk index | trailer
+
+The records are one contiguous array, so the reader maps the file and hands out NumPy views
+without parsing anything. The index is only written on close, if it's missing (crash, power
+loss) the reader rebuilds it from the records it can trust.
+
+usage: python fluxlog.py record out.fluxlog [--seconds S] [--rate HZ]
+       python fluxlog.py info in.fluxlog
+"""
+import argparse
+import mmap
+import pathlib
+import struct
+import sys
+import time
+from typing import BinaryIO, Iterable, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+
+from fluxpad_interface import AnalogReadMessage, DatastreamSample, Fluxpad, find_fluxpad_ports
+
+MAGIC = b"FLUXLOG\x00"
+VERSION = 1
+MAX_CHANNELS = 16
+
+# magic, version, channels, record size, chunk records, start unix time, key ids
+HEADER_FORMAT = struct.Struct(f"<8sHHIId{MAX_CHANNELS}s")
+HEADER_SIZE = 64
+
+INDEX_ENTRY_DTYPE = np.dtype([("first_record", "<u8"), ("host_time_s", "<f8"), ("device_time_us", "<i8")])
+
+# index offset, chunk count, record count, magic
+TRAILER_FORMAT = struct.Struct("<QIQ8s")
+TRAILER_MAGIC = b"FLUXIDX\x00"
+
+DEFAULT_CHUNK_RECORDS = 4096
+NO_DEVICE_TIME = -1
+
+PathLike = Union[str, pathlib.Path]
+
+
+def record_dtype(channels: int) -> np.dtype:
+    """Layout of a single record for the given number of analog keys"""
+    return np.dtype([
+        ("host_time_s", "<f8"),
+        ("device_time_us", "<i8"),
+        ("raw_adc", "<f4", (channels,)),
+        ("height_mm", "<f4", (channels,)),
+        ("pressed", "u1", (channels,)),
+    ])
+
+
+class FluxlogRecorder:
+    """Appends telemetry samples to a new .fluxlog file"""
+
+    def __init__(self, path: PathLike, key_ids: Sequence[int] = Fluxpad.ANALOG_KEY_IDS, chunk_records: int = DEFAULT_CHUNK_RECORDS) -> None:
+        assert 0 < len(key_ids) <= MAX_CHANNELS
+        assert chunk_records > 0
+        self.path = pathlib.Path(path)
+        self.key_ids = tuple(key_ids)
+        self.chunk_records = chunk_records
+        self.dtype = record_dtype(len(self.key_ids))
+
+        self._file: Optional[BinaryIO] = open(self.path, "wb")
+        self._file.write(HEADER_FORMAT.pack(
+            MAGIC, VERSION, len(self.key_ids), self.dtype.itemsize, chunk_records, time.time(), bytes(self.key_ids)
+        ).ljust(HEADER_SIZE, b"\x00"))
+
+        self._chunk = np.zeros(chunk_records, dtype=self.dtype)
+        self._chunk_count = 0  # Records waiting in _chunk
+        self._index: List[Tuple[int, float, int]] = []
+        self.record_count = 0  # Records written to the file
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return self.record_count + self._chunk_count
+
+    def append(self, host_time_s: float, device_time_us: int, raw_adc: Sequence[float], height_mm: Sequence[float], pressed: Sequence[bool]):
+        record = self._chunk[self._chunk_count]
+        record["host_time_s"] = host_time_s
+        record["device_time_us"] = device_time_us
+        record["raw_adc"] = raw_adc
+        record["height_mm"] = height_mm
+        record["pressed"] = pressed
+        self._chunk_count += 1
+        if self._chunk_count == self.chunk_records:
+            self._write_chunk()
+
+    def append_sample(self, sample: DatastreamSample):
+        """Record a sample from Fluxpad.stream(), its keys must be the recorder's keys"""
+        assert sample.key_ids == self.key_ids, f"Sample keys {sample.key_ids} don't match recorder keys {self.key_ids}"
+        self.append(sample.host_time_s, sample.device_time_us, sample.raw_adc, sample.height_mm, sample.pressed)
+
+    def append_analog_read(self, message: AnalogReadMessage, host_time_s: Optional[float] = None):
+        """Record a polled analog read response, the other keys are recorded as NaN"""
+        channels = len(self.key_ids)
+        channel = self.key_ids.index(message.key_id)
+        raw_adc = [np.nan] * channels
+        height_mm = [np.nan] * channels
+        raw_adc[channel] = message.raw_adc
+        height_mm[channel] = message.height_mm
+        self.append(time.monotonic() if host_time_s is None else host_time_s, NO_DEVICE_TIME, raw_adc, height_mm, [False] * channels)
+
+    def extend(self, samples: Iterable[DatastreamSample]):
+        for sample in samples:
+            self.append_sample(sample)
+
+    def flush(self):
+        """Write out the records waiting in the current chunk"""
+        self._write_chunk()
+        self._file.flush()
+
+    def close(self):
+        if self._file is None:
+            return
+        self._write_chunk()
+        index_offset = self._file.tell()
+        self._file.write(np.array(self._index, dtype=INDEX_ENTRY_DTYPE).tobytes())
+        self._file.write(TRAILER_FORMAT.pack(index_offset, len(self._index), self.record_count, TRAILER_MAGIC))
+        self._file.close()
+        self._file = None
+
+    def _write_chunk(self):
+        if self._chunk_count == 0:
+            return
+        chunk = self._chunk[:self._chunk_count]
+        self._index.append((self.record_count, chunk[0]["host_time_s"], chunk[0]["device_time_us"]))
+        self._file.write(memoryview(chunk).cast("B"))
+        self.record_count += self._chunk_count
+        self._chunk_count = 0
+
+
+class FluxlogReader:
+    """Memory maps a .fluxlog file, opening costs the same however big the file is"""
+
+    def __init__(self, path: PathLike) -> None:
+        self.path = pathlib.Path(path)
+        with open(self.path, "rb") as file:
+            file_size = file.seek(0, 2)
+            assert file_size >= HEADER_SIZE, f"{self.path} is too short to be a fluxlog"
+            self._mmap = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, channels, record_size, chunk_records, self.start_unix_time, key_ids = HEADER_FORMAT.unpack_from(self._mmap)
+        assert magic == MAGIC, f"{self.path} is not a fluxlog"
+        assert version == VERSION, f"Unsupported fluxlog version {version}"
+        self.key_ids = tuple(key_ids[:channels])
+        self.chunk_records = chunk_records
+        self.dtype = record_dtype(channels)
+        assert self.dtype.itemsize == record_size
+
+        trailer = self._read_trailer(file_size)
+        if trailer is not None:
+            index_offset, chunk_count, record_count = trailer
+            self.records = np.frombuffer(self._mmap, dtype=self.dtype, count=record_count, offset=HEADER_SIZE)
+            self.index = np.frombuffer(self._mmap, dtype=INDEX_ENTRY_DTYPE, count=chunk_count, offset=index_offset)
+            self.is_complete = True
+        else:
+            # Recording didn't finish, use every complete record and index it the way the recorder would have
+            record_count = self._count_whole_records(file_size)
+            self.records = np.frombuffer(self._mmap, dtype=self.dtype, count=record_count, offset=HEADER_SIZE)
+            chunks = self.records[::chunk_records]
+            self.index = np.empty(len(chunks), dtype=INDEX_ENTRY_DTYPE)
+            self.index["first_record"] = np.arange(0, record_count, chunk_records)
+            self.index["host_time_s"] = chunks["host_time_s"]
+            self.index["device_time_us"] = chunks["device_time_us"]
+            self.is_complete = False
+
+    def _read_trailer(self, file_size: int) -> Optional[Tuple[int, int, int]]:
+        if file_size < HEADER_SIZE + TRAILER_FORMAT.size:
+            return None
+        index_offset, chunk_count, record_count, magic = TRAILER_FORMAT.unpack_from(self._mmap, file_size - TRAILER_FORMAT.size)
+        if magic != TRAILER_MAGIC:
+            return None
+        return index_offset, chunk_count, record_count
+
+    def _count_whole_records(self, file_size: int) -> int:
+        """Number of records a file without a trailer holds.
+        Stops before an index or trailer that was only partly written, then at the first record that
+        can't have been recorded (torn, or zeros a crash left behind) since host time only goes up"""
+        record_size = self.dtype.itemsize
+        record_count = (file_size - HEADER_SIZE) // record_size
+        if record_count == 0:
+            return 0
+        records = np.frombuffer(self._mmap, dtype=self.dtype, count=record_count, offset=HEADER_SIZE)
+
+        # The index starts with the entry of the first chunk, or with the trailer pointing at itself if there are no chunks.
+        # It is at most one entry per chunk and the trailer long, so only the last few records can be part of it
+        first_entry = struct.pack("<Qd", 0, records[0]["host_time_s"])
+        max_index_size = INDEX_ENTRY_DTYPE.itemsize * (record_count // self.chunk_records + 1) + TRAILER_FORMAT.size
+        for count in range(max(0, record_count - max_index_size // record_size - 1), record_count + 1):
+            offset = HEADER_SIZE + count * record_size
+            start = self._mmap[offset:offset + len(first_entry)]
+            if start == first_entry or start[:8] == struct.pack("<Q", offset):
+                record_count = count
+                break
+
+        host_time_s = records["host_time_s"][:record_count]
+        invalid = ~np.isfinite(host_time_s)
+        invalid[1:] |= host_time_s[1:] < host_time_s[:-1]
+        invalid |= np.any(records["pressed"][:record_count] > 1, axis=1)
+        invalid |= records["device_time_us"][:record_count] < NO_DEVICE_TIME
+        invalid_records = np.flatnonzero(invalid)
+        return int(invalid_records[0]) if len(invalid_records) else record_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __len__(self):
+        return len(self.records)
+
+    def close(self):
+        """Unmap the file. Views handed out keep the mapping alive until they are deleted"""
+        self.records = self.records[:0].copy()
+        self.index = self.index[:0].copy()
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # A view is still in use, the mapping goes away with it
+
+    def duration_s(self) -> float:
+        if len(self.records) == 0:
+            return 0.0
+        return float(self.records[-1]["host_time_s"] - self.records[0]["host_time_s"])
+
+    def find(self, timestamp: float, device_time: bool = False) -> int:
+        """Index of the first record at or after timestamp (seconds of host time, or us of device time).
+        Records without a device time (polled analog reads) are skipped when searching by device time,
+        raises ValueError if no record has one"""
+        if device_time:
+            return self._find_device_time(timestamp)
+        # Find the chunk with the index, then search only inside it so only a few pages get touched
+        chunk = int(np.searchsorted(self.index["host_time_s"], timestamp, side="right")) - 1
+        if chunk < 0:
+            return 0
+        start = int(self.index[chunk]["first_record"])
+        end = int(self.index[chunk + 1]["first_record"]) if chunk + 1 < len(self.index) else len(self.records)
+        return start + int(np.searchsorted(self.records["host_time_s"][start:end], timestamp, side="left"))
+
+    def _find_device_time(self, timestamp_us: float) -> int:
+        # Only chunks starting with a device time bound the search, the records between them may have none
+        timed_chunks = self.index[self.index["device_time_us"] != NO_DEVICE_TIME]
+        if len(timed_chunks) == 0 and not np.any(self.records["device_time_us"] != NO_DEVICE_TIME):
+            raise ValueError(f"{self.path} was recorded with host time only, it can't be searched by device time")
+        chunk = int(np.searchsorted(timed_chunks["device_time_us"], timestamp_us, side="right")) - 1
+        start = int(timed_chunks[chunk]["first_record"]) if chunk >= 0 else 0
+        end = int(timed_chunks[chunk + 1]["first_record"]) if chunk + 1 < len(timed_chunks) else len(self.records)
+        device_time_us = self.records["device_time_us"][start:end]
+        found = np.flatnonzero((device_time_us != NO_DEVICE_TIME) & (device_time_us >= timestamp_us))
+        return start + int(found[0]) if len(found) else end
+
+    def time_range(self, start: float, end: float, device_time: bool = False) -> np.ndarray:
+        """Read only view of the records with start <= time < end"""
+        return self.records[self.find(start, device_time):self.find(end, device_time)]
+
+
+def record(path: PathLike, seconds: float, rate_hz: int) -> int:
+    """Record datastream telemetry from the first attached fluxpad"""
+    ports = find_fluxpad_ports()
+    if not ports:
+        print("No fluxpads found", file=sys.stderr)
+        return 1
+    serial_number, port = next(iter(ports.items()))
+    fluxpad = Fluxpad(port, serial_number)
+    fluxpad.open()
+    try:
+        with FluxlogRecorder(path) as recorder:
+            end_s = time.monotonic() + seconds
+            stream = fluxpad.stream(rate_hz=rate_hz)
+            try:
+                for sample in stream:
+                    recorder.append_sample(sample)
+                    if sample.host_time_s >= end_s:
+                        break
+            finally:
+                stream.close()
+            print(f"Recorded {len(recorder)} samples from {serial_number} to {path}, {fluxpad.stream_dropped_count} dropped")
+    finally:
+        fluxpad.close()
+    return 0
+
+
+def info(path: PathLike) -> int:
+    with FluxlogReader(path) as reader:
+        print(f"{reader.path}: {len(reader)} records over {reader.duration_s():.3f} s in {len(reader.index)} chunks")
+        print(f"Keys {reader.key_ids}, started {time.ctime(reader.start_unix_time)}")
+        if not reader.is_complete:
+            print("Recording was not closed, index rebuilt from records")
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Record and inspect fluxpad telemetry captures")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    record_parser = subparsers.add_parser("record", help="Record datastream telemetry from a fluxpad")
+    record_parser.add_argument("path", type=pathlib.Path)
+    record_parser.add_argument("--seconds", type=float, default=10.0)
+    record_parser.add_argument("--rate", type=int, default=1000, help="Samples per second")
+    info_parser = subparsers.add_parser("info", help="Summarize a recording")
+    info_parser.add_argument("path", type=pathlib.Path)
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        return record(args.path, args.seconds, args.rate)
+    return info(args.path)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
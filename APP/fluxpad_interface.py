@@ -1,9 +1,13 @@
+import asyncio
 import enum
 import json
 from collections import deque
-from typing import Deque, NamedTuple, Optional, TypedDict, Literal, Dict, Union, List, get_type_hints, Callable, TypeVar
+import concurrent.futures
+import contextlib
+from typing import Deque, Iterable, NamedTuple, Optional, TypedDict, Literal, Dict, Union, List, Tuple, Type, Iterator, Callable, TypeVar
 import logging
 import pathlib
+import queue
 import threading
 import time
 
@@ -11,6 +15,9 @@ import serial
 import serial.tools.list_ports
 
 from scancode_to_hid_code import KeyType, ScanCodeList
+from codec import FrameDecoder, JsonCodec, BinaryCodec, AnyCodec
+import hotplug
+import settings_schema
 
 
 def find_fluxpad_port():
@@ -21,6 +28,24 @@ def find_fluxpad_port():
     return None
 
 
+def find_fluxpad_serial_number(port: str) -> Optional[str]:
+    """USB serial number of the fluxpad on the given port name or device"""
+    for serial_port in serial.tools.list_ports.comports():
+        if port in (serial_port.name, serial_port.device):
+            return serial_port.serial_number
+    return None
+
+
+def find_fluxpad_ports() -> Dict[str, str]:
+    """Find every connected fluxpad, returns the port device keyed by USB serial number.
+    Falls back to the device name for fluxpads that don't report a serial number"""
+    fluxpad_ports = dict()
+    for serial_port in serial.tools.list_ports.comports():
+        if serial_port.pid == Fluxpad.PID and serial_port.vid == Fluxpad.VID:
+            fluxpad_ports[serial_port.serial_number or serial_port.device] = serial_port.device
+    return fluxpad_ports
+
+
 class CommandType(enum.Enum):
     WRITE = "w"
     READ = "r"
@@ -71,15 +96,95 @@ class MessageKey:
     RGB_C2 = "rgb_c2"
     RGB_C3 = "rgb_c3"
     CLEAR_FLASH = "clear"
+    CODECS = "cdc"
+    DATASTREAM_TIME = "t"
+    DATASTREAM_RAW = "dstrm_raw"
+    RAW_READINGS = "raw"
+    PRESSED = "p"
+    ADC_SAMPLES_OVERRIDE = "adc_n"
+    SETTINGS_CRC = "crc"
+
+
+class Field:
+    """Declares one message field, maps an attribute to its key in the message data dict.
+    Setting the attribute checks the value against the field type and range"""
+
+    __slots__ = ("key", "type", "minimum", "maximum", "choices", "default", "strict", "read_only", "name")
+
+    def __init__(self, key: str, type: type, minimum=None, maximum=None, choices=None, default=None, strict: bool = True, read_only: bool = False) -> None:
+        self.key = key
+        self.type = type
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = None if choices is None else frozenset(choices)
+        self.default = type(0) if default is None else default  # Value used by set_zeros and read requests
+        self.strict = strict  # Check the value is an instance of type
+        self.read_only = read_only  # Only ever requested from the fluxpad, setting it requests it
+        self.name = key
+
+    def __set_name__(self, owner, name: str):
+        self.name = name
+
+    def __get__(self, message: Optional["BaseMessage"], owner=None):
+        if message is None:
+            return self
+        return self.type(message.data[self.key])
+
+    def __set__(self, message: "BaseMessage", value):
+        if self.read_only:
+            value = self.default
+        else:
+            self.validate(value)
+        message.data[self.key] = value
+
+    def __delete__(self, message: "BaseMessage"):
+        message.data.pop(self.key, None)
+
+    def validate(self, value):
+        if self.strict:
+            assert isinstance(value, self.type), f"{self.name} must be {self.type.__name__}, got {value!r}"
+        if self.minimum is not None:
+            assert self.minimum <= value, f"{self.name} must be at least {self.minimum}, got {value!r}"
+        if self.maximum is not None:
+            assert value <= self.maximum, f"{self.name} must be at most {self.maximum}, got {value!r}"
+        if self.choices is not None:
+            assert value in self.choices, f"{self.name} must be one of {sorted(self.choices)}, got {value!r}"
+
+
+def uint8_field(key: str, **kwargs) -> Field:
+    return Field(key, int, 0x00, 0xFF, **kwargs)
+
+
+def uint16_field(key: str, **kwargs) -> Field:
+    return Field(key, int, 0x00, 0xFFFF, **kwargs)
 
 
 class BaseMessage:
 
+    __slots__ = ("data",)
+
+    # Fields of the message, collected from the Field attributes when the class is created
+    _fields: Tuple[Field, ...] = ()
+    _zeros: Dict[str, object] = {}
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        fields = dict()
+        for klass in reversed(cls.__mro__):
+            for name, value in vars(klass).items():
+                if isinstance(value, Field):
+                    fields[name] = value
+        cls._fields = tuple(fields.values())
+        cls._zeros = {field.key: field.default for field in cls._fields}
+
     def __init__(self, init_dict: Optional[dict] = None) -> None:
         if init_dict is None:
             init_dict = dict()
         self.data = init_dict
 
+    def __repr__(self) -> str:
+        return f"{self.__class__.__name__}({self.data!r})"
+
     def to_string(self) -> str:
         return json.dumps(self.data, indent=None, separators=(',', ':'))
 
@@ -88,12 +193,11 @@ class BaseMessage:
     
     def set_zeros(self):
         """Set all message values to zero"""
-        for k, v in self.__class__.__dict__.items():
-            # Iterate through all class members and look for properties
-            if isinstance(v, property):
-                # print(get_type_hints(v.fset))
-                expected_type = next(iter(get_type_hints(v.fset).values()))
-                setattr(self, k, expected_type(0))  # Set property to zero to set the message value
+        self.data.update(self._zeros)
+
+    @classmethod
+    def get_fields(cls) -> Tuple[Field, ...]:
+        return cls._fields
     
     @property
     def token(self):
@@ -123,523 +227,849 @@ class BaseMessage:
         assert isinstance(value, int)
         assert 0x00 <= value <= 0xFFFF
 
-class EncoderSettingsMessage(BaseMessage):
-
-    # KEY ID
-    @property
-    def key_id(self):
-        return self.data[MessageKey.KEY_ID]
 
-    @key_id.setter
-    def key_id(self, key_id: int):
-        self._assert_uint8(key_id)
-        self.data[MessageKey.KEY_ID] = key_id
-
-    # KEYMAP
-    @property
-    def key_code(self):
-        return self.data[MessageKey.KEY_CODE]
-
-    @key_code.setter
-    def key_code(self, key_code: int):
-        self._assert_uint16(key_code)
-        self.data[MessageKey.KEY_CODE] = key_code
+class EncoderSettingsMessage(BaseMessage):
 
-    @key_code.deleter
-    def key_code(self):
-        try:
-            del self.data[MessageKey.KEY_CODE]
-        except KeyError:
-            pass
+    __slots__ = ()
 
-    @property
-    def key_type(self):
-        return self.data[MessageKey.KEY_TYPE]
-
-    @key_type.setter
-    def key_type(self, key_type: int):
-        self._assert_uint8(key_type)
-        assert key_type in list(KeyType)
-        self.data[MessageKey.KEY_TYPE] = key_type
-    
-    @key_type.deleter
-    def key_type(self):
-        try:
-            del self.data[MessageKey.KEY_TYPE]
-        except KeyError:
-            pass
+    key_id = uint8_field(MessageKey.KEY_ID)
+    key_code = uint16_field(MessageKey.KEY_CODE)
+    key_type = uint8_field(MessageKey.KEY_TYPE, choices=KeyType)
 
 
 class DigitalSettingsMessage(BaseMessage):
 
-    # KEY ID
-    @property
-    def key_id(self):
-        return self.data[MessageKey.KEY_ID]
-
-    @key_id.setter
-    def key_id(self, key_id: int):
-        self._assert_uint8(key_id)
-        assert key_id in list(KeyType)
-        self.data[MessageKey.KEY_ID] = key_id
+    __slots__ = ()
 
-    # KEYMAP
-    @property
-    def key_code(self):
-        return self.data[MessageKey.KEY_CODE]
-
-    @key_code.setter
-    def key_code(self, key_code: int):
-        self._assert_uint16(key_code)
-        self.data[MessageKey.KEY_CODE] = key_code
-
-    @property
-    def key_type(self):
-        return self.data[MessageKey.KEY_TYPE]
-
-    @key_type.setter
-    def key_type(self, key_type: int):
-        self._assert_uint8(key_type)
-        assert key_type in list(KeyType)
-        self.data[MessageKey.KEY_TYPE] = key_type
+    key_id = uint8_field(MessageKey.KEY_ID)
+    key_code = uint16_field(MessageKey.KEY_CODE)
+    key_type = uint8_field(MessageKey.KEY_TYPE, choices=KeyType)
+    actuate_debounce = uint8_field(MessageKey.ACTUATE_DEBOUNCE)
+    release_debounce = uint8_field(MessageKey.RELEASE_DEBOUNCE)
+    mode = uint8_field(MessageKey.LIGHTING_MODE)
+    brightness = uint8_field(MessageKey.LIGHTING_FADE_BRIGHTNESS)
+    flash_duration = Field(MessageKey.LIGHTING_FLASH_DURATION, int, strict=False)  # us
 
-    # DEBOUNCE
-    @property
-    def actuate_debounce(self):
-        return self.data[MessageKey.ACTUATE_DEBOUNCE]
-
-    @actuate_debounce.setter
-    def actuate_debounce(self, debounce_ms: int):
-        self._assert_uint8(debounce_ms)
-        self.data[MessageKey.ACTUATE_DEBOUNCE] = debounce_ms
 
-    @property
-    def release_debounce(self):
-        return self.data[MessageKey.RELEASE_DEBOUNCE]
+class AnalogSettingsMessage(BaseMessage):
 
-    @release_debounce.setter
-    def release_debounce(self, debounce_ms: int):
-        self._assert_uint8(debounce_ms)
-        self.data[MessageKey.RELEASE_DEBOUNCE] = debounce_ms
+    __slots__ = ()
 
-    # LIGHTING MODE
-    @property
-    def mode(self):
-        return int(self.data[MessageKey.LIGHTING_MODE])
+    key_id = uint8_field(MessageKey.KEY_ID)
+    key_code = uint16_field(MessageKey.KEY_CODE)
+    key_type = uint8_field(MessageKey.KEY_TYPE, choices=KeyType)
+    actuate_hysteresis = Field(MessageKey.ACTUATE_HYSTERESIS, float, minimum=0)  # mm
+    release_hysteresis = Field(MessageKey.RELEASE_HYSTERESIS, float, minimum=0)  # mm
+    actuate_point = Field(MessageKey.ACTUATE_POINT, float, minimum=0)  # mm
+    release_point = Field(MessageKey.RELEASE_POINT, float, minimum=0)  # mm
+    actuate_debounce = uint8_field(MessageKey.ACTUATE_DEBOUNCE)
+    release_debounce = uint8_field(MessageKey.RELEASE_DEBOUNCE)
+    adc_samples = uint8_field(MessageKey.ADC_SAMPLES)
+    rapid_trigger = Field(MessageKey.RAPID_TRIGGER, bool)
+    mode = uint8_field(MessageKey.LIGHTING_MODE)
+    brightness = uint8_field(MessageKey.LIGHTING_FADE_BRIGHTNESS)
+    flash_duration = Field(MessageKey.LIGHTING_FLASH_DURATION, int, strict=False)  # us
 
-    @mode.setter
-    def mode(self, mode: int):
-        self._assert_uint8(mode)
-        self.data[MessageKey.LIGHTING_MODE] = mode
 
-    # LIGHTING BRIGHTNESS
-    @property
-    def brightness(self):
-        return int(self.data[MessageKey.LIGHTING_FADE_BRIGHTNESS])
+class AnalogCalibrationMessage(BaseMessage):
+    """Analog key calibration message containing
+    calibration up and calibration down settings"""
 
-    @brightness.setter
-    def brightness(self, brightness: int):
-        self._assert_uint8(brightness)
-        self.data[MessageKey.LIGHTING_FADE_BRIGHTNESS] = brightness
+    __slots__ = ()
 
-    # LIGHTING FLASH DURATION
-    @property
-    def flash_duration(self):
-        return int(self.data[MessageKey.LIGHTING_FLASH_DURATION])
+    key_id = uint8_field(MessageKey.KEY_ID)
+    calibration_up = Field(MessageKey.CALIBRATION_UP, float, 0, 4096)  # ADC counts
+    calibration_down = Field(MessageKey.CALIBRATION_DOWN, float, 0, 4096)  # ADC counts
 
-    @flash_duration.setter
-    def flash_duration(self, flash_duration_us: int):
-        self.data[MessageKey.LIGHTING_FLASH_DURATION] = flash_duration_us
 
+class RGBSettingsMessage(BaseMessage):
+    """KeyLightingMessage containing all info about a key's
+    per-key lighting settings"""
 
-class AnalogSettingsMessage(BaseMessage):
+    __slots__ = ()
 
-    # KEY ID
-    @property
-    def key_id(self):
-        return self.data[MessageKey.KEY_ID]
+    mode = uint8_field(MessageKey.RGB_MODE)
+    color1 = Field(MessageKey.RGB_C1, int, strict=False)
+    color2 = Field(MessageKey.RGB_C2, int, strict=False)
+    color3 = Field(MessageKey.RGB_C3, int, strict=False)
+    brightness = Field(MessageKey.RGB_BRIGHTNESS, int, strict=False)
+    speed = Field(MessageKey.RGB_SPEED, int, strict=False)
 
-    @key_id.setter
-    def key_id(self, key_id: int):
-        self._assert_uint8(key_id)
-        self.data[MessageKey.KEY_ID] = key_id
 
-    # KEYMAP
-    @property
-    def key_code(self):
-        return self.data[MessageKey.KEY_CODE]
+class AnalogReadMessage(BaseMessage):
+    """Analog key read message containing """
 
-    @key_code.setter
-    def key_code(self, key_code: int):
-        self._assert_uint16(key_code)
-        self.data[MessageKey.KEY_CODE] = key_code
+    __slots__ = ()
 
-    @property
-    def key_type(self):
-        return self.data[MessageKey.KEY_TYPE]
+    key_id = uint8_field(MessageKey.KEY_ID)
+    raw_adc = Field(MessageKey.RAW_ADC, float, default=0, read_only=True)
+    height_mm = Field(MessageKey.HEIGHT, float, default=0, read_only=True)
 
-    @key_type.setter
-    def key_type(self, key_type: int):
-        self._assert_uint8(key_type)
-        assert key_type in list(KeyType)
-        self.data[MessageKey.KEY_TYPE] = key_type
 
+class VersionReadMessage(BaseMessage):
 
-    # HYSTERESIS
-    @property
-    def actuate_hysteresis(self):
-        return self.data[MessageKey.ACTUATE_HYSTERESIS]
+    __slots__ = ()
 
-    @actuate_hysteresis.setter
-    def actuate_hysteresis(self, hysteresis_mm: float):
-        assert isinstance(hysteresis_mm, float)
-        assert 0 <= hysteresis_mm
-        self.data[MessageKey.ACTUATE_HYSTERESIS] = hysteresis_mm
+    version = uint8_field(MessageKey.VERSION)
 
-    @property
-    def release_hysteresis(self):
-        return self.data[MessageKey.RELEASE_HYSTERESIS]
+    def get_supported_codecs(self) -> int:
+        """Bitmask of the codec ids the firmware supports, firmware that doesn't report it only speaks JSON"""
+        return self.data.get(MessageKey.CODECS, 1 << JsonCodec.CODEC_ID)
 
-    @release_hysteresis.setter
-    def release_hysteresis(self, hysteresis_mm: float):
-        assert isinstance(hysteresis_mm, float)
-        assert 0 <= hysteresis_mm
-        self.data[MessageKey.RELEASE_HYSTERESIS] = hysteresis_mm
+# class KeySettingMessage(DigitalSettingsMessage, AnalogSettingsMessage, EncoderSettingsMessage, AnalogCalibrationMessage, AnalogReadMessage):
+#     """Composite class of all settings types"""
+#     pass
 
-    # POINT
-    @property
-    def actuate_point(self):
-        return self.data[MessageKey.ACTUATE_POINT]
+AnyMessage = TypeVar("AnyMessage", DigitalSettingsMessage, AnalogSettingsMessage, EncoderSettingsMessage, AnalogCalibrationMessage, AnalogReadMessage, RGBSettingsMessage, VersionReadMessage, Union[DigitalSettingsMessage, AnalogSettingsMessage, EncoderSettingsMessage, AnalogCalibrationMessage, AnalogReadMessage, RGBSettingsMessage])
+T = TypeVar("T")
 
-    @actuate_point.setter
-    def actuate_point(self, height_mm: float):
-        assert isinstance(height_mm, float)
-        assert 0 <= height_mm
-        self.data[MessageKey.ACTUATE_POINT] = height_mm
 
-    @property
-    def release_point(self):
-        return self.data[MessageKey.RELEASE_POINT]
+class DatastreamSample(NamedTuple):
+    """Readings of the streamed analog keys at one point in time"""
+    host_time_s: float  # time.monotonic() when the sample was read from the port
+    device_time_us: int  # Fluxpad time, unwrapped so it keeps counting up
+    key_ids: Tuple[int, ...]
+    raw_adc: Tuple[float, ...]
+    height_mm: Tuple[float, ...]
+    pressed: Tuple[bool, ...]
 
-    @release_point.setter
-    def release_point(self, height_mm: float):
-        assert isinstance(height_mm, float)
-        assert 0 <= height_mm
-        self.data[MessageKey.RELEASE_POINT] = height_mm
 
-    # DEBOUNCE
-    @property
-    def actuate_debounce(self):
-        return self.data[MessageKey.ACTUATE_DEBOUNCE]
+class PendingRequest(NamedTuple):
+    """Request that has been sent to the fluxpad and is waiting for a response"""
+    message_type: Type[BaseMessage]
+    future: concurrent.futures.Future
+    sent_time_s: float
 
-    @actuate_debounce.setter
-    def actuate_debounce(self, debounce_ms: int):
-        self._assert_uint8(debounce_ms)
-        self.data[MessageKey.ACTUATE_DEBOUNCE] = debounce_ms
 
-    @property
-    def release_debounce(self):
-        return self.data[MessageKey.RELEASE_DEBOUNCE]
+class Fluxpad:
 
-    @release_debounce.setter
-    def release_debounce(self, debounce_ms: int):
-        self._assert_uint8(debounce_ms)
-        self.data[MessageKey.RELEASE_DEBOUNCE] = debounce_ms
+    VID = 0x1209
+    PID = 0x7272
+    BAUDRATE = 115200
+    SOP_TOKEN = b"{"
+    EOP_TOKEN = b"}"
 
-    @property
-    def adc_samples(self):
-        return int(self.data[MessageKey.ADC_SAMPLES])
+    REQUEST_TIMEOUT_S = 1.0
+    MAX_IN_FLIGHT = 8
+    INCOMING_MSGS_MAXLEN = 256
 
-    @adc_samples.setter
-    def adc_samples(self, adc_samples: int):
-        self._assert_uint8(adc_samples)
-        self.data[MessageKey.ADC_SAMPLES] = adc_samples
+    ANALOG_KEY_IDS = (2, 3, 4)  # Order of the analog keys in datastream messages
+    ADC_SAMPLES_MAX = 1024
+    STREAM_QUEUE_MAXLEN = 4096
+    STREAM_TIMEOUT_S = 1.0
 
-    @property
-    def rapid_trigger(self):
-        return bool(self.data[MessageKey.RAPID_TRIGGER])
+    def __init__(self, port: str, serial_number: Optional[str] = None) -> None:
+        self.serial_number = serial_number
+        self.port = serial.Serial()
+        self.port.port = port
+        self.port.baudrate = self.BAUDRATE
+        self.port.bytesize = 8
+        self.port.timeout = 0.1  # seconds
+        self.last_token = 1
+        self.incoming_msgs: Deque[BaseMessage] = deque(maxlen=self.INCOMING_MSGS_MAXLEN)  # Unsolicited messages
+        self.codec: AnyCodec = JsonCodec()
+        self._decoder = self.codec.new_frame_decoder()
+
+        # Pipelining state, requests in flight are keyed by token
+        self._pending_requests: Dict[int, PendingRequest] = dict()
+        self._pending_lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._in_flight = threading.BoundedSemaphore(self.MAX_IN_FLIGHT)
+        self._reader_thread: Optional[threading.Thread] = None
+        self._reader_stop_request = threading.Event()
+        self._pipelined_lock = threading.Lock()
+        self._pipelined_count = 0  # pipelined() contexts open, the reader stops when the last one exits
+        self._pipelined_started_reader = False
+
+        # Queues of the running streams, datastream messages are copied to each
+        self._stream_queues: List[queue.Queue] = []
+        self._stream_lock = threading.Lock()
+        self._stream_raw = False
+        self.stream_dropped_count = 0
 
-    @rapid_trigger.setter
-    def rapid_trigger(self, rapid_trigger_enable: bool):
-        assert isinstance(rapid_trigger_enable, bool)
-        self.data[MessageKey.RAPID_TRIGGER] = rapid_trigger_enable
+    def get_next_token(self):
+        self.last_token += 1
+        if self.last_token > 255:
+            self.last_token = 1
+        return self.last_token
 
-    # LIGHTING MODE
-    @property
-    def mode(self):
-        return int(self.data[MessageKey.LIGHTING_MODE])
+    def open(self):
+        self.port.open()
 
-    @mode.setter
-    def mode(self, mode: int):
-        self._assert_uint8(mode)
-        self.data[MessageKey.LIGHTING_MODE] = mode
+    def close(self):
+        self.stop_reader()
+        self.port.close()
 
-    # LIGHTING BRIGHTNESS
     @property
-    def brightness(self):
-        return int(self.data[MessageKey.LIGHTING_FADE_BRIGHTNESS])
-
-    @brightness.setter
-    def brightness(self, brightness: int):
-        self._assert_uint8(brightness)
-        self.data[MessageKey.LIGHTING_FADE_BRIGHTNESS] = brightness
+    def is_pipelined(self):
+        return self._reader_thread is not None and self._reader_thread.is_alive()
+
+    def _read_messages(self) -> List[dict]:
+        """Read everything waiting on the port and return the decoded messages.
+        Blocks for up to the port timeout if nothing is waiting"""
+        messages = []
+        for frame in self._decoder.read_from(self.port):
+            try:
+                messages.append(self.codec.decode(frame))
+            except ValueError:
+                logging.warning("Failed to parse incoming message %s", bytes(frame), exc_info=True)
+        return messages
 
-    # LIGHTING FLASH DURATION
-    @property
-    def flash_duration(self):
-        return int(self.data[MessageKey.LIGHTING_FLASH_DURATION])
+    def _send_request(self, message: AnyMessage):
 
-    @flash_duration.setter
-    def flash_duration(self, flash_duration_us: int):
-        self.data[MessageKey.LIGHTING_FLASH_DURATION] = flash_duration_us
+        if self.is_pipelined:
+            # Reader thread owns the port reads, wait on the response future instead
+            return self._wait_for_response(self._submit_request(message))
 
+        message_type = type(message)
 
-class AnalogCalibrationMessage(BaseMessage):
-    """Analog key calibration message containing
-    calibration up and calibration down settings"""
+        # Add token
+        message.token = self.get_next_token()
 
-    # KEY ID
-    @property
-    def key_id(self):
-        return self.data[MessageKey.KEY_ID]
+        # Send bytes, anything left over from earlier exchanges is stale
+        logging.debug("Sending %s: %s", message.__class__.__name__, message.data)
+        self._decoder.reset()
+        self.port.write(self.codec.encode(message.data))
+
+        # Receive bytes, keep anything that isn't our response as unsolicited
+        deadline_s = time.monotonic() + self.REQUEST_TIMEOUT_S
+        while time.monotonic() < deadline_s:
+            incoming_message = None
+            for incoming_json in self._read_messages():
+                logging.debug("Received message: %s", incoming_json)
+                if incoming_message is None and incoming_json.get(MessageKey.TOKEN) == message.token:
+                    incoming_message = message_type(incoming_json)
+                else:
+                    self.incoming_msgs.append(BaseMessage(incoming_json))
+            if incoming_message is not None:
+                return incoming_message
+        raise TimeoutError(f"No response to {message.__class__.__name__} with token {message.token}")
+
+    def _submit_request(self, message: AnyMessage) -> concurrent.futures.Future:
+        """Send a request without waiting for the response.
+        The reader thread resolves the returned future once the response with the matching token arrives"""
+
+        if not self.is_pipelined:
+            raise RuntimeError("Reader thread not started, use Fluxpad.pipelined()")
+
+        self._expire_pending_requests()
+        if not self._in_flight.acquire(timeout=self.REQUEST_TIMEOUT_S):
+            raise TimeoutError(f"More than {self.MAX_IN_FLIGHT} requests in flight")
+
+        future = concurrent.futures.Future()
+        future.add_done_callback(lambda _: self._in_flight.release())
+        with self._pending_lock:
+            # Skip tokens that are still waiting on a response
+            token = self.get_next_token()
+            while token in self._pending_requests:
+                token = self.get_next_token()
+            message.token = token
+            self._pending_requests[token] = PendingRequest(type(message), future, time.monotonic())
+
+        logging.debug("Sending %s: %s", message.__class__.__name__, message.data)
+        try:
+            with self._write_lock:
+                self.port.write(self.codec.encode(message.data))
+        except Exception as e:
+            self._resolve_pending_request(token, exception=e)
+        return future
 
-    @key_id.setter
-    def key_id(self, key_id: int):
-        self._assert_uint8(key_id)
-        self.data[MessageKey.KEY_ID] = key_id
-    
-    # CALIBRATION
-    @property
-    def calibration_up(self):
-        return self.data[MessageKey.CALIBRATION_UP]
+    def _wait_for_response(self, future: concurrent.futures.Future) -> AnyMessage:
+        try:
+            return future.result(timeout=self.REQUEST_TIMEOUT_S)
+        except concurrent.futures.TimeoutError:
+            # Stop waiting on this request so its token and in flight slot are freed
+            with self._pending_lock:
+                tokens = [token for token, pending_request in self._pending_requests.items() if pending_request.future is future]
+            for token in tokens:
+                self._resolve_pending_request(token, exception=TimeoutError(f"No response for token {token}"))
+            raise
+
+    def _resolve_pending_request(self, token: int, message: Optional[dict] = None, exception: Optional[BaseException] = None):
+        """Complete the future of the pending request with the given token, returns False if there is none"""
+        with self._pending_lock:
+            pending_request = self._pending_requests.pop(token, None)
+        if pending_request is None:
+            return False
+        if exception is not None:
+            pending_request.future.set_exception(exception)
+        else:
+            pending_request.future.set_result(pending_request.message_type(message))
+        return True
 
-    @calibration_up.setter
-    def calibration_up(self, up_adc: float):
-        assert isinstance(up_adc, float)
-        assert 0 <= up_adc <= 4096
-        self.data[MessageKey.CALIBRATION_UP] = up_adc
+    def _expire_pending_requests(self, max_age_s: Optional[float] = None):
+        """Fail any pending requests that have been waiting for longer than max_age_s"""
+        if max_age_s is None:
+            max_age_s = self.REQUEST_TIMEOUT_S
+        now_s = time.monotonic()
+        with self._pending_lock:
+            expired_tokens = [token for token, pending_request in self._pending_requests.items() if now_s - pending_request.sent_time_s >= max_age_s]
+        for token in expired_tokens:
+            self._resolve_pending_request(token, exception=TimeoutError(f"No response for token {token}"))
+
+    def start_reader(self):
+        """Start the reader thread that routes responses to pending requests"""
+        if self.is_pipelined:
+            return
+        if not self.port.is_open:
+            raise ConnectionError("Fluxpad not connected")
+        logging.debug("Starting reader")
+        self._decoder.reset()
+        self._reader_stop_request.clear()
+        self._reader_thread = threading.Thread(target=self._reader_worker, name="fluxpadreader", daemon=True)
+        self._reader_thread.start()
+
+    def stop_reader(self):
+        """Stop the reader thread, fails any requests still in flight"""
+        if self._reader_thread is not None and self._reader_thread.is_alive():
+            logging.debug("Stopping reader")
+            self._reader_stop_request.set()
+            try:
+                self.port.cancel_read()  # Wake the reader from a blocking read
+            except Exception:
+                pass
+            self._reader_thread.join(timeout=1.0)
+            assert self._reader_thread.is_alive() == False, "Reader thread not stopped"
+        self._reader_thread = None
+
+    @contextlib.contextmanager
+    def pipelined(self):
+        """Context in which several requests can be in flight at once.
+        Starts the reader thread if it isn't running and stops it again when the last of these contexts exits,
+        so contexts on different threads can overlap, eg. two streams"""
+        with self._pipelined_lock:
+            if self._pipelined_count == 0:
+                self._pipelined_started_reader = not self.is_pipelined
+                if self._pipelined_started_reader:
+                    self.start_reader()
+            self._pipelined_count += 1
+        try:
+            yield self
+        finally:
+            with self._pipelined_lock:
+                self._pipelined_count -= 1
+                if self._pipelined_count == 0 and self._pipelined_started_reader:
+                    self.stop_reader()
+
+    def _reader_worker(self):
+        while not self._reader_stop_request.is_set():
+            try:
+                incoming_msgs = self._read_messages()
+            except serial.SerialException:
+                logging.error("Serial exception in reader thread", exc_info=True)
+                break
 
-    @calibration_up.deleter
-    def calibration_up(self):
+            receive_time_s = time.monotonic()
+            for incoming_json in incoming_msgs:
+                if MessageKey.DATASTREAM_TIME in incoming_json:
+                    self._on_datastream_message(receive_time_s, incoming_json)
+                    continue
+                logging.debug("Received message: %s", incoming_json)
+                token = incoming_json.get(MessageKey.TOKEN, 0)
+                if not self._resolve_pending_request(token, message=incoming_json):
+                    # Not a response to anything we sent, keep it for whoever is interested
+                    self.incoming_msgs.append(BaseMessage(incoming_json))
+            self._expire_pending_requests()
+
+        # Nobody is going to answer the requests still in flight
+        with self._pending_lock:
+            pending_tokens = list(self._pending_requests.keys())
+        for token in pending_tokens:
+            self._resolve_pending_request(token, exception=ConnectionError("Reader thread stopped"))
+        logging.debug("Reader thread stopped")
+
+    def _on_datastream_message(self, receive_time_s: float, message: dict):
+        with self._stream_lock:
+            for stream_queue in self._stream_queues:
+                try:
+                    stream_queue.put_nowait((receive_time_s, message))
+                except queue.Full:
+                    self.stream_dropped_count += 1
+
+    def set_datastream_rate(self, rate_hz: int):
+        """Set how often the fluxpad sends datastream messages, 0 turns datastream mode off"""
+        message = BaseMessage({MessageKey.DATASTREAM_FREQUENCY: rate_hz})
+        self.send_write_request(message)
+
+    def set_datastream_raw(self, raw: bool):
+        """Make datastream messages carry only the packed raw readings instead of readings and heights"""
+        message = BaseMessage({MessageKey.DATASTREAM_RAW: raw})
+        self.send_write_request(message)
+
+    def set_adc_samples(self, samples: int):
+        """Override how many ADC samples the fluxpad averages per reading until it resets, 0 restores the default.
+        For benchmarking, unlike the adc_samples setting it isn't saved"""
+        assert 0 <= samples <= self.ADC_SAMPLES_MAX
+        message = BaseMessage({MessageKey.ADC_SAMPLES_OVERRIDE: samples})
+        self.send_write_request(message)
+
+    def get_settings_crc(self) -> Optional[int]:
+        """CRC-32 of everything the fluxpad stores in flash, None if the firmware doesn't report it"""
+        message = BaseMessage({MessageKey.SETTINGS_CRC: 0})
+        return self.send_read_request(message).data.get(MessageKey.SETTINGS_CRC)
+
+    @contextlib.contextmanager
+    def _datastream(self, rate_hz: int, raw: bool) -> Iterator[queue.Queue]:
+        """Turn on datastream mode and get a queue of (receive time, message) for as long as the context lasts"""
+        stream_queue = queue.Queue(maxsize=self.STREAM_QUEUE_MAXLEN)
+        with self.pipelined():
+            with self._stream_lock:
+                assert not self._stream_queues or self._stream_raw == raw, "Can't mix raw and normal datastreams"
+                self._stream_raw = raw
+                self._stream_queues.append(stream_queue)
+            try:
+                self.set_datastream_raw(raw)
+                self.set_datastream_rate(rate_hz)
+                yield stream_queue
+            finally:
+                with self._stream_lock:
+                    self._stream_queues.remove(stream_queue)
+                    streams_left = len(self._stream_queues)
+                if streams_left == 0:
+                    try:
+                        self.set_datastream_rate(0)
+                        if raw:
+                            self.set_datastream_raw(False)
+                    except Exception:
+                        logging.warning("Failed to turn off datastream mode", exc_info=True)
+
+    def _get_datastream_message(self, stream_queue: queue.Queue) -> Tuple[float, dict]:
         try:
-            del self.data[MessageKey.CALIBRATION_UP]
-        except KeyError:
-            pass
+            return stream_queue.get(timeout=self.STREAM_TIMEOUT_S)
+        except queue.Empty:
+            raise TimeoutError(f"No datastream messages for {self.STREAM_TIMEOUT_S}s") from None
+
+    def stream(self, key_ids: Iterable[int] = ANALOG_KEY_IDS, rate_hz: int = 1000) -> Iterator[DatastreamSample]:
+        """Turn on datastream mode and yield samples of the given analog keys as the fluxpad sends them.
+        Datastream mode is turned off again when the generator is closed. Works over either codec,
+        the binary codec sends the per key readings as list fields.
+        Raises TimeoutError if the fluxpad stops sending, eg. firmware without datastream mode"""
+        key_ids = tuple(key_ids)
+        indexes = [self.ANALOG_KEY_IDS.index(key_id) for key_id in key_ids]
+
+        with self._datastream(rate_hz, raw=False) as stream_queue:
+            last_time_us = None
+            time_offset_us = 0
+            while True:
+                receive_time_s, message = self._get_datastream_message(stream_queue)
+
+                # Fluxpad time is 32 bit us, unwrap it
+                time_us = message[MessageKey.DATASTREAM_TIME]
+                if last_time_us is not None and time_us < last_time_us:
+                    time_offset_us += 1 << 32
+                last_time_us = time_us
+
+                raw_adc = message[MessageKey.RAW_ADC]
+                height_mm = message[MessageKey.HEIGHT]
+                pressed = message[MessageKey.PRESSED]
+                yield DatastreamSample(
+                    receive_time_s,
+                    time_us + time_offset_us,
+                    key_ids,
+                    tuple(float(raw_adc[index]) for index in indexes),
+                    tuple(float(height_mm[index]) for index in indexes),
+                    tuple(bool(pressed[index]) for index in indexes),
+                )
+
+    def stream_raw_messages(self, rate_hz: int = 1000, max_batch: int = 256) -> Iterator[List[Tuple[float, dict]]]:
+        """Turn on raw datastream mode and yield lists of (receive time, message) as they arrive.
+        Waits for at least one message, then takes whatever else is already waiting up to max_batch.
+        Use telemetry.stream_raw() to get heights"""
+        with self._datastream(rate_hz, raw=True) as stream_queue:
+            while True:
+                batch = [self._get_datastream_message(stream_queue)]
+                try:
+                    while len(batch) < max_batch:
+                        batch.append(stream_queue.get_nowait())
+                except queue.Empty:
+                    pass
+                yield batch
 
-    @property
-    def calibration_down(self):
-        return float(self.data[MessageKey.CALIBRATION_DOWN])
+    def send_write_request(self, message: AnyMessage) -> AnyMessage:
+        """Send a write request to the fluxpad"""
 
-    @calibration_down.setter
-    def calibration_down(self, down_adc: float):
-        assert isinstance(down_adc, float)
-        assert 0 <= down_adc <= 4096
-        self.data[MessageKey.CALIBRATION_DOWN] = down_adc
+        message.command = CommandType.WRITE
+        return self._send_request(message)
 
-    @calibration_down.deleter
-    def calibration_down(self):
-        try:
-            del self.data[MessageKey.CALIBRATION_DOWN]
-        except KeyError:
-            pass
+    def send_read_request(self, message: AnyMessage) -> AnyMessage:
+        """Send a read request to the fluxpad"""
 
+        message.command = CommandType.READ
+        return self._send_request(message)
 
-class RGBSettingsMessage(BaseMessage):
-    """KeyLightingMessage containing all info about a key's
-    per-key lighting settings"""
+    def submit_write_request(self, message: AnyMessage) -> concurrent.futures.Future:
+        """Send a write request to the fluxpad without waiting for the response, must be pipelined"""
 
-    # RGB MODE
-    @property
-    def mode(self):
-        return int(self.data[MessageKey.RGB_MODE])
+        message.command = CommandType.WRITE
+        return self._submit_request(message)
 
-    @mode.setter
-    def mode(self, mode: int):
-        self._assert_uint8(mode)
-        self.data[MessageKey.RGB_MODE] = mode
+    def submit_read_request(self, message: AnyMessage) -> concurrent.futures.Future:
+        """Send a read request to the fluxpad without waiting for the response, must be pipelined"""
 
-    # RGB Color 1
-    @property
-    def color1(self):
-        return int(self.data[MessageKey.RGB_C1])
+        message.command = CommandType.READ
+        return self._submit_request(message)
 
-    @color1.setter
-    def color1(self, color: int):
-        self.data[MessageKey.RGB_C1] = color
+    def wait_for_response(self, future: concurrent.futures.Future) -> AnyMessage:
+        """Wait for the response to a submitted request"""
+        return self._wait_for_response(future)
+    
+    def get_version(self) -> int:
+        message = VersionReadMessage()
+        message.command = CommandType.VERSION
+        return self._send_request(message).version
 
-    # RGB Color 2
-    @property
-    def color2(self):
-        return int(self.data[MessageKey.RGB_C2])
+    def set_codec(self, codec: AnyCodec):
+        """Encode and decode messages with the given codec from now on"""
+        self.codec = codec
+        self._decoder = codec.new_frame_decoder()
 
-    @color2.setter
-    def color2(self, color: int):
-        self.data[MessageKey.RGB_C2] = color
+    def negotiate_codec(self) -> AnyCodec:
+        """Switch to the binary codec if the firmware reports support for it in the version response,
+        stays on JSON otherwise. Must be called before the reader thread is started"""
+        if self.is_pipelined:
+            raise RuntimeError("Can't switch codec while the reader thread is running")
+        message = VersionReadMessage()
+        message.command = CommandType.VERSION
+        supported_codecs = self._send_request(message).get_supported_codecs()
+        if supported_codecs & (1 << BinaryCodec.CODEC_ID) and not isinstance(self.codec, BinaryCodec):
+            # The switch is acknowledged with the current codec, everything after uses the new one
+            self.send_write_request(BaseMessage({MessageKey.CODECS: BinaryCodec.CODEC_ID}))
+            self.set_codec(BinaryCodec())
+        logging.debug("Using %s codec", self.codec.NAME)
+        return self.codec
 
-    # RGB Color 3
-    @property
-    def color3(self):
-        return int(self.data[MessageKey.RGB_C3])
 
-    @color3.setter
-    def color3(self, color: int):
-        self.data[MessageKey.RGB_C3] = color
+class AsyncFluxpad:
+    """asyncio counterpart of Fluxpad.
+    Responses are read when the event loop sees the serial fd become readable,
+    so any number of devices and requests can share one loop without blocking threads"""
 
-    # RGB BRIGHTNESS
-    @property
-    def brightness(self):
-        return int(self.data[MessageKey.RGB_BRIGHTNESS])
+    REQUEST_TIMEOUT_S = Fluxpad.REQUEST_TIMEOUT_S
+    INCOMING_MSGS_MAXLEN = Fluxpad.INCOMING_MSGS_MAXLEN
 
-    @brightness.setter
-    def brightness(self, brightness: int):
-        self.data[MessageKey.RGB_BRIGHTNESS] = brightness
+    def __init__(self, port: str, serial_number: Optional[str] = None) -> None:
+        self.serial_number = serial_number
+        self.port = serial.Serial()
+        self.port.port = port
+        self.port.baudrate = Fluxpad.BAUDRATE
+        self.port.bytesize = 8
+        self.port.timeout = 0  # Non-blocking, the event loop tells us when there is data
+        self.port.write_timeout = self.REQUEST_TIMEOUT_S
+        self.last_token = 1
+        self.incoming_msgs: Deque[BaseMessage] = deque(maxlen=self.INCOMING_MSGS_MAXLEN)
 
-    # RGB SPEED
-    @property
-    def speed(self):
-        return int(self.data[MessageKey.RGB_SPEED])
-    
-    @speed.setter
-    def speed(self, speed: int):
-        self.data[MessageKey.RGB_SPEED] = speed
-    
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._writer: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        self._pending_requests: Dict[int, Tuple[Type[BaseMessage], asyncio.Future]] = dict()
+        self.codec: AnyCodec = JsonCodec()
+        self._decoder = self.codec.new_frame_decoder()
+        self._reader_fd: Optional[int] = None
+        self._reader_thread: Optional[threading.Thread] = None
 
-class AnalogReadMessage(BaseMessage):
-    """Analog key read message containing """
+    async def __aenter__(self):
+        await self.open()
+        return self
 
-    # KEY ID
-    @property
-    def key_id(self):
-        return self.data[MessageKey.KEY_ID]
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
 
-    @key_id.setter
-    def key_id(self, key_id: int):
-        self._assert_uint8(key_id)
-        self.data[MessageKey.KEY_ID] = key_id
+    def get_next_token(self):
+        # Skip tokens that are still waiting on a response
+        while True:
+            self.last_token += 1
+            if self.last_token > 255:
+                self.last_token = 1
+            if self.last_token not in self._pending_requests:
+                return self.last_token
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._decoder.reset()
+        self.port.open()
+        # Writes block until the OS takes the bytes, so they run off the event loop.
+        # A single writer thread keeps frames whole and in order
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="asyncfluxpadwriter")
+        try:
+            self._reader_fd = self.port.fileno()
+            self._loop.add_reader(self._reader_fd, self._on_readable)
+        except (AttributeError, NotImplementedError):
+            # No selectable fd (Windows), fall back to a thread feeding the loop
+            logging.debug("Serial fd not selectable, using reader thread")
+            self._reader_fd = None
+            self.port.timeout = 0.1
+            self._reader_thread = threading.Thread(target=self._reader_worker, name="asyncfluxpadreader", daemon=True)
+            self._reader_thread.start()
+
+    async def close(self):
+        if self._reader_fd is not None:
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+        self.port.close()
+        if self._writer is not None:
+            self._writer.shutdown(wait=False)
+            self._writer = None
+        if self._reader_thread is not None:
+            await self._loop.run_in_executor(None, self._reader_thread.join, 1.0)
+            self._reader_thread = None
+        self._fail_pending_requests(ConnectionError("Fluxpad closed"))
+
+    def _on_readable(self):
+        try:
+            frames = self._decoder.read_from(self.port)
+        except OSError as e:  # SerialException, or EIO straight from the port once the device is gone
+            logging.error("Serial exception while reading", exc_info=True)
+            self._loop.remove_reader(self._reader_fd)
+            self._reader_fd = None
+            self._fail_pending_requests(e)
+            return
+        for frame in frames:
+            self._on_frame(frame)
 
-    # RAW ADC
-    @property
-    def raw_adc(self):
-        return float(self.data[MessageKey.RAW_ADC])
+    def _reader_worker(self):
+        while self.port.is_open:
+            try:
+                data = self.port.read(self.port.in_waiting or 1)
+            except Exception as e:
+                if self.port.is_open:
+                    self._loop.call_soon_threadsafe(self._fail_pending_requests, e)
+                break
+            if data:
+                self._loop.call_soon_threadsafe(self._on_data, data)
 
-    @raw_adc.setter
-    def raw_adc(self, dummy: int):
-        """Dummy function for read cmd, doesn't actually set raw_adc"""
-        self.data[MessageKey.RAW_ADC] = 0
+    def _on_data(self, data: bytes):
+        for frame in self._decoder.feed(data):
+            self._on_frame(frame)
 
-    @property
-    def height_mm(self):
-        return float(self.data[MessageKey.HEIGHT])
+    def _on_frame(self, frame: memoryview):
+        try:
+            incoming_json = self.codec.decode(frame)
+        except ValueError:
+            logging.warning("Failed to parse incoming message %s", bytes(frame), exc_info=True)
+            return
 
-    @height_mm.setter
-    def height_mm(self, dummy: int):
-        """Dummy function for read cmd, doesn't actually set height_mm"""
-        self.data[MessageKey.HEIGHT] = 0
+        logging.debug("Received message: %s", incoming_json)
+        pending_request = self._pending_requests.pop(incoming_json.get(MessageKey.TOKEN, 0), None)
+        if pending_request is None:
+            self.incoming_msgs.append(BaseMessage(incoming_json))
+            return
+        message_type, future = pending_request
+        if not future.done():
+            future.set_result(message_type(incoming_json))
+
+    def _fail_pending_requests(self, exception: BaseException):
+        pending_requests = list(self._pending_requests.values())
+        self._pending_requests.clear()
+        for _, future in pending_requests:
+            if not future.done():
+                future.set_exception(exception)
+
+    async def _send_request(self, message: AnyMessage) -> AnyMessage:
+        if self._loop is None or not self.port.is_open:
+            raise ConnectionError("Fluxpad not connected")
 
-class VersionReadMessage(BaseMessage):
+        # Add token
+        token = self.get_next_token()
+        message.token = token
+        future = self._loop.create_future()
+        self._pending_requests[token] = (type(message), future)
 
-    # VERSION
-    @property
-    def version(self):
-        return self.data[MessageKey.VERSION]
+        # Send bytes
+        logging.debug("Sending %s: %s", message.__class__.__name__, message.data)
+        try:
+            await self._loop.run_in_executor(self._writer, self.port.write, self.codec.encode(message.data))
+            return await asyncio.wait_for(future, timeout=self.REQUEST_TIMEOUT_S)
+        finally:
+            self._pending_requests.pop(token, None)
 
-    @version.setter
-    def version(self, version: int):
-        self._assert_uint8(version)
-        self.data[MessageKey.VERSION] = version
+    async def send_write_request(self, message: AnyMessage) -> AnyMessage:
+        """Send a write request to the fluxpad"""
 
-# class KeySettingMessage(DigitalSettingsMessage, AnalogSettingsMessage, EncoderSettingsMessage, AnalogCalibrationMessage, AnalogReadMessage):
-#     """Composite class of all settings types"""
-#     pass
+        message.command = CommandType.WRITE
+        return await self._send_request(message)
 
-AnyMessage = TypeVar("AnyMessage", DigitalSettingsMessage, AnalogSettingsMessage, EncoderSettingsMessage, AnalogCalibrationMessage, AnalogReadMessage, RGBSettingsMessage, VersionReadMessage, Union[DigitalSettingsMessage, AnalogSettingsMessage, EncoderSettingsMessage, AnalogCalibrationMessage, AnalogReadMessage, RGBSettingsMessage])
+    async def send_read_request(self, message: AnyMessage) -> AnyMessage:
+        """Send a read request to the fluxpad"""
 
+        message.command = CommandType.READ
+        return await self._send_request(message)
 
-class Fluxpad:
+    async def get_version(self) -> int:
+        message = VersionReadMessage()
+        message.command = CommandType.VERSION
+        return (await self._send_request(message)).version
+
+    def set_codec(self, codec: AnyCodec):
+        """Encode and decode messages with the given codec from now on"""
+        self.codec = codec
+        self._decoder = codec.new_frame_decoder()
+
+    async def negotiate_codec(self) -> AnyCodec:
+        """Switch to the binary codec if the firmware reports support for it in the version response,
+        stays on JSON otherwise. Must not be called with other requests in flight"""
+        if self._pending_requests:
+            raise RuntimeError("Can't switch codec with requests in flight")
+        message = VersionReadMessage()
+        message.command = CommandType.VERSION
+        supported_codecs = (await self._send_request(message)).get_supported_codecs()
+        if supported_codecs & (1 << BinaryCodec.CODEC_ID) and not isinstance(self.codec, BinaryCodec):
+            # The switch is acknowledged with the current codec, everything after uses the new one
+            await self.send_write_request(BaseMessage({MessageKey.CODECS: BinaryCodec.CODEC_ID}))
+            self.set_codec(BinaryCodec())
+        logging.debug("Using %s codec", self.codec.NAME)
+        return self.codec
 
-    VID = 0x1209
-    PID = 0x7272
-    BAUDRATE = 115200
-    SOP_TOKEN = b"{"
-    EOP_TOKEN = b"}"
 
-    def __init__(self, port: str) -> None:
-        self.port = serial.Serial()
-        self.port.port = port
-        self.port.baudrate = self.BAUDRATE
-        self.port.bytesize = 8
-        self.port.timeout = 0.1  # seconds
-        self.last_token = 1
-        self.incoming_msgs: Deque[BaseMessage] = deque()
+class FluxpadSession:
+    """Keeps a fluxpad open for the life of a connection.
+    A single I/O thread owns the port, jobs submitted from other threads are queued and run on it in order"""
 
-    def get_next_token(self):
-        self.last_token += 1
-        if self.last_token > 255:
-            self.last_token = 1
-        return self.last_token
+    OPEN_RETRY_S = 1.0
+    OPEN_RETRY_PERIOD_S = 0.05
 
-    def open(self):
-        self.port.open()
+    def __init__(self, fluxpad: Fluxpad) -> None:
+        self.fluxpad = fluxpad
+        self._jobs: "queue.Queue[Optional[Tuple[concurrent.futures.Future, Callable, tuple, dict]]]" = queue.Queue()
+        self._session_thread: Optional[threading.Thread] = None
+        self._jobs_lock = threading.Lock()
+        self.open_error: Optional[BaseException] = None  # Why the port couldn't be opened, jobs fail with ConnectionError
 
-    def close(self):
-        self.port.close()
+    @property
+    def is_running(self):
+        return self._session_thread is not None and self._session_thread.is_alive()
 
-    def _send_request(self, message: AnyMessage):
+    def start(self):
+        """Start the I/O thread, the port is opened on it"""
+        with self._jobs_lock:
+            if self.is_running:
+                return
+            logging.debug(f"Starting session on {self.fluxpad.port.port}")
+            self.open_error = None
+            self._session_thread = threading.Thread(target=self._worker, name="fluxpadsession", daemon=True)
+            self._session_thread.start()
 
-        message_type = type(message)
+    def stop(self):
+        """Stop the I/O thread after the jobs already queued and close the port"""
+        with self._jobs_lock:
+            if not self.is_running:
+                return
+            logging.debug(f"Stopping session on {self.fluxpad.port.port}")
+            self._jobs.put(None)
+            session_thread = self._session_thread
+        if session_thread is not threading.current_thread():
+            session_thread.join(timeout=5.0)
+            assert session_thread.is_alive() == False, "Session thread not stopped"
+
+    def submit(self, fn: Callable, *args, **kwargs) -> concurrent.futures.Future:
+        """Queue fn(*args, **kwargs) to run on the I/O thread, returns a future for its result"""
+        future = concurrent.futures.Future()
+        if threading.current_thread() is self._session_thread:
+            # Already on the I/O thread, queueing would deadlock anyone waiting on the result
+            self._run_job(future, fn, args, kwargs)
+            return future
+        with self._jobs_lock:
+            if not self.is_running:
+                raise ConnectionError("Fluxpad session not running")
+            self._jobs.put((future, fn, args, kwargs))
+        return future
+
+    def run(self, fn: Callable, *args, **kwargs):
+        """Run fn(*args, **kwargs) on the I/O thread and wait for its result"""
+        return self.submit(fn, *args, **kwargs).result()
 
-        # Add token
-        message.token = self.get_next_token()
+    @staticmethod
+    def _run_job(future: concurrent.futures.Future, fn: Callable, args: tuple, kwargs: dict):
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            result = fn(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(result)
 
-        # Send bytes
-        logging.debug(f"Sending {message.__class__.__name__}: {message.to_string()}")
-        self.port.write(message.to_bytes())
-
-        # Receive bytes
-        self.port.read_until(expected=self.SOP_TOKEN, size=100)
-        incoming_bytes = self.SOP_TOKEN + \
-            self.port.read_until(expected=self.EOP_TOKEN, size=1024)
-        incoming_string = incoming_bytes.decode("ASCII")
-        logging.debug(f"Received message: {incoming_string}")
-        incoming_json = json.loads(incoming_string)
-        incoming_message = message_type(incoming_json)
-        assert incoming_message.token == message.token, f"Token mismatch, expected {incoming_message.token}, got {message.token}"
-        return incoming_message
+    def _worker(self):
+        open_error = None
+        deadline_s = time.monotonic() + self.OPEN_RETRY_S
+        while True:
+            try:
+                self.fluxpad.open()
+                logging.info(f"Opened port {self.fluxpad.port.port}")
+                break
+            except serial.SerialException as e:
+                # A freshly plugged in device node may not be ready yet
+                if time.monotonic() < deadline_s:
+                    time.sleep(self.OPEN_RETRY_PERIOD_S)
+                    continue
+                logging.error(f"Failed to open port {self.fluxpad.port.port}", exc_info=True)
+                open_error = e
+                break
+            except Exception as e:
+                logging.error(f"Failed to open port {self.fluxpad.port.port}", exc_info=True)
+                open_error = e
+                break
 
-    def send_write_request(self, message: AnyMessage) -> AnyMessage:
-        """Send a write request to the fluxpad"""
+        if open_error is None:
+            try:
+                self.fluxpad.negotiate_codec()
+            except Exception:
+                logging.warning(f"Codec negotiation failed on {self.fluxpad.port.port}, using JSON", exc_info=True)
+            try:
+                self.fluxpad.start_reader()
+            except Exception as e:
+                open_error = e
+        self.open_error = open_error
 
-        message.command = CommandType.WRITE
-        return self._send_request(message)
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            future, fn, args, kwargs = job
+            if open_error is not None:
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(ConnectionError(f"Port {self.fluxpad.port.port} not open: {open_error}"))
+                continue
+            self._run_job(future, fn, args, kwargs)
 
-    def send_read_request(self, message: AnyMessage) -> AnyMessage:
-        """Send a read request to the fluxpad"""
+        try:
+            self.fluxpad.close()
+        except Exception:
+            logging.info(f"Serial exception closing {self.fluxpad.port.port}", exc_info=True)
 
-        message.command = CommandType.READ
-        return self._send_request(message)
-    
-    def get_version(self) -> int:
-        message = VersionReadMessage()
-        message.command = CommandType.VERSION
-        return self._send_request(message).version
+        # Anything queued after the stop request won't run
+        while True:
+            try:
+                job = self._jobs.get_nowait()
+            except queue.Empty:
+                break
+            if job is not None and job[0].set_running_or_notify_cancel():
+                job[0].set_exception(ConnectionError("Fluxpad session stopped"))
+        logging.debug("Session thread stopped")
 
 
 class FluxpadListener():
-    """Listener for connected/disconnected events of a fluxpad"""
+    """Listener for connected/disconnected events of a fluxpad.
+    Waits on tty hotplug events where the OS provides them and polls the comports otherwise"""
 
     LISTEN_PERIOD_S = 0.5
+    HOTPLUG_RESCAN_PERIOD_S = 5.0  # Safety net in case a hotplug event is missed
     
-    def __init__(self, on_connect: Callable[[Fluxpad], None], on_disconnect: Callable[[], None]) -> None:
+    def __init__(self, on_connect: Callable[[Fluxpad], None], on_disconnect: Callable[[], None], use_hotplug: bool = True) -> None:
         self._listener_thread: Optional[threading.Thread] = None
         self._stop_request = threading.Event()
         self._prev_port: Optional[str] = None
         self._on_connect_callback = on_connect
         self._on_disconnect_callback = on_disconnect
+        self._use_hotplug = use_hotplug
+        self._monitor: Optional[hotplug.TtyEventMonitor] = None
 
     def start(self):
         """Start the listener thread"""
         logging.debug("Starting listener")
         self._stop_request.clear()
+        if self._use_hotplug:
+            self._monitor = hotplug.TtyEventMonitor.create()
+        if self._monitor is None:
+            logging.info(f"Polling for fluxpad every {self.LISTEN_PERIOD_S}s")
         self._listener_thread = threading.Thread(target=self._worker, daemon=True)
         self._listener_thread.start()
 
@@ -648,50 +1078,201 @@ class FluxpadListener():
         logging.debug("Stopping listener")
         if self._listener_thread is not None and self._listener_thread.is_alive():
             self._stop_request.set()
+            if self._monitor is not None:
+                self._monitor.wake()
             self._listener_thread.join(timeout=1.0)
             assert self._listener_thread.is_alive() == False, "Worker thread not stopped"
             self._listener_thread = None
+        if self._monitor is not None:
+            self._monitor.close()
+            self._monitor = None
 
     @property
     def is_connected(self):
         if self._prev_port is None:
             return False
         return True
+
+    def _wait_for_change(self, timeout: float) -> bool:
+        """Wait until the comports might have changed, returns False if the listener should stop"""
+        if self._monitor is None:
+            return not self._stop_request.wait(timeout=self.LISTEN_PERIOD_S)
+        # Every kernel uevent wakes the monitor, only rescan for a tty event or once the timeout since the last scan runs out
+        self._monitor.wait_for_tty_event(timeout, self._stop_request)
+        return not self._stop_request.is_set()
+
+    def _check_port(self):
+        port = self._prev_port
+        try:
+            port = find_fluxpad_port()
+            if port != self._prev_port:
+                if isinstance(port, str):
+                    # Connected, fire on connect callback
+                    try:
+                        self._on_connect_callback(Fluxpad(port, find_fluxpad_serial_number(port)))
+                    except Exception:
+                        logging.error("on_connect callback error", exc_info=1)
+                else:
+                    # Disconnected, fire on connect callback
+                    try:
+                        self._on_disconnect_callback()
+                    except Exception:
+                        logging.error("on_disconnect callback error", exc_info=1)
+
+        except Exception:
+            logging.error("Listener worker error", exc_info=1)
+        finally:
+            self._prev_port = port
         
     def _worker(self):
+        # First check after the usual poll period so the owner is done setting up
+        timeout = self.LISTEN_PERIOD_S
         while True:
             
             # Handle thread stop event
-            if self._stop_request.wait(timeout=self.LISTEN_PERIOD_S):
+            if not self._wait_for_change(timeout):
                 logging.debug("Stop request event received from worker thread")
                 break
 
-            try:
-                port = find_fluxpad_port()
-                if port != self._prev_port:
-                    if isinstance(port, str):
-                        # Connected, fire on connect callback
-                        try:
-                            self._on_connect_callback(Fluxpad(port))
-                        except Exception:
-                            logging.error("on_connect callback error", exc_info=1)
-                    else:
-                        # Disconnected, fire on connect callback
-                        try:
-                            self._on_disconnect_callback()
-                        except Exception:
-                            logging.error("on_disconnect callback error", exc_info=1)
-
-            except Exception:
-                logging.error("Listener worker error", exc_info=1)
-            finally:
-                self._prev_port = port
+            self._check_port()
+            timeout = self.HOTPLUG_RESCAN_PERIOD_S
             
         # Clear the stop request on the way out
         self._stop_request.clear()
         logging.debug("Workor thread stopped")
 
 
+class FluxpadManager:
+    """Tracks every attached fluxpad, keyed by USB serial number.
+    Each fluxpad gets its own FluxpadSession, so operations on different fluxpads run in parallel"""
+
+    LISTEN_PERIOD_S = FluxpadListener.LISTEN_PERIOD_S
+    HOTPLUG_RESCAN_PERIOD_S = FluxpadListener.HOTPLUG_RESCAN_PERIOD_S
+
+    def __init__(self, on_connect: Optional[Callable[[str, FluxpadSession], None]] = None, on_disconnect: Optional[Callable[[str], None]] = None, use_hotplug: bool = True) -> None:
+        self._manager_thread: Optional[threading.Thread] = None
+        self._stop_request = threading.Event()
+        self._sessions: Dict[str, FluxpadSession] = dict()
+        self._sessions_lock = threading.Lock()
+        self._on_connect_callback = on_connect
+        self._on_disconnect_callback = on_disconnect
+        self._use_hotplug = use_hotplug
+        self._monitor: Optional[hotplug.TtyEventMonitor] = None
+
+    def start(self):
+        """Pick up the fluxpads already attached and start watching for changes"""
+        logging.debug("Starting manager")
+        self._stop_request.clear()
+        if self._use_hotplug:
+            self._monitor = hotplug.TtyEventMonitor.create()
+        self.rescan()
+        self._manager_thread = threading.Thread(target=self._worker, name="fluxpadmanager", daemon=True)
+        self._manager_thread.start()
+
+    def stop(self):
+        """Stop watching and close every session"""
+        logging.debug("Stopping manager")
+        if self._manager_thread is not None and self._manager_thread.is_alive():
+            self._stop_request.set()
+            if self._monitor is not None:
+                self._monitor.wake()
+            self._manager_thread.join(timeout=1.0)
+            assert self._manager_thread.is_alive() == False, "Manager thread not stopped"
+            self._manager_thread = None
+        if self._monitor is not None:
+            self._monitor.close()
+            self._monitor = None
+        with self._sessions_lock:
+            sessions = self._sessions
+            self._sessions = dict()
+        for serial_number, session in sessions.items():
+            self._disconnect(serial_number, session)
+
+    @property
+    def sessions(self) -> Dict[str, FluxpadSession]:
+        """Sessions of the attached fluxpads keyed by serial number"""
+        with self._sessions_lock:
+            return dict(self._sessions)
+
+    def get_session(self, serial_number: str) -> Optional[FluxpadSession]:
+        with self._sessions_lock:
+            return self._sessions.get(serial_number)
+
+    def submit_all(self, fn: Callable[..., T], *args, **kwargs) -> Dict[str, concurrent.futures.Future]:
+        """Queue fn(fluxpad, *args, **kwargs) on every attached fluxpad, returns futures keyed by serial number"""
+        futures = dict()
+        for serial_number, session in self.sessions.items():
+            try:
+                futures[serial_number] = session.submit(fn, session.fluxpad, *args, **kwargs)
+            except ConnectionError as e:
+                futures[serial_number] = concurrent.futures.Future()
+                futures[serial_number].set_exception(e)
+        return futures
+
+    def run_all(self, fn: Callable[..., T], *args, **kwargs) -> Dict[str, T]:
+        """Run fn(fluxpad, *args, **kwargs) on every attached fluxpad in parallel and wait for the results.
+        Raises the first error once every fluxpad is done"""
+        futures = self.submit_all(fn, *args, **kwargs)
+        concurrent.futures.wait(futures.values())
+        return {serial_number: future.result() for serial_number, future in futures.items()}
+
+    def rescan(self):
+        """Compare the attached fluxpads against the sessions and fire connect/disconnect events for the difference"""
+        ports = find_fluxpad_ports()
+        with self._sessions_lock:
+            # A fluxpad that comes back on a different port is a disconnect and a reconnect,
+            # one whose port failed to open is dropped so it gets another try
+            removed = {serial_number: session for serial_number, session in self._sessions.items()
+                       if ports.get(serial_number) != session.fluxpad.port.port or session.open_error is not None}
+            for serial_number in removed:
+                del self._sessions[serial_number]
+            added = dict()
+            for serial_number, port in ports.items():
+                if serial_number not in self._sessions:
+                    added[serial_number] = FluxpadSession(Fluxpad(port, serial_number))
+                    self._sessions[serial_number] = added[serial_number]
+
+        for serial_number, session in removed.items():
+            self._disconnect(serial_number, session)
+        for serial_number, session in added.items():
+            logging.info(f"Fluxpad {serial_number} connected on port {session.fluxpad.port.port}")
+            session.start()
+            if self._on_connect_callback is not None:
+                try:
+                    self._on_connect_callback(serial_number, session)
+                except Exception:
+                    logging.error("on_connect callback error", exc_info=1)
+
+    def _disconnect(self, serial_number: str, session: FluxpadSession):
+        if session.open_error is not None:
+            logging.info(f"Fluxpad {serial_number} dropped, its port failed to open")
+        else:
+            logging.info(f"Fluxpad {serial_number} disconnected")
+        session.stop()
+        if self._on_disconnect_callback is not None:
+            try:
+                self._on_disconnect_callback(serial_number)
+            except Exception:
+                logging.error("on_disconnect callback error", exc_info=1)
+
+    def _worker(self):
+        while True:
+            if self._monitor is None:
+                if self._stop_request.wait(timeout=self.LISTEN_PERIOD_S):
+                    break
+            else:
+                # Every kernel uevent wakes the monitor, only rescan for a tty event or once the rescan period runs out
+                self._monitor.wait_for_tty_event(self.HOTPLUG_RESCAN_PERIOD_S, self._stop_request)
+                if self._stop_request.is_set():
+                    break
+
+            try:
+                self.rescan()
+            except Exception:
+                logging.error("Manager worker error", exc_info=1)
+        logging.debug("Manager thread stopped")
+
+
 # class DigitalSettings:
 #     MESSAGE_KEY_LIST = [
 #         MessageKey.ACTUATE_DEBOUNCE,
@@ -735,21 +1316,35 @@ class FluxpadListener():
 
 class FluxpadSettings:
 
-    KEY_SETTINGS_KEY = "key_settings"
-    RGB_SETTINGS_KEY = "rgb_settings"
-    
+    KEY_SETTINGS_KEY = settings_schema.KEY_SETTINGS_KEY
+    RGB_SETTINGS_KEY = settings_schema.RGB_SETTINGS_KEY
+
+    # Message keys that address a message rather than hold a setting
+    ADDRESS_KEYS = (MessageKey.COMMAND, MessageKey.TOKEN, MessageKey.KEY_ID)
+
+    # Settings message of every key id
+    KEY_MESSAGE_TYPES = (
+        DigitalSettingsMessage,
+        DigitalSettingsMessage,
+        AnalogSettingsMessage,
+        AnalogSettingsMessage,
+        AnalogSettingsMessage,
+        EncoderSettingsMessage,
+        EncoderSettingsMessage,
+    )
+    FILE_SCHEMA = settings_schema.SettingsSchema(KEY_MESSAGE_TYPES, RGBSettingsMessage)
+
     def __init__(self) -> None:
         self.key_settings_list: List[Union[EncoderSettingsMessage, AnalogSettingsMessage, DigitalSettingsMessage]] = [
-            DigitalSettingsMessage(),
-            DigitalSettingsMessage(),
-            AnalogSettingsMessage(),
-            AnalogSettingsMessage(),
-            AnalogSettingsMessage(),
-            EncoderSettingsMessage(),
-            EncoderSettingsMessage(),
+            message_type() for message_type in self.KEY_MESSAGE_TYPES
         ]
         self.rgb_settings = RGBSettingsMessage()
 
+        # Shadow copy of what the fluxpad identified by _device_id last reported or acknowledged,
+        # one entry per key followed by RGB, None where unknown
+        self._device_id: Optional[str] = None
+        self._device_state: List[Optional[dict]] = [None] * (len(self.key_settings_list) + 1)
+
     def _set_key_ids(self):
         key_id = 0
         for key_settings in self.key_settings_list:
@@ -759,81 +1354,208 @@ class FluxpadSettings:
     def get_version(self, fluxpad: Fluxpad):
         return fluxpad.get_version()
 
+    def _all_settings(self) -> List[AnyMessage]:
+        """All settings messages, in the same order as the device state"""
+        return [*self.key_settings_list, self.rgb_settings]
+
+    def invalidate_device_state(self):
+        """Forget the last known fluxpad state so the next save writes everything"""
+        self._device_id = None
+        self._device_state = [None] * len(self._device_state)
+
+    @staticmethod
+    def _get_device_id(fluxpad: Fluxpad) -> str:
+        """Serial number of the fluxpad, another fluxpad can show up on the same port.
+        Falls back to the port when the serial number isn't known"""
+        return fluxpad.serial_number or fluxpad.port.port
+
+    def _use_device(self, fluxpad: Fluxpad):
+        """Invalidate the device state if it belongs to a different fluxpad"""
+        if self._device_id != self._get_device_id(fluxpad):
+            self.invalidate_device_state()
+            self._device_id = self._get_device_id(fluxpad)
+
+    def assume_device_state(self, fluxpad: Fluxpad):
+        """Take these settings as what the given fluxpad has, when that is known without reading it back"""
+        self._use_device(fluxpad)
+        self._device_state = [self.get_setting_values(settings) for settings in self._all_settings()]
+
+    def matches_device_state(self, fluxpad: Fluxpad) -> bool:
+        """Whether every setting is known to be what the given fluxpad has"""
+        if self._device_id != self._get_device_id(fluxpad):
+            return False
+        return all(device_values is not None and not self.get_changed_values(settings, device_values)
+                   for settings, device_values in zip(self._all_settings(), self._device_state))
+
+    @classmethod
+    def get_setting_values(cls, message: AnyMessage) -> dict:
+        """Get the setting values of a message without command, token and key id"""
+        return {key: value for key, value in message.data.items() if key not in cls.ADDRESS_KEYS}
+
+    @staticmethod
+    def is_same_value(value1, value2) -> bool:
+        """Compare two setting values the way the fluxpad stores them, floats are stored as Q22.10 fixed point"""
+        if isinstance(value1, float) or isinstance(value2, float):
+            return int(value1 * 1024) == int(value2 * 1024)
+        return value1 == value2
+
+    @classmethod
+    def get_changed_values(cls, message: AnyMessage, device_values: Optional[dict]) -> dict:
+        """Get the setting values of a message that differ from the given device values,
+        all of them if the device values are unknown"""
+        values = cls.get_setting_values(message)
+        if device_values is None:
+            return values
+        return {key: value for key, value in values.items() if key not in device_values or not cls.is_same_value(value, device_values[key])}
+
+    @staticmethod
+    def _submit_or_fail(submit_request: Callable[[AnyMessage], concurrent.futures.Future], message: AnyMessage) -> concurrent.futures.Future:
+        """Submit a request, returns an already failed future if it couldn't be sent"""
+        try:
+            return submit_request(message)
+        except Exception as e:
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+            return future
+
     def load_from_keypad(self, fluxpad: Fluxpad):
         """Load all settings from the given connected fluxpad"""
 
         if not fluxpad.port.is_open:
             raise ConnectionError("Fluxpad not connected")
-        
+
+        self._use_device(fluxpad)
+
+        # Request every field of every key
         for key_settings in self.key_settings_list:
+            key_settings.set_zeros()
+        self._set_key_ids()
+        self.rgb_settings.set_zeros()
+
+        with fluxpad.pipelined():
+            # Send all read requests up front so they are in flight at the same time
+            key_futures = [self._submit_or_fail(fluxpad.submit_read_request, key_settings) for key_settings in self.key_settings_list]
+            rgb_future = self._submit_or_fail(fluxpad.submit_read_request, self.rgb_settings)
+
+            for key_settings, key_future in zip(self.key_settings_list, key_futures):
+                try:
+                    # Read Settings
+                    response = fluxpad.wait_for_response(key_future)
+
+                    # Check all requested keys exist
+                    assert set(response.data.keys()) == set(key_settings.data.keys()), f"Difference: {set(response.data.keys()).symmetric_difference(set(key_settings.data.keys()))}"
+                    logging.debug(f"Got settings for Key ID {key_settings.key_id}")
+                except Exception:
+                    logging.error(f"Failed to get settings for Key ID {key_settings.key_id} with message {key_settings.data}", exc_info=True)
+                else:
+                    key_settings.data = response.data.copy()
+                    self._device_state[key_settings.key_id] = self.get_setting_values(key_settings)
+
             try:
-                # Read Settings
-                key_settings.set_zeros()
-                self._set_key_ids()
-                response = fluxpad.send_read_request(key_settings)
+                # Read RGB Settings
+                response = fluxpad.wait_for_response(rgb_future)
 
                 # Check all requested keys exist
-                assert set(response.data.keys()) == set(key_settings.data.keys()), f"Difference: {set(response.data.keys()).symmetric_difference(set(key_settings.data.keys()))}"
-                logging.debug(f"Got settings for Key ID {key_settings.key_id}")
+                assert set(response.data.keys()) == set(self.rgb_settings.data.keys()), f"Difference: {set(response.data.keys()).symmetric_difference(set(self.rgb_settings.data.keys()))}"
+                logging.debug("Got RGB settings")
             except Exception:
-                logging.error(f"Failed to get settings for Key ID {key_settings.key_id} with message {key_settings.data}", exc_info=True)
+                logging.error(f"Failed to get RGB settings {self.rgb_settings.data}", exc_info=True)
             else:
-                key_settings.data = response.data.copy()
-
-        try:
-            # Read RGB Settings
-            self.rgb_settings.set_zeros()
-            response = fluxpad.send_read_request(self.rgb_settings)
-
-            # Check all requested keys exist
-            assert set(response.data.keys()) == set(self.rgb_settings.data.keys()), f"Difference: {set(response.data.keys()).symmetric_difference(set(self.rgb_settings.data.keys()))}"
-            logging.debug("Got RGB settings")
-        except Exception:
-            logging.error(f"Failed to get RGB settings {self.rgb_settings.data}", exc_info=True)
-        else:
-            self.rgb_settings.data = response.data.copy()
+                self.rgb_settings.data = response.data.copy()
+                self._device_state[-1] = self.get_setting_values(self.rgb_settings)
 
-    def save_to_fluxpad(self, fluxpad: Fluxpad, include_calibration: bool = False):
-        """Save all settings to the given connected fluxpad"""
+    def save_to_fluxpad(self, fluxpad: Fluxpad, include_calibration: bool = False, force: bool = False) -> int:
+        """Save all settings to the given connected fluxpad.
+        Only the values that differ from the last known fluxpad state are written unless force is set.
+        Returns the number of messages written"""
         if not fluxpad.port.is_open:
             raise ConnectionError("Fluxpad not connected")
-        
-        for current_key_settings in self.key_settings_list:
-            key_settings = current_key_settings
-            try:
-                assert isinstance(key_settings.key_id, int)  # check key id exists
-                response = fluxpad.send_write_request(key_settings)
-                logging.debug(f"Wrote settings for Key ID {key_settings.key_id}")
-            except Exception:
-                logging.error(f"Failed to write settings for Key ID {key_settings.key_id} with message {key_settings.data}", exc_info=True)
 
-        rgb_settings = self.rgb_settings
-        try:
-            response = fluxpad.send_write_request(rgb_settings)
-            logging.debug(f"Wrote rgb settings")
-        except Exception:
-            logging.error(f"Failed to write rgb settings with message {rgb_settings.data}", exc_info=True)
+        if force:
+            self.invalidate_device_state()
+        self._use_device(fluxpad)
+
+        # Build minimal write messages holding only the changed values
+        write_messages: List[Tuple[int, AnyMessage, dict]] = []
+        for index, settings in enumerate(self._all_settings()):
+            changed_values = self.get_changed_values(settings, self._device_state[index])
+            if not changed_values:
+                continue
+            write_message = type(settings)(dict(changed_values))
+            if MessageKey.KEY_ID in settings.data:
+                write_message.data[MessageKey.KEY_ID] = settings.data[MessageKey.KEY_ID]
+            write_messages.append((index, write_message, changed_values))
+
+        if not write_messages:
+            logging.info("Fluxpad already has these settings, nothing to write")
+            return 0
+
+        def submit_write_message(write_message: AnyMessage):
+            if not isinstance(write_message, RGBSettingsMessage):
+                assert isinstance(write_message.key_id, int)  # check key id exists
+            return fluxpad.submit_write_request(write_message)
+
+        with fluxpad.pipelined():
+            # Send all write requests up front so they are in flight at the same time
+            futures = [self._submit_or_fail(submit_write_message, write_message) for _, write_message, _ in write_messages]
+
+            for (index, write_message, changed_values), future in zip(write_messages, futures):
+                name = "rgb settings" if isinstance(write_message, RGBSettingsMessage) else f"settings for Key ID {write_message.data.get(MessageKey.KEY_ID)}"
+                try:
+                    fluxpad.wait_for_response(future)
+                    logging.debug(f"Wrote {name}: {changed_values}")
+                except Exception:
+                    # The fluxpad may or may not have applied it, write everything next time
+                    self._device_state[index] = None
+                    logging.error(f"Failed to write {name} with message {write_message.data}", exc_info=True)
+                else:
+                    if self._device_state[index] is None:
+                        self._device_state[index] = dict()
+                    self._device_state[index].update(changed_values)
+        return len(write_messages)
+
+    def verify_fluxpad(self, fluxpad: Fluxpad) -> List[str]:
+        """Read the settings back from the given connected fluxpad and compare them to these settings.
+        Returns a description of every mismatch, empty if the fluxpad matches"""
+        read_back = FluxpadSettings()
+        read_back.load_from_keypad(fluxpad)
+
+        mismatches = []
+        for index, (settings, device_values) in enumerate(zip(self._all_settings(), read_back._device_state)):
+            name = "RGB settings" if index == len(self.key_settings_list) else f"Key ID {index}"
+            if device_values is None:
+                mismatches.append(f"{name}: failed to read back")
+                continue
+            for key, value in self.get_changed_values(settings, device_values).items():
+                mismatches.append(f"{name}: {key} is {device_values.get(key)}, expected {value}")
+
+        # What was read back is now the known fluxpad state
+        self._use_device(fluxpad)
+        self._device_state = read_back._device_state
+        return mismatches
         
-    def load_from_file(self, path: pathlib.Path):
-        """Load all settings from the given file"""
-        try:
-            with path.open("r") as f:
-                root_json = json.load(f)
-        except Exception:
-            logging.error(f"Failed to load settings from {path}", exc_info=True)
-            return
+    def load_from_dict(self, root_dict: dict):
+        """Load all settings from a dict laid out like a settings file"""
+        for json_object in root_dict[self.KEY_SETTINGS_KEY]:
+            self.key_settings_list[json_object[MessageKey.KEY_ID]].data = dict(json_object)
+        self.rgb_settings.data = dict(root_dict[self.RGB_SETTINGS_KEY])
+
+    def to_dict(self) -> dict:
+        """All settings as a dict laid out like a settings file of the current version"""
+        root_dict = dict()
+        root_dict[settings_schema.VERSION_KEY] = settings_schema.SCHEMA_VERSION
+        root_dict[self.KEY_SETTINGS_KEY] = [{MessageKey.KEY_ID: key_id, **self.get_setting_values(key_settings)}
+                                            for key_id, key_settings in enumerate(self.key_settings_list)]
+        root_dict[self.RGB_SETTINGS_KEY] = self.get_setting_values(self.rgb_settings)
+        return root_dict
 
-        try:
-            for json_object in root_json[self.KEY_SETTINGS_KEY]:
-                self.key_settings_list[json_object[MessageKey.KEY_ID]].data = json_object
-        except Exception:
-            logging.error(f"Failed to parse key settings from {path}", exc_info=True)
+    def load_from_file(self, path: pathlib.Path):
+        """Load all settings from the given file, older versions are migrated.
+        Raises SettingsFileError listing every invalid setting, nothing is loaded then"""
+        with path.open("r") as f:
+            root_json = json.load(f)
+        self.load_from_dict(self.FILE_SCHEMA.load(root_json, path))
 
-        try:
-            self.rgb_settings.data = root_json[self.RGB_SETTINGS_KEY]
-        except Exception:
-            logging.error(f"Failed to parse rgb settings from {path}", exc_info=True)
-    
     def save_to_file(self, path: pathlib.Path):
         """Save all settings to the given file"""
         if path.exists():
@@ -843,13 +1565,8 @@ class FluxpadSettings:
             path.parent.mkdir(parents=True, exist_ok=True)
             path.touch(exist_ok=True)
 
-        # Construct master json to store all settings
-        root_dict = dict()
-        root_dict[self.KEY_SETTINGS_KEY] = [key_settings.data for key_settings in self.key_settings_list]
-        root_dict[self.RGB_SETTINGS_KEY] = self.rgb_settings.data
-        
         with path.open("w") as f:
-            json.dump(root_dict, f, indent=4)
+            json.dump(self.to_dict(), f, indent=4)
 
 
 # FOR TESTING
@@ -0,0 +1,105 @@
+import logging
+import select
+import socket
+import struct
+import sys
+import threading
+import time
+from typing import Optional
+
+# Netlink protocol and multicast groups for device uevents, see linux/netlink.h
+NETLINK_KOBJECT_UEVENT = 15
+KERNEL_EVENT_GROUP = 1
+UDEV_EVENT_GROUP = 2
+
+UEVENT_BUFFER_SIZE = 64 * 1024
+
+# udev monitor header, see monitor_netlink_header in libudev
+UDEV_HEADER_PREFIX = b"libudev\x00"
+UDEV_PROPERTIES_OFFSET_POS = 16
+
+
+class TtyEventMonitor:
+    """Watches for serial devices being added or removed on Linux.
+    Listens to kernel and udev uevents on a netlink socket so waiting costs nothing while idle"""
+
+    def __init__(self) -> None:
+        self._uevent_socket = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM, NETLINK_KOBJECT_UEVENT)
+        try:
+            self._uevent_socket.bind((0, KERNEL_EVENT_GROUP | UDEV_EVENT_GROUP))
+            self._uevent_socket.setblocking(False)
+        except OSError:
+            self._uevent_socket.close()
+            raise
+        # Written to from other threads to wake up wait()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        self._wakeup_reader.setblocking(False)
+        self._wakeup_writer.setblocking(False)
+
+    @classmethod
+    def create(cls) -> Optional["TtyEventMonitor"]:
+        """Create a monitor, returns None where uevents aren't available (not Linux, sandboxed, ...)"""
+        if not sys.platform.startswith("linux"):
+            return None
+        try:
+            return cls()
+        except OSError:
+            logging.info("Netlink uevents not available", exc_info=True)
+            return None
+
+    @staticmethod
+    def is_tty_event(uevent: bytes) -> bool:
+        """Check if a raw uevent is a tty device being added or removed"""
+        if uevent.startswith(UDEV_HEADER_PREFIX):
+            # udev events have a binary header in front of the properties
+            properties_offset, = struct.unpack_from("=I", uevent, UDEV_PROPERTIES_OFFSET_POS)
+            uevent = uevent[properties_offset:]
+        # Kernel events are "action@devpath" followed by the same NUL separated properties
+        fields = uevent.split(b"\x00")
+        return b"SUBSYSTEM=tty" in fields and (b"ACTION=add" in fields or b"ACTION=remove" in fields)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Block until a tty is added or removed, the timeout runs out, or wake() is called.
+        Returns True if there was a tty event"""
+        readable, _, _ = select.select([self._uevent_socket, self._wakeup_reader], [], [], timeout)
+        if self._wakeup_reader in readable:
+            try:
+                while self._wakeup_reader.recv(64):
+                    pass
+            except BlockingIOError:
+                pass
+
+        # Drain everything waiting, a single plug in sends a burst of events
+        has_tty_event = False
+        while True:
+            try:
+                uevent = self._uevent_socket.recv(UEVENT_BUFFER_SIZE)
+            except BlockingIOError:
+                break
+            if self.is_tty_event(uevent):
+                has_tty_event = True
+        return has_tty_event
+
+    def wait_for_tty_event(self, timeout: float, stop_request: threading.Event) -> bool:
+        """Block until a tty is added or removed, the timeout runs out, or stop_request is set.
+        Unlike wait(), other uevents don't end the wait. Returns True if there was a tty event"""
+        deadline_s = time.monotonic() + timeout
+        while not stop_request.is_set():
+            remaining_s = deadline_s - time.monotonic()
+            if remaining_s <= 0:
+                break
+            if self.wait(timeout=remaining_s):
+                return True
+        return False
+
+    def wake(self):
+        """Make a blocked wait() return, safe to call from any thread"""
+        try:
+            self._wakeup_writer.send(b"\x00")
+        except BlockingIOError:
+            pass  # Already plenty of wake ups waiting
+
+    def close(self):
+        self._uevent_socket.close()
+        self._wakeup_reader.close()
+        self._wakeup_writer.close()
@@ -0,0 +1,219 @@
+"""Fit a per key ADC to distance lookup table from a slow sweep over the full key travel.
+
+The firmware scales every reading so the calibrated up and down positions land on
+REFERENCE_UP_ADC and REFERENCE_DOWN_ADC, then looks the height up in the 17 point
+adc_to_dist_lut. That table is shared by every key, so differences between magnets and
+springs show up as height errors between the two calibrated points. This fits the table to
+one key from a recording of it being pushed slowly from rest to the bottom.
+
+The travel at every sample comes from a CSV of jig positions (time_s, travel_mm, time from the
+start of the recording) if one is given, otherwise the key is assumed to move at constant
+speed from leaving rest to bottoming out.
+
+usage: python lut_fit.py sweep.fluxlog [--key 2 3 4] [--positions jig.csv] [--output lut.json]
+"""
+import argparse
+import json
+import pathlib
+import sys
+from typing import List, NamedTuple, Optional, Sequence
+
+import numpy as np
+
+import calibration
+import fixed_point
+import fluxlog
+
+TRAVEL_MM = fixed_point.REFERENCE_UP_MM - fixed_point.REFERENCE_DOWN_MM
+
+# How strongly table entries are pulled towards the stock table, in samples.
+# Only matters for entries the sweep has few or no samples around
+STOCK_WEIGHT = 1.0
+
+# A smoothed reading has left rest or reached the bottom once it's this many plateau standard deviations
+# from it, or MIN_PLATEAU_BAND counts if that's more
+PLATEAU_EDGE_STD_DEVS = 4.0
+SMOOTHING_SAMPLES = 8
+
+TABLE_KNOTS_ADC = np.arange(fixed_point.LUT_SIZE) * fixed_point.LUT_STEP
+
+
+class Sweep(NamedTuple):
+    raw_adc: np.ndarray  # ADC counts of every sample
+    height_mm: np.ndarray  # Where the key actually was at every sample
+    calibration_down: float  # ADC counts at the bottom, from the sweep
+    calibration_up: float  # ADC counts at rest, from the sweep
+
+
+class FitError(NamedTuple):
+    rms_mm: float
+    max_mm: float
+
+
+class LutFit(NamedTuple):
+    key_id: int
+    calibration_down: float
+    calibration_up: float
+    table_mm: np.ndarray  # (LUT_SIZE,) replacement for adc_to_dist_lut
+    stock_error: FitError  # Of the firmware's own table on the sweep
+    fitted_error: FitError
+
+
+def _smooth(values: np.ndarray) -> np.ndarray:
+    kernel = np.ones(SMOOTHING_SAMPLES) / SMOOTHING_SAMPLES
+    padded = np.pad(values, (SMOOTHING_SAMPLES // 2, SMOOTHING_SAMPLES - 1 - SMOOTHING_SAMPLES // 2), mode="edge")
+    return np.convolve(padded, kernel, mode="valid")
+
+
+def load_sweep(path: pathlib.Path, key_id: int, positions: Optional[np.ndarray] = None) -> Sweep:
+    """Raw readings of one key from a .fluxlog recording of a sweep and where the key was at each one.
+    positions is an (n, 2) array of time_s and travel_mm from a jig, if there is one"""
+    with fluxlog.FluxlogReader(path) as reader:
+        assert key_id in reader.key_ids, f"Key {key_id} not in recording, it has {reader.key_ids}"
+        channel = reader.key_ids.index(key_id)
+        records = reader.records[np.isfinite(reader.records["raw_adc"][:, channel])]
+        raw_adc = records["raw_adc"][:, channel].astype(np.float64)
+        if len(records) and (records["device_time_us"] != fluxlog.NO_DEVICE_TIME).all():
+            time_s = (records["device_time_us"] - records["device_time_us"][0]) / 1e6
+        else:
+            time_s = records["host_time_s"] - records["host_time_s"][0] if len(records) else np.zeros(0)
+
+    plateaus = calibration.find_plateaus(raw_adc)
+    assert plateaus.up is not None and plateaus.down is not None, "Sweep has to start at rest and reach the bottom"
+    calibration_up = plateaus.up.mean
+    calibration_down = plateaus.down.mean
+
+    if positions is not None:
+        in_range = (time_s >= positions[0, 0]) & (time_s <= positions[-1, 0])
+        travel_mm = np.interp(time_s[in_range], positions[:, 0], positions[:, 1])
+        return Sweep(raw_adc[in_range], fixed_point.REFERENCE_UP_MM - travel_mm, calibration_down, calibration_up)
+
+    # Constant speed from the last sample at rest to the first one at the bottom
+    smoothed = _smooth(raw_adc)
+    up_edge = calibration_up - max(PLATEAU_EDGE_STD_DEVS * plateaus.up.standard_deviation, calibration.MIN_PLATEAU_BAND)
+    down_edge = calibration_down + max(PLATEAU_EDGE_STD_DEVS * plateaus.down.standard_deviation, calibration.MIN_PLATEAU_BAND)
+    end = int(np.argmax(smoothed <= down_edge))
+    start = int(np.flatnonzero(smoothed[:end] >= up_edge)[-1])
+    travel_mm = TRAVEL_MM * (time_s[start:end + 1] - time_s[start]) / (time_s[end] - time_s[start])
+    return Sweep(raw_adc[start:end + 1], fixed_point.REFERENCE_UP_MM - travel_mm, calibration_down, calibration_up)
+
+
+def load_positions(path: pathlib.Path) -> np.ndarray:
+    """Jig positions CSV with a time_s,travel_mm header"""
+    positions = np.genfromtxt(path, delimiter=",", names=True)
+    return np.column_stack([positions["time_s"], positions["travel_mm"]])
+
+
+def calibrated_counts(raw_adc: np.ndarray, calibration_down: float, calibration_up: float) -> np.ndarray:
+    """Readings scaled the way AnalogSwitch::apply_calibration does, as floats clamped to the table"""
+    scale = (fixed_point.REFERENCE_UP_ADC - fixed_point.REFERENCE_DOWN_ADC) / (calibration_up - calibration_down)
+    counts = fixed_point.REFERENCE_DOWN_ADC + (np.asarray(raw_adc, dtype=np.float64) - calibration_down) * scale
+    return np.clip(counts, 0, TABLE_KNOTS_ADC[-1])
+
+
+def isotonic(values: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    """Closest non decreasing sequence to values in the weighted least squares sense (pool adjacent violators)"""
+    blocks: List[List[float]] = []  # mean, weight, length
+    for value, weight in zip(values.tolist(), weights.tolist()):
+        blocks.append([value, weight, 1])
+        while len(blocks) > 1 and blocks[-2][0] > blocks[-1][0]:
+            mean, weight, length = blocks.pop()
+            previous = blocks[-1]
+            total = previous[1] + weight
+            previous[0] = (previous[0] * previous[1] + mean * weight) / total if total else (previous[0] + mean) / 2
+            previous[1] = total
+            previous[2] += length
+    return np.concatenate([np.full(length, mean) for mean, _, length in blocks])
+
+
+def fit_table(counts: np.ndarray, height_mm: np.ndarray, stock_weight: float = STOCK_WEIGHT) -> np.ndarray:
+    """Monotonic table of LUT_SIZE heights whose linear interpolation best matches the samples.
+    Interpolation is linear in the table entries, so this is a small least squares problem"""
+    position = np.asarray(counts, dtype=np.float64) / fixed_point.LUT_STEP
+    index = np.clip(np.floor(position).astype(np.intp), 0, fixed_point.LUT_SIZE - 2)
+    fraction = position - index
+    basis = np.zeros((len(position), fixed_point.LUT_SIZE))
+    rows = np.arange(len(position))
+    basis[rows, index] = 1 - fraction
+    basis[rows, index + 1] += fraction
+
+    stock = np.asarray(fixed_point.ADC_TO_DIST_LUT_MM)
+    normal = basis.T @ basis + stock_weight * np.eye(fixed_point.LUT_SIZE)
+    table = np.linalg.solve(normal, basis.T @ np.asarray(height_mm, dtype=np.float64) + stock_weight * stock)
+    return isotonic(table, np.diag(normal))
+
+
+def table_error(sweep: Sweep, table_mm: Optional[Sequence[float]] = None) -> FitError:
+    """Height error over the sweep of what the firmware would compute with table_mm, or its own table"""
+    height = fixed_point.raw_adc_to_height_mm(sweep.raw_adc, sweep.calibration_down, sweep.calibration_up, table_mm)
+    error = np.abs(height - sweep.height_mm)
+    return FitError(float(np.sqrt(np.mean(error ** 2))), float(error.max()))
+
+
+def fit_key(sweep: Sweep, key_id: int) -> LutFit:
+    counts = calibrated_counts(sweep.raw_adc, sweep.calibration_down, sweep.calibration_up)
+    table_mm = fit_table(counts, sweep.height_mm)
+    return LutFit(key_id, sweep.calibration_down, sweep.calibration_up, table_mm, table_error(sweep), table_error(sweep, table_mm))
+
+
+def format_c_table(table_mm: Sequence[float], name: str = "adc_to_dist_lut") -> str:
+    """Table as a C initializer laid out like the one in AnalogSwitch.h"""
+    lines = [f"const q22_10_t {name}[] = {{"]
+    for knot, value in zip(TABLE_KNOTS_ADC.tolist(), table_mm):
+        lines.append(f"    {f'FLOAT_TO_Q22_10({value:.3f}f),':<26}// {knot}")
+    lines.append("};")
+    return "\n".join(lines)
+
+
+def save_fits(fits: Sequence[LutFit], path: pathlib.Path):
+    data = {"keys": [{
+        "key_id": fit.key_id,
+        "calibration_down": fit.calibration_down,
+        "calibration_up": fit.calibration_up,
+        "adc_to_dist_lut_mm": [round(value, 4) for value in fit.table_mm.tolist()],
+        "stock_rms_mm": fit.stock_error.rms_mm,
+        "fitted_rms_mm": fit.fitted_error.rms_mm,
+    } for fit in fits]}
+    path.write_text(json.dumps(data, indent=4))
+
+
+def format_report(fits: Sequence[LutFit]) -> str:
+    lines = [f"{'key':>4} {'cal down':>9} {'cal up':>9} {'stock rms':>10} {'stock max':>10} {'fit rms':>10} {'fit max':>10}"]
+    for fit in fits:
+        lines.append(f"{fit.key_id:>4} {fit.calibration_down:>9.1f} {fit.calibration_up:>9.1f} "
+                     f"{fit.stock_error.rms_mm:>10.3f} {fit.stock_error.max_mm:>10.3f} {fit.fitted_error.rms_mm:>10.3f} {fit.fitted_error.max_mm:>10.3f}")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Fit per key ADC to distance tables from recorded sweeps")
+    parser.add_argument("sweep", type=pathlib.Path, help="Recording made with fluxlog.py of keys pushed slowly from rest to the bottom")
+    parser.add_argument("--key", type=int, nargs="+", help="Analog keys in the recording to fit (default every key)")
+    parser.add_argument("--positions", type=pathlib.Path, help="CSV of time_s,travel_mm from the jig, otherwise the sweep is assumed to be at constant speed")
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("lut.json"))
+    args = parser.parse_args(argv)
+
+    with fluxlog.FluxlogReader(args.sweep) as reader:
+        key_ids = args.key or list(reader.key_ids)
+    positions = load_positions(args.positions) if args.positions is not None else None
+
+    fits = []
+    for key_id in key_ids:
+        try:
+            sweep = load_sweep(args.sweep, key_id, positions)
+        except AssertionError as e:
+            print(f"Key {key_id}: {e}", file=sys.stderr)
+            return 1
+        fits.append(fit_key(sweep, key_id))
+
+    print(format_report(fits))
+    for fit in fits:
+        print(f"\n// Key {fit.key_id}, calibrated down {fit.calibration_down:.1f} up {fit.calibration_up:.1f}")
+        print(format_c_table(fit.table_mm, f"adc_to_dist_lut_key{fit.key_id}"))
+    save_fits(fits, args.output)
+    print(f"\nSaved tables to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
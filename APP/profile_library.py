@@ -0,0 +1,251 @@
+"""Library of named settings profiles to switch a fluxpad between.
+
+Every profile is stored as one block per key plus one for the RGB settings. Blocks are named by
+the SHA-256 of their contents, so keys that are set up the same in many profiles are stored once
+and two profiles can be compared by their block hashes without reading them. The index maps
+profile names to their blocks.
+
+Switching loads the profile into the settings the fluxpad was last known to have, so only the
+fields that differ are written.
+
+usage: python profile_library.py list [--directory PATH]
+       python profile_library.py import NAME settings.json [--directory PATH]
+       python profile_library.py export NAME settings.json [--directory PATH]
+       python profile_library.py delete NAME [--directory PATH]
+       python profile_library.py switch NAME [--directory PATH]
+"""
+import argparse
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import sys
+import time
+from typing import Dict, List, NamedTuple, Optional, Union
+
+from fluxpad_interface import Fluxpad, FluxpadSettings, MessageKey, find_fluxpad_ports
+from settings_schema import SettingsFileError
+
+DEFAULT_DIRECTORY = pathlib.Path.home() / ".fluxapp" / "profiles"
+INDEX_VERSION = 1
+
+LOCK_TIMEOUT_S = 5.0
+LOCK_RETRY_PERIOD_S = 0.01
+LOCK_STALE_S = 30.0  # A lock file this old was left behind by a process that died holding it
+
+PathLike = Union[str, pathlib.Path]
+
+
+class Profile(NamedTuple):
+    name: str
+    profile_hash: str  # Of the block hashes in order, equal for profiles with equal settings
+    blocks: List[str]  # Block hash of every key in key id order, then the RGB settings
+    time: float  # Unix time it was saved
+
+
+def _canonical_json(values: dict) -> bytes:
+    return json.dumps(values, sort_keys=True, separators=(",", ":")).encode()
+
+
+def _messages(settings: FluxpadSettings) -> list:
+    """Settings messages in block order"""
+    return [*settings.key_settings_list, settings.rgb_settings]
+
+
+def _write_atomic(path: pathlib.Path, data: bytes):
+    temporary_path = path.with_suffix(".tmp")
+    temporary_path.write_bytes(data)
+    os.replace(temporary_path, path)
+
+
+class ProfileLibrary:
+    """Profiles in a directory, blocks/ holds the deduplicated settings and index.json the names.
+    Several processes can share a library, changes are made holding index.lock on the index as it is on disk"""
+
+    def __init__(self, directory: PathLike = DEFAULT_DIRECTORY) -> None:
+        self.directory = pathlib.Path(directory)
+        self.blocks_directory = self.directory / "blocks"
+        self.blocks_directory.mkdir(parents=True, exist_ok=True)
+        self.index_path = self.directory / "index.json"
+        self.lock_path = self.directory / "index.lock"
+        self._profiles: Dict[str, Profile] = dict()
+        self._blocks: Dict[str, dict] = dict()  # Blocks read so far, they never change
+        self._read_index()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        """Hold the lock file of the library for a read-modify-write of the index"""
+        deadline_s = time.monotonic() + LOCK_TIMEOUT_S
+        while True:
+            try:
+                lock_fd = os.open(self.lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+                break
+            except FileExistsError:
+                pass
+            try:
+                if time.time() - self.lock_path.stat().st_mtime > LOCK_STALE_S:
+                    logging.warning(f"Removing stale profile library lock {self.lock_path}")
+                    self.lock_path.unlink(missing_ok=True)
+                    continue
+            except FileNotFoundError:
+                continue  # Just released
+            if time.monotonic() > deadline_s:
+                raise TimeoutError(f"Profile library {self.directory} is locked, remove {self.lock_path} if no other fluxapp is running")
+            time.sleep(LOCK_RETRY_PERIOD_S)
+        try:
+            os.write(lock_fd, str(os.getpid()).encode())
+            os.close(lock_fd)
+            yield
+        finally:
+            self.lock_path.unlink(missing_ok=True)
+
+    def _read_index(self):
+        """Pick up the index as it is on disk, other processes may have changed it"""
+        if not self.index_path.exists():
+            self._profiles = dict()
+            return
+        root = json.loads(self.index_path.read_text())
+        assert root["version"] == INDEX_VERSION, f"Unsupported profile index version {root['version']}"
+        self._profiles = {name: Profile(name, **profile) for name, profile in root["profiles"].items()}
+
+    def _save_index(self):
+        root = {"version": INDEX_VERSION, "profiles": {name: profile._asdict() for name, profile in self._profiles.items()}}
+        for profile in root["profiles"].values():
+            del profile["name"]
+        _write_atomic(self.index_path, json.dumps(root, indent=4).encode())
+
+    def _block_path(self, block_hash: str) -> pathlib.Path:
+        return self.blocks_directory / f"{block_hash}.json"
+
+    def _put_block(self, values: dict) -> str:
+        data = _canonical_json(values)
+        block_hash = hashlib.sha256(data).hexdigest()
+        # Checked on disk even if read before, another process may have deleted it since
+        path = self._block_path(block_hash)
+        if not path.exists():
+            _write_atomic(path, data)
+        self._blocks.setdefault(block_hash, values)
+        return block_hash
+
+    def _get_block(self, block_hash: str) -> dict:
+        if block_hash not in self._blocks:
+            self._blocks[block_hash] = json.loads(self._block_path(block_hash).read_bytes())
+        return self._blocks[block_hash]
+
+    def names(self) -> List[str]:
+        return sorted(self._profiles)
+
+    def get(self, name: str) -> Optional[Profile]:
+        return self._profiles.get(name)
+
+    def save(self, name: str, settings: FluxpadSettings) -> Profile:
+        """Save settings as a profile, replacing any profile with the same name"""
+        with self._locked():
+            self._read_index()
+            # Blocks are written holding the lock too, so a delete can't collect them before the index refers to them
+            blocks = [self._put_block(FluxpadSettings.get_setting_values(message)) for message in _messages(settings)]
+            profile_hash = hashlib.sha256("".join(blocks).encode()).hexdigest()
+            self._profiles[name] = Profile(name, profile_hash, blocks, time.time())
+            self._save_index()
+        return self._profiles[name]
+
+    def load_into(self, name: str, settings: FluxpadSettings):
+        """Replace settings with a profile. What the fluxpad is known to have is kept, so saving writes only the differences"""
+        profile = self._profiles[name]
+        assert len(profile.blocks) == len(_messages(settings)), f"Profile {name} has {len(profile.blocks)} blocks"
+        for key_id, (message, block_hash) in enumerate(zip(_messages(settings), profile.blocks)):
+            message.data = dict(self._get_block(block_hash))
+            if key_id < len(settings.key_settings_list):
+                message.data[MessageKey.KEY_ID] = key_id
+
+    def load(self, name: str) -> FluxpadSettings:
+        settings = FluxpadSettings()
+        self.load_into(name, settings)
+        return settings
+
+    def delete(self, name: str):
+        """Delete a profile and the blocks no other profile uses"""
+        with self._locked():
+            self._read_index()
+            profile = self._profiles.pop(name)
+            self._save_index()
+            in_use = {block_hash for other in self._profiles.values() for block_hash in other.blocks}
+            for block_hash in set(profile.blocks) - in_use:
+                self._block_path(block_hash).unlink(missing_ok=True)
+                self._blocks.pop(block_hash, None)
+
+
+def switch_profile(fluxpad: Fluxpad, library: ProfileLibrary, name: str, settings: FluxpadSettings) -> int:
+    """Switch a connected fluxpad to a profile, settings being what it was last loaded with or saved from.
+    Returns the number of messages written"""
+    library.load_into(name, settings)
+    written = settings.save_to_fluxpad(fluxpad)
+    logging.info(f"Switched to profile {name} with {written} messages")
+    return written
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Library of named fluxpad settings profiles")
+    parser.add_argument("--directory", type=pathlib.Path, default=DEFAULT_DIRECTORY)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("list", help="List the profiles")
+    import_parser = subparsers.add_parser("import", help="Add a settings file to the library")
+    import_parser.add_argument("name")
+    import_parser.add_argument("path", type=pathlib.Path)
+    export_parser = subparsers.add_parser("export", help="Write a profile to a settings file")
+    export_parser.add_argument("name")
+    export_parser.add_argument("path", type=pathlib.Path)
+    delete_parser = subparsers.add_parser("delete", help="Delete a profile")
+    delete_parser.add_argument("name")
+    switch_parser = subparsers.add_parser("switch", help="Switch the attached fluxpad to a profile")
+    switch_parser.add_argument("name")
+    args = parser.parse_args(argv)
+
+    library = ProfileLibrary(args.directory)
+    if args.command == "list":
+        for name in library.names():
+            profile = library.get(name)
+            print(f"{name}: {profile.profile_hash[:12]} saved {time.ctime(profile.time)}")
+        return 0
+    if args.command == "import":
+        settings = FluxpadSettings()
+        try:
+            settings.load_from_file(args.path)
+        except SettingsFileError as e:
+            print(e, file=sys.stderr)
+            return 1
+        print(f"Saved {args.name} as {library.save(args.name, settings).profile_hash[:12]}")
+        return 0
+
+    if library.get(args.name) is None:
+        print(f"No profile named {args.name}", file=sys.stderr)
+        return 1
+    if args.command == "export":
+        library.load(args.name).save_to_file(args.path)
+        return 0
+    if args.command == "delete":
+        library.delete(args.name)
+        return 0
+
+    ports = find_fluxpad_ports()
+    if not ports:
+        print("No fluxpads found", file=sys.stderr)
+        return 1
+    serial_number, port = next(iter(ports.items()))
+    fluxpad = Fluxpad(port, serial_number)
+    fluxpad.open()
+    try:
+        # Nothing is known about this fluxpad yet, read it first so only the differences are written
+        settings = FluxpadSettings()
+        settings.load_from_keypad(fluxpad)
+        written = switch_profile(fluxpad, library, args.name, settings)
+    finally:
+        fluxpad.close()
+    print(f"Switched {serial_number} to {args.name}, wrote {written} messages")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,123 @@
+"""Push one settings profile to every attached fluxpad at once.
+
+usage: python provision.py profile.json [--workers N] [--serial SERIAL ...] [--force]
+"""
+import argparse
+import concurrent.futures
+import copy
+import logging
+import pathlib
+import sys
+import time
+from typing import List, NamedTuple, Optional
+
+import fluxpad_interface
+
+DEFAULT_MAX_WORKERS = 8
+
+
+class ProvisionResult(NamedTuple):
+    serial_number: str
+    port: str
+    mismatches: List[str]
+    error: Optional[str]
+    write_s: float
+    verify_s: float
+
+    @property
+    def ok(self):
+        return self.error is None and not self.mismatches
+
+
+def provision_fluxpad(serial_number: str, port: str, profile: fluxpad_interface.FluxpadSettings, force: bool = False) -> ProvisionResult:
+    """Write the profile to a single fluxpad and read it back to verify"""
+    settings = copy.deepcopy(profile)
+    fluxpad = fluxpad_interface.Fluxpad(port, serial_number)
+    write_s = verify_s = 0.0
+    try:
+        fluxpad.open()
+        with fluxpad.pipelined():
+            start_s = time.perf_counter()
+            if not force:
+                # Only write what differs from what the fluxpad already has
+                settings.verify_fluxpad(fluxpad)
+            settings.save_to_fluxpad(fluxpad, force=force)
+            write_s = time.perf_counter() - start_s
+
+            start_s = time.perf_counter()
+            mismatches = settings.verify_fluxpad(fluxpad)
+            verify_s = time.perf_counter() - start_s
+    except Exception as e:
+        logging.error(f"Failed to provision fluxpad {serial_number} on {port}", exc_info=True)
+        return ProvisionResult(serial_number, port, [], f"{type(e).__name__}: {e}", write_s, verify_s)
+    finally:
+        fluxpad.close()
+    return ProvisionResult(serial_number, port, mismatches, None, write_s, verify_s)
+
+
+def provision_all(ports: dict, profile: fluxpad_interface.FluxpadSettings, max_workers: int = DEFAULT_MAX_WORKERS, force: bool = False) -> List[ProvisionResult]:
+    """Provision every fluxpad in ports (port keyed by serial number) concurrently"""
+    if not ports:
+        return []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(max_workers, len(ports)), thread_name_prefix="provision") as executor:
+        futures = [executor.submit(provision_fluxpad, serial_number, port, profile, force) for serial_number, port in ports.items()]
+        return [future.result() for future in futures]
+
+
+def format_results(results: List[ProvisionResult], elapsed_s: float) -> str:
+    """Per device timing and result table"""
+    serial_width = max([len("Serial")] + [len(result.serial_number) for result in results])
+    port_width = max([len("Port")] + [len(result.port) for result in results])
+    lines = [f"{'Serial':<{serial_width}}  {'Port':<{port_width}}  {'Write ms':>9}  {'Verify ms':>9}  Result"]
+    for result in sorted(results, key=lambda result: result.serial_number):
+        if result.error is not None:
+            status = f"ERROR {result.error}"
+        elif result.mismatches:
+            status = f"MISMATCH {'; '.join(result.mismatches)}"
+        else:
+            status = "OK"
+        lines.append(f"{result.serial_number:<{serial_width}}  {result.port:<{port_width}}  {result.write_s * 1000:>9.1f}  {result.verify_s * 1000:>9.1f}  {status}")
+
+    total_s = sum(result.write_s + result.verify_s for result in results)
+    passed = sum(result.ok for result in results)
+    lines.append(f"{passed}/{len(results)} fluxpads provisioned in {elapsed_s * 1000:.1f} ms ({total_s * 1000:.1f} ms of device time)")
+    return "\n".join(lines)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Push a settings profile to every attached fluxpad")
+    parser.add_argument("profile", type=pathlib.Path, help="Settings JSON saved from fluxapp")
+    parser.add_argument("--workers", type=int, default=DEFAULT_MAX_WORKERS, help=f"Fluxpads to provision at once (default {DEFAULT_MAX_WORKERS})")
+    parser.add_argument("--serial", action="append", help="Only provision the fluxpad with this serial number, can be repeated")
+    parser.add_argument("--force", action="store_true", help="Write every setting even if the fluxpad already has it")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+
+    if not args.profile.is_file():
+        parser.error(f"Profile {args.profile} not found")
+    profile = fluxpad_interface.FluxpadSettings()
+    try:
+        profile.load_from_file(args.profile)
+    except (OSError, ValueError) as e:  # Unreadable, not JSON, or not matching the settings schema
+        parser.error(f"Can't load profile {args.profile}: {e}")
+
+    ports = fluxpad_interface.find_fluxpad_ports()
+    if args.serial:
+        missing = set(args.serial) - set(ports)
+        if missing:
+            print(f"Not attached: {', '.join(sorted(missing))}", file=sys.stderr)
+        ports = {serial_number: port for serial_number, port in ports.items() if serial_number in args.serial}
+    if not ports:
+        print("No fluxpads found", file=sys.stderr)
+        return 1
+
+    start_s = time.perf_counter()
+    results = provision_all(ports, profile, max_workers=args.workers, force=args.force)
+    print(format_results(results, time.perf_counter() - start_s))
+    return 0 if all(result.ok for result in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
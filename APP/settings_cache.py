@@ -0,0 +1,116 @@
+"""Cache of the settings last read from every fluxpad, by USB serial number.
+
+Reading every setting takes a request per key. Firmware that reports the CRC of what it stores
+in flash lets one small read tell whether the cached copy is still what the fluxpad has, so the
+settings can be shown as soon as it connects and only read again when they changed.
+"""
+import json
+import logging
+import os
+import pathlib
+import re
+import time
+from typing import NamedTuple, Optional, Tuple, Union
+
+from fluxpad_interface import Fluxpad, FluxpadSettings
+
+DEFAULT_DIRECTORY = pathlib.Path.home() / ".fluxapp" / "settings_cache"
+CACHE_VERSION = 1
+
+PathLike = Union[str, pathlib.Path]
+
+
+class CachedSettings(NamedTuple):
+    serial_number: str
+    firmware_version: int
+    settings_crc: Optional[int]  # None if the firmware doesn't report it
+    time: float  # Unix time the settings were read or written
+    settings: dict  # Laid out like a settings file
+
+    def is_current(self, firmware_version: int, settings_crc: Optional[int]) -> bool:
+        """Whether the fluxpad still has these settings, never without a CRC to compare"""
+        return settings_crc is not None and self.settings_crc == settings_crc and self.firmware_version == firmware_version
+
+    def to_fluxpad_settings(self) -> FluxpadSettings:
+        settings = FluxpadSettings()
+        settings.load_from_dict(self.settings)
+        return settings
+
+
+class SettingsCache:
+    """One JSON file per fluxpad, replaced whole so a reader never sees half a file"""
+
+    def __init__(self, directory: PathLike = DEFAULT_DIRECTORY) -> None:
+        self.directory = pathlib.Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+
+    def _path(self, serial_number: str) -> pathlib.Path:
+        return self.directory / f"{re.sub(r'[^A-Za-z0-9_-]', '_', serial_number)}.json"
+
+    def load(self, serial_number: str) -> Optional[CachedSettings]:
+        """Cached settings of a fluxpad, None if there are none or they can't be used"""
+        path = self._path(serial_number)
+        if not path.exists():
+            return None
+        try:
+            root = json.loads(path.read_text())
+            if root["version"] != CACHE_VERSION or root["serial_number"] != serial_number:
+                return None
+            cached = CachedSettings(serial_number, root["firmware_version"], root["settings_crc"], root["time"], root["settings"])
+            cached.to_fluxpad_settings()  # Check it parses
+        except Exception:
+            logging.error(f"Ignoring unreadable settings cache {path}", exc_info=True)
+            return None
+        return cached
+
+    def store(self, serial_number: str, firmware_version: int, settings_crc: Optional[int], settings: FluxpadSettings, time_s: Optional[float] = None) -> CachedSettings:
+        cached = CachedSettings(serial_number, firmware_version, settings_crc, time.time() if time_s is None else time_s, settings.to_dict())
+        root = {"version": CACHE_VERSION, **cached._asdict()}
+        path = self._path(serial_number)
+        temporary_path = path.with_suffix(".tmp")
+        temporary_path.write_text(json.dumps(root, indent=4))
+        os.replace(temporary_path, path)
+        return cached
+
+    def remove(self, serial_number: str):
+        self._path(serial_number).unlink(missing_ok=True)
+
+
+def read_fingerprint(fluxpad: Fluxpad) -> Tuple[int, Optional[int]]:
+    """Firmware version and settings CRC of a connected fluxpad, two small requests instead of every setting"""
+    return fluxpad.get_version(), fluxpad.get_settings_crc()
+
+
+def load_current_settings(fluxpad: Fluxpad, cache: SettingsCache) -> Tuple[FluxpadSettings, bool]:
+    """Settings of a connected fluxpad, from the cache if it is still current, otherwise read from the fluxpad and cached.
+    Returns the settings and whether they came from the cache"""
+    assert fluxpad.serial_number is not None, "Fluxpad has no serial number"
+    firmware_version, settings_crc = read_fingerprint(fluxpad)
+    cached = cache.load(fluxpad.serial_number)
+    if cached is not None and cached.is_current(firmware_version, settings_crc):
+        settings = cached.to_fluxpad_settings()
+        settings.assume_device_state(fluxpad)
+        logging.info(f"Settings cache of {fluxpad.serial_number} is current")
+        return settings, True
+
+    settings = FluxpadSettings()
+    settings.load_from_keypad(fluxpad)
+    if settings.matches_device_state(fluxpad):
+        cache.store(fluxpad.serial_number, firmware_version, settings_crc, settings)
+    else:
+        # Some reads failed, don't keep a partial copy
+        cache.remove(fluxpad.serial_number)
+    return settings, False
+
+
+def update_cache(fluxpad: Fluxpad, cache: SettingsCache, settings: FluxpadSettings) -> bool:
+    """Cache settings after writing to a connected fluxpad, if every one of them is known to have gone through.
+    Also re-stamps the cache after writes that change the CRC but no settings, like calibrations"""
+    if fluxpad.serial_number is None:
+        return False
+    if not settings.matches_device_state(fluxpad):
+        cache.remove(fluxpad.serial_number)
+        return False
+    firmware_version, settings_crc = read_fingerprint(fluxpad)
+    cache.store(fluxpad.serial_number, firmware_version, settings_crc, settings)
+    return True
@@ -0,0 +1,250 @@
+"""Layout of settings files, checked in one pass and migrated from older versions.
+
+A settings file holds key_settings, one object per key with its key id, and rgb_settings. The
+fields every object can have come from the Field declarations of the settings messages, so the
+schema follows the messages. Versions:
+
+    0  From before RGB settings, a bare list of key settings or an object without rgb_settings
+    1  Unversioned, with rgb_settings. Objects hold the whole message data, command and token
+       of the read that filled them included
+    2  Versioned, objects only hold settings
+
+usage: python settings_schema.py FILE [FILE ...] [--migrate]
+"""
+import argparse
+import json
+import math
+import pathlib
+import sys
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Union
+
+SCHEMA_VERSION = 2
+
+VERSION_KEY = "version"
+KEY_SETTINGS_KEY = "key_settings"
+RGB_SETTINGS_KEY = "rgb_settings"
+KEY_ID_KEY = "key"
+# Message keys version 1 files picked up from the read that filled them
+ADDRESS_KEYS = ("cmd", "tkn")
+
+# What fillDefaultStorageVars in the firmware sets, and so what fluxpads from before RGB settings have
+DEFAULT_RGB_SETTINGS = {"rgb_m": 2, "rgb_c1": 0xFF0000, "rgb_c2": 0x008000, "rgb_c3": 0x0000FF, "rgb_b": 255, "rgb_s": 20}
+# And the key settings it sets, HID keycodes A S Z X C then volume up and down
+_DEFAULT_LIGHTING_SETTINGS = {"l_m": 2, "l_b": 255, "l_d": 20000}
+_DEFAULT_DIGITAL_SETTINGS = {"k_t": 1, "d_a": 1, "d_r": 10, **_DEFAULT_LIGHTING_SETTINGS}
+_DEFAULT_ANALOG_SETTINGS = {"k_t": 1, "h_a": 0.2, "h_r": 0.2, "p_a": 2.5, "p_r": 5.5, "d_a": 1, "d_r": 6, "a_s": 22, "rt": True,
+                            **_DEFAULT_LIGHTING_SETTINGS}
+DEFAULT_KEY_SETTINGS = [
+    {"key": 0, "k_c": 0x04, **_DEFAULT_DIGITAL_SETTINGS},
+    {"key": 1, "k_c": 0x16, **_DEFAULT_DIGITAL_SETTINGS},
+    {"key": 2, "k_c": 0x1D, **_DEFAULT_ANALOG_SETTINGS},
+    {"key": 3, "k_c": 0x1B, **_DEFAULT_ANALOG_SETTINGS},
+    {"key": 4, "k_c": 0x06, **_DEFAULT_ANALOG_SETTINGS},
+    {"key": 5, "k_t": 2, "k_c": 0xE9},
+    {"key": 6, "k_t": 2, "k_c": 0xEA},
+]
+
+PathLike = Union[str, pathlib.Path]
+
+
+class SettingsFileError(ValueError):
+    """Settings that don't match the schema, with every problem found"""
+
+    def __init__(self, errors: List[str], source: Optional[PathLike] = None) -> None:
+        self.errors = errors
+        self.source = source
+        super().__init__(f"{source or 'Settings'} has {len(errors)} error(s):\n" + "\n".join(errors))
+
+
+def _strip_address_keys(settings):
+    if not isinstance(settings, dict):
+        return settings  # Left for validation to report
+    return {key: value for key, value in settings.items() if key not in ADDRESS_KEYS}
+
+
+def _from_version_0(root) -> dict:
+    if isinstance(root, list):
+        root = {KEY_SETTINGS_KEY: root}
+    return {**root, RGB_SETTINGS_KEY: dict(DEFAULT_RGB_SETTINGS)}
+
+
+def _from_version_1(root: dict) -> dict:
+    key_settings = root.get(KEY_SETTINGS_KEY)
+    if isinstance(key_settings, list):
+        key_settings = [_strip_address_keys(settings) for settings in key_settings]
+    return {VERSION_KEY: 2, KEY_SETTINGS_KEY: key_settings, RGB_SETTINGS_KEY: _strip_address_keys(root.get(RGB_SETTINGS_KEY))}
+
+
+# Each takes a file of the version it is listed under to the next one
+MIGRATIONS: Dict[int, Callable[[object], dict]] = {
+    0: _from_version_0,
+    1: _from_version_1,
+}
+
+
+def default_settings() -> dict:
+    """Settings file of what a fluxpad has before anything was saved to it"""
+    return {VERSION_KEY: SCHEMA_VERSION, KEY_SETTINGS_KEY: [dict(settings) for settings in DEFAULT_KEY_SETTINGS],
+            RGB_SETTINGS_KEY: dict(DEFAULT_RGB_SETTINGS)}
+
+
+def file_version(root) -> int:
+    if isinstance(root, dict) and VERSION_KEY in root:
+        return root[VERSION_KEY]
+    if isinstance(root, dict) and RGB_SETTINGS_KEY in root:
+        return 1
+    return 0
+
+
+def migrate(root) -> dict:
+    """Bring a parsed settings file of any version up to SCHEMA_VERSION, without validating it"""
+    version = file_version(root)
+    if isinstance(version, bool) or not isinstance(version, int) or not 0 <= version <= SCHEMA_VERSION:
+        raise SettingsFileError([f"{VERSION_KEY}: must be a version up to {SCHEMA_VERSION}, got {version!r}"])
+    if not isinstance(root, (dict, list)):
+        raise SettingsFileError([f"must be an object, got {type(root).__name__}"])
+    while version < SCHEMA_VERSION:
+        root = MIGRATIONS[version](root)
+        version += 1
+    return root
+
+
+def _check_value(field, value) -> Optional[str]:
+    """What is wrong with a value for a message field, None if nothing.
+    Like Field.validate but without asserts, and any JSON number does for a float"""
+    if field.type is bool:
+        if not isinstance(value, bool):
+            return f"must be bool, got {value!r}"
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return f"must be {field.type.__name__}, got {value!r}"
+    if field.type is int and field.strict and not isinstance(value, int):
+        return f"must be int, got {value!r}"
+    if not math.isfinite(value):
+        return f"must be finite, got {value!r}"
+    if field.minimum is not None and value < field.minimum:
+        return f"must be at least {field.minimum}, got {value!r}"
+    if field.maximum is not None and value > field.maximum:
+        return f"must be at most {field.maximum}, got {value!r}"
+    if field.choices is not None and value not in field.choices:
+        return f"must be one of {sorted(int(choice) for choice in field.choices)}, got {value!r}"
+    return None
+
+
+class SettingsSchema:
+    """Schema of a settings file for the given message type of every key id and of the RGB settings"""
+
+    def __init__(self, key_message_types: Sequence[type], rgb_message_type: type) -> None:
+        self.key_fields = [self._file_fields(message_type) for message_type in key_message_types]
+        self.rgb_fields = self._file_fields(rgb_message_type)
+
+    @staticmethod
+    def _file_fields(message_type: type) -> dict:
+        """Fields a file can hold for a message type by key, measurements read from the fluxpad aren't settings"""
+        return {field.key: field for field in message_type.get_fields() if not field.read_only and field.key != KEY_ID_KEY}
+
+    @staticmethod
+    def _check_object(settings, fields: dict, location: str, errors: List[str], skip_keys=()):
+        if not isinstance(settings, dict):
+            errors.append(f"{location}: must be an object, got {type(settings).__name__}")
+            return
+        for key, value in settings.items():
+            if key in skip_keys:
+                continue
+            field = fields.get(key)
+            if field is None:
+                errors.append(f"{location}.{key}: unknown setting")
+                continue
+            problem = _check_value(field, value)
+            if problem is not None:
+                errors.append(f"{location}.{key} ({field.name}): {problem}")
+        # The settings getters need every field, a fluxpad always reports them all
+        for key, field in fields.items():
+            if key not in settings:
+                errors.append(f"{location}.{key} ({field.name}): missing")
+
+    def validate(self, root) -> List[str]:
+        """Every problem with a settings file of the current version, empty if there are none"""
+        if not isinstance(root, dict):
+            return [f"must be an object, got {type(root).__name__}"]
+        errors = []
+        for key in root.keys() - {VERSION_KEY, KEY_SETTINGS_KEY, RGB_SETTINGS_KEY}:
+            errors.append(f"{key}: unknown section")
+        if root.get(VERSION_KEY) != SCHEMA_VERSION:
+            errors.append(f"{VERSION_KEY}: must be {SCHEMA_VERSION}, got {root.get(VERSION_KEY)!r}")
+
+        key_settings = root.get(KEY_SETTINGS_KEY)
+        if not isinstance(key_settings, list):
+            errors.append(f"{KEY_SETTINGS_KEY}: must be a list, got {type(key_settings).__name__}")
+        else:
+            seen_key_ids = set()
+            for index, settings in enumerate(key_settings):
+                location = f"{KEY_SETTINGS_KEY}[{index}]"
+                key_id = settings.get(KEY_ID_KEY) if isinstance(settings, dict) else None
+                if isinstance(key_id, bool) or not isinstance(key_id, int) or not 0 <= key_id < len(self.key_fields):
+                    errors.append(f"{location}.{KEY_ID_KEY}: must be a key id from 0 to {len(self.key_fields) - 1}, got {key_id!r}")
+                    continue
+                if key_id in seen_key_ids:
+                    errors.append(f"{location}.{KEY_ID_KEY}: key id {key_id} appears more than once")
+                    continue
+                seen_key_ids.add(key_id)
+                self._check_object(settings, self.key_fields[key_id], location, errors, skip_keys=(KEY_ID_KEY,))
+            missing = sorted(set(range(len(self.key_fields))) - seen_key_ids)
+            if missing:
+                errors.append(f"{KEY_SETTINGS_KEY}: no settings for key ids {missing}")
+
+        self._check_object(root.get(RGB_SETTINGS_KEY), self.rgb_fields, RGB_SETTINGS_KEY, errors)
+        return errors
+
+    def load(self, root, source: Optional[PathLike] = None) -> dict:
+        """Migrate and validate a parsed settings file, raises SettingsFileError listing every problem"""
+        try:
+            root = migrate(root)
+        except SettingsFileError as e:
+            raise SettingsFileError(e.errors, source) from None
+        errors = self.validate(root)
+        if errors:
+            raise SettingsFileError(errors, source)
+        return root
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Check settings files against the schema")
+    parser.add_argument("files", type=pathlib.Path, nargs="+")
+    parser.add_argument("--migrate", action="store_true", help=f"Rewrite valid files of older versions as version {SCHEMA_VERSION}")
+    args = parser.parse_args(argv)
+
+    # fluxpad_interface uses this module for its files, so the schema is only looked up here
+    from fluxpad_interface import FluxpadSettings
+    schema = FluxpadSettings.FILE_SCHEMA
+
+    start_s = time.monotonic()
+    invalid_count = 0
+    migrated_count = 0
+    for path in args.files:
+        try:
+            original = json.loads(path.read_bytes())
+        except (OSError, ValueError) as e:
+            print(f"{path}: {e}", file=sys.stderr)
+            invalid_count += 1
+            continue
+        try:
+            root = migrate(original)
+            errors = schema.validate(root)
+        except SettingsFileError as e:
+            errors = e.errors
+        if errors:
+            print(SettingsFileError(errors, path), file=sys.stderr)
+            invalid_count += 1
+            continue
+        if args.migrate and root != original:
+            path.write_text(json.dumps(root, indent=4))
+            migrated_count += 1
+    print(f"Checked {len(args.files)} files in {time.monotonic() - start_s:.2f}s, {invalid_count} invalid"
+          + (f", {migrated_count} migrated" if args.migrate else ""))
+    return 1 if invalid_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
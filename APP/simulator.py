@@ -0,0 +1,168 @@
+"""Offline simulation of the analog key press/release logic in AnalogSwitch::mainLoopService.
+
+Runs a recorded height trace through the same rapid trigger, hysteresis and debounce rules the
+firmware uses, in Q22.10 fixed point like the firmware, to see what a setting would do before
+writing it to a fluxpad.
+"""
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from fixed_point import to_q22_10
+from fluxpad_interface import AnalogSettingsMessage, MessageKey
+
+LOOP_FREQUENCY_HZ = 2000  # normal_mode_freq_hz in the firmware
+
+# Firmware defaults, used for settings the message doesn't have
+DEFAULT_ANALOG_SETTINGS = {
+    MessageKey.RAPID_TRIGGER: True,
+    MessageKey.ACTUATE_HYSTERESIS: 0.2,
+    MessageKey.RELEASE_HYSTERESIS: 0.2,
+    MessageKey.ACTUATE_POINT: 2.5,
+    MessageKey.RELEASE_POINT: 5.5,
+    MessageKey.ACTUATE_DEBOUNCE: 1,
+    MessageKey.RELEASE_DEBOUNCE: 6,
+}
+
+MIN_CHUNK_SAMPLES = 256
+MAX_CHUNK_SAMPLES = 65536
+
+
+class SwitchSettings(NamedTuple):
+    """AnalogSwitchSettings_t, distances in Q22.10"""
+    rapid_trigger: bool
+    press_hysteresis: int
+    release_hysteresis: int
+    actuation_point: int
+    release_point: int
+    press_debounce_ms: int
+    release_debounce_ms: int
+
+    @classmethod
+    def from_message(cls, message: AnalogSettingsMessage) -> "SwitchSettings":
+        values = dict(DEFAULT_ANALOG_SETTINGS)
+        values.update((key, message.data[key]) for key in DEFAULT_ANALOG_SETTINGS if key in message.data)
+        return cls(
+            bool(values[MessageKey.RAPID_TRIGGER]),
+            int(to_q22_10(values[MessageKey.ACTUATE_HYSTERESIS])),
+            int(to_q22_10(values[MessageKey.RELEASE_HYSTERESIS])),
+            int(to_q22_10(values[MessageKey.ACTUATE_POINT])),
+            int(to_q22_10(values[MessageKey.RELEASE_POINT])),
+            int(values[MessageKey.ACTUATE_DEBOUNCE]),
+            int(values[MessageKey.RELEASE_DEBOUNCE]),
+        )
+
+
+class SimulationResult(NamedTuple):
+    pressed: np.ndarray  # Key state after each sample
+    press_indexes: np.ndarray  # Samples where the key got pressed
+    release_indexes: np.ndarray  # Samples where the key got released
+    time_ms: np.ndarray
+
+    @property
+    def press_times_ms(self) -> np.ndarray:
+        return self.time_ms[self.press_indexes]
+
+    @property
+    def release_times_ms(self) -> np.ndarray:
+        return self.time_ms[self.release_indexes]
+
+
+def simulate(height_mm, settings: AnalogSettingsMessage, time_ms: Optional[np.ndarray] = None, sample_rate_hz: float = LOOP_FREQUENCY_HZ) -> SimulationResult:
+    """Run a height trace through the firmware key logic.
+
+    time_ms is the firmware millis() of each sample, by default the samples are spaced at sample_rate_hz.
+    Like the firmware, the key starts released with both debounce timers at the first sample."""
+    height = to_q22_10(height_mm)
+    if time_ms is None:
+        time_ms = (np.arange(len(height)) * 1000 // sample_rate_hz).astype(np.int64)
+    else:
+        time_ms = np.asarray(time_ms, dtype=np.int64)
+    assert height.shape == time_ms.shape and height.ndim == 1
+    switch = SwitchSettings.from_message(settings) if isinstance(settings, AnalogSettingsMessage) else settings
+
+    press_indexes = []
+    release_indexes = []
+    sample_indexes = np.arange(len(height))
+    # Firmware time of each sample shifted by one, the debounce timers start at the time of the first sample
+    timer_times_ms = np.concatenate([time_ms[:1], time_ms])
+
+    # Everything that doesn't depend on the key state is worked out for the whole trace at once
+    capped_at_release = np.minimum(height, switch.release_point)
+    capped_at_actuation = np.maximum(height, switch.actuation_point)
+    below_actuation = height < switch.actuation_point
+    above_release = height > switch.release_point
+    if switch.rapid_trigger:
+        press_forced = below_actuation & ~above_release
+        press_allowed = ~above_release
+        release_forced = above_release & ~below_actuation
+        release_allowed = ~below_actuation
+    else:
+        press_forced = below_actuation
+        release_forced = above_release
+
+    is_pressed = False
+    # Index of the last sample that restarted each debounce timer, -1 for the first sample's time
+    last_released_index = last_pressed_index = -1
+    extreme = None  # max_height_mm while released, min_height_mm while pressed, None right after a reset
+    chunk_samples = MIN_CHUNK_SAMPLES
+    start = 0
+    while start < len(height):
+        end = min(start + chunk_samples, len(height))
+
+        if not is_pressed:
+            should_change = press_forced[start:end]
+            if switch.rapid_trigger:
+                # max_height_mm is capped at the release point
+                extremes = np.maximum.accumulate(capped_at_release[start:end])
+                if extreme is not None:
+                    np.maximum(extremes, extreme, out=extremes)
+                should_change = (extremes - height[start:end] > switch.press_hysteresis) & press_allowed[start:end] | should_change
+            last_index = last_released_index
+            debounce_ms = switch.press_debounce_ms
+        else:
+            should_change = release_forced[start:end]
+            if switch.rapid_trigger:
+                # min_height_mm is capped at the actuation point
+                extremes = np.minimum.accumulate(capped_at_actuation[start:end])
+                if extreme is not None:
+                    np.minimum(extremes, extreme, out=extremes)
+                should_change = (height[start:end] - extremes > switch.release_hysteresis) & release_allowed[start:end] | should_change
+            last_index = last_pressed_index
+            debounce_ms = switch.release_debounce_ms
+
+        # The debounce timer restarts on every sample where the key shouldn't change
+        restart_indexes = np.maximum.accumulate(np.where(should_change, last_index, sample_indexes[start:end]))
+        debounced = time_ms[start:end] - timer_times_ms[restart_indexes + 1] > debounce_ms
+        change = int(debounced.argmax())
+
+        if not debounced[change]:
+            last_index = int(restart_indexes[-1])
+            if switch.rapid_trigger:
+                extreme = int(extremes[-1])
+            chunk_samples = min(chunk_samples * 2, MAX_CHUNK_SAMPLES)
+            change_index = None
+        else:
+            last_index = int(restart_indexes[change])
+            change_index = start + change
+            end = change_index + 1
+            chunk_samples = MIN_CHUNK_SAMPLES
+
+        if is_pressed:
+            last_pressed_index = last_index
+        else:
+            last_released_index = last_index
+        if change_index is not None:
+            (release_indexes if is_pressed else press_indexes).append(change_index)
+            is_pressed = not is_pressed
+            extreme = None
+        start = end
+
+    press_indexes = np.array(press_indexes, dtype=np.intp)
+    release_indexes = np.array(release_indexes, dtype=np.intp)
+    # The key is pressed from each press up to the next release
+    state_changes = np.zeros(len(height) + 1, dtype=np.int8)
+    np.add.at(state_changes, press_indexes, 1)
+    np.add.at(state_changes, release_indexes, -1)
+    pressed = np.cumsum(state_changes[:-1]).astype(np.bool_)
+    return SimulationResult(pressed, press_indexes, release_indexes, time_ms)
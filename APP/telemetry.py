@@ -0,0 +1,196 @@
+import threading
+from typing import Iterator, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+import fixed_point
+from fluxpad_interface import AnalogCalibrationMessage, DatastreamSample, Fluxpad, MessageKey
+
+RAW_HEX_DIGITS = 6  # Per reading in raw datastream messages
+
+# ASCII hex digit to its value
+_HEX_VALUES = np.zeros(256, dtype=np.int64)
+_HEX_VALUES[np.frombuffer(b"0123456789abcdef", dtype=np.uint8)] = np.arange(16)
+_HEX_VALUES[np.frombuffer(b"ABCDEF", dtype=np.uint8)] = np.arange(10, 16)
+_HEX_PLACES = 16 ** np.arange(RAW_HEX_DIGITS - 1, -1, -1, dtype=np.int64)
+
+
+class TelemetryView(NamedTuple):
+    """Read only views into a TelemetryBuffer, oldest sample first. Each array has one row per sample"""
+    host_time_s: np.ndarray  # (n,)
+    device_time_us: np.ndarray  # (n,)
+    raw_adc: np.ndarray  # (n, channels)
+    height_mm: np.ndarray  # (n, channels)
+    pressed: np.ndarray  # (n, channels)
+
+    def __len__(self):
+        return len(self.host_time_s)
+
+
+class RawDatastreamBatch(NamedTuple):
+    """Raw datastream messages converted to heights on the host, one row per message and a column per analog key"""
+    host_time_s: np.ndarray  # (n,)
+    device_time_us: np.ndarray  # (n,) unwrapped
+    readings: np.ndarray  # (n, keys) Q22.10 averaged ADC readings, as the fluxpad has them
+    raw_adc: np.ndarray  # (n, keys) the same readings in ADC counts
+    height_mm: np.ndarray  # (n, keys)
+    pressed: np.ndarray  # (n, keys)
+
+
+def decode_raw_readings(hex_readings: Sequence[str], keys: int) -> np.ndarray:
+    """Unpack the "raw" hex strings of datastream messages into an (n, keys) array of Q22.10 readings"""
+    digits = np.frombuffer("".join(hex_readings).encode("ascii"), dtype=np.uint8)
+    digits = _HEX_VALUES[digits].reshape(len(hex_readings), keys, RAW_HEX_DIGITS)
+    return digits @ _HEX_PLACES
+
+
+def read_calibrations(fluxpad: Fluxpad) -> List[Tuple[float, float]]:
+    """Calibration down and up in ADC counts of every analog key"""
+    calibrations = []
+    for key_id in Fluxpad.ANALOG_KEY_IDS:
+        message = AnalogCalibrationMessage()
+        message.set_zeros()
+        message.key_id = key_id
+        response = fluxpad.send_read_request(message)
+        calibrations.append((response.calibration_down, response.calibration_up))
+    return calibrations
+
+
+def stream_raw(fluxpad: Fluxpad, calibrations: Optional[Sequence[Tuple[float, float]]] = None, rate_hz: int = 1000, max_batch: int = 256) -> Iterator[RawDatastreamBatch]:
+    """Stream packed raw readings of every analog key and convert them to heights on the host in batches.
+    Uses the fluxpad's own calibration unless calibrations of (down, up) ADC counts per key are given"""
+    if calibrations is None:
+        calibrations = read_calibrations(fluxpad)
+    calibrations = np.asarray(calibrations, dtype=np.float64)
+    calibration_down = fixed_point.to_q22_10(calibrations[:, 0])
+    calibration_up = fixed_point.to_q22_10(calibrations[:, 1])
+    keys = len(Fluxpad.ANALOG_KEY_IDS)
+    key_bits = 1 << np.arange(keys)
+
+    time_offset_us = 0
+    last_time_us = None
+    for messages in fluxpad.stream_raw_messages(rate_hz, max_batch):
+        host_time_s = np.array([receive_time_s for receive_time_s, _ in messages])
+        device_time_us = np.array([message[MessageKey.DATASTREAM_TIME] for _, message in messages], dtype=np.int64)
+        readings = decode_raw_readings([message[MessageKey.RAW_READINGS] for _, message in messages], keys)
+        pressed = (np.array([message[MessageKey.PRESSED] for _, message in messages])[:, np.newaxis] & key_bits) != 0
+
+        # Fluxpad time is 32 bit us, unwrap it
+        wraps = np.cumsum(np.diff(device_time_us, prepend=device_time_us[0] if last_time_us is None else last_time_us) < 0)
+        last_time_us = int(device_time_us[-1])
+        device_time_us = device_time_us + time_offset_us + (wraps << 32)
+        time_offset_us += int(wraps[-1]) << 32
+
+        height = fixed_point.reading_to_height(readings, calibration_down, calibration_up)
+        yield RawDatastreamBatch(
+            host_time_s,
+            device_time_us,
+            readings,
+            readings / fixed_point.SCALE,
+            fixed_point.q22_10_to_float(height),
+            pressed,
+        )
+
+
+class TelemetryBuffer:
+    """Fixed capacity circular buffer of key telemetry backed by preallocated NumPy arrays.
+
+    Every sample is written twice, at index i and i + capacity, so the last n samples are always
+    one contiguous slice and views never have to copy. Memory use is fixed at creation."""
+
+    def __init__(self, capacity: int, channels: int = 3) -> None:
+        assert capacity > 0
+        assert channels > 0
+        self.capacity = capacity
+        self.channels = channels
+
+        self._host_time_s = np.zeros(2 * capacity, dtype=np.float64)
+        self._device_time_us = np.zeros(2 * capacity, dtype=np.int64)
+        self._raw_adc = np.zeros((2 * capacity, channels), dtype=np.float32)
+        self._height_mm = np.zeros((2 * capacity, channels), dtype=np.float32)
+        self._pressed = np.zeros((2 * capacity, channels), dtype=np.bool_)
+
+        self._write_index = 0  # Where the next sample goes, always < capacity
+        self._count = 0  # Total samples ever appended
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_duration(cls, duration_s: float, rate_hz: float, channels: int = 3) -> "TelemetryBuffer":
+        """Buffer big enough to hold duration_s of samples at rate_hz"""
+        return cls(max(1, int(duration_s * rate_hz)), channels)
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    @property
+    def total_count(self) -> int:
+        """Samples appended since creation or the last clear(), including overwritten ones"""
+        return self._count
+
+    def append(self, host_time_s: float, device_time_us: int, raw_adc: Sequence[float], height_mm: Sequence[float], pressed: Sequence[bool]):
+        """Add one sample, overwriting the oldest one once full"""
+        with self._lock:
+            i = self._write_index
+            j = i + self.capacity
+            self._host_time_s[i] = self._host_time_s[j] = host_time_s
+            self._device_time_us[i] = self._device_time_us[j] = device_time_us
+            self._raw_adc[i] = self._raw_adc[j] = raw_adc
+            self._height_mm[i] = self._height_mm[j] = height_mm
+            self._pressed[i] = self._pressed[j] = pressed
+
+            self._write_index = i + 1 if i + 1 < self.capacity else 0
+            self._count += 1
+
+    def append_sample(self, sample: DatastreamSample):
+        """Add a sample from Fluxpad.stream()"""
+        self.append(sample.host_time_s, sample.device_time_us, sample.raw_adc, sample.height_mm, sample.pressed)
+
+    def append_batch(self, batch: RawDatastreamBatch):
+        """Add many samples at once, only the newest capacity of them are kept if there are more"""
+        count = len(batch.host_time_s)
+        keep = min(count, self.capacity)
+        columns = (batch.host_time_s, batch.device_time_us, batch.raw_adc, batch.height_mm, batch.pressed)
+        arrays = (self._host_time_s, self._device_time_us, self._raw_adc, self._height_mm, self._pressed)
+        with self._lock:
+            indexes = (self._write_index + count - keep + np.arange(keep)) % self.capacity
+            for array, column in zip(arrays, columns):
+                array[indexes] = array[indexes + self.capacity] = column[count - keep:]
+            self._write_index = (self._write_index + count) % self.capacity
+            self._count += count
+
+    def clear(self):
+        with self._lock:
+            self._write_index = 0
+            self._count = 0
+
+    def last(self, n: int) -> TelemetryView:
+        """Views of the newest n samples, or fewer if the buffer doesn't have that many yet.
+        The views are only valid until the samples are overwritten, copy them to keep them longer"""
+        with self._lock:
+            n = max(0, min(n, len(self)))
+            # The newest sample is at write_index - 1 and its mirror at write_index - 1 + capacity
+            end = self._write_index + self.capacity if self._count >= self.capacity else self._write_index
+            start = end - n
+            return self._view(start, end)
+
+    def last_seconds(self, duration_s: float, device_time: bool = False) -> TelemetryView:
+        """Views of the samples from the last duration_s seconds, measured back from the newest sample"""
+        everything = self.last(self.capacity)
+        if len(everything) == 0:
+            return everything
+        if device_time:
+            times = everything.device_time_us
+            start = np.searchsorted(times, times[-1] - duration_s * 1e6, side="left")
+        else:
+            times = everything.host_time_s
+            start = np.searchsorted(times, times[-1] - duration_s, side="left")
+        return TelemetryView(*(array[start:] for array in everything))
+
+    def _view(self, start: int, end: int) -> TelemetryView:
+        arrays = (self._host_time_s, self._device_time_us, self._raw_adc, self._height_mm, self._pressed)
+        views = []
+        for array in arrays:
+            view = array[start:end]
+            view.flags.writeable = False
+            views.append(view)
+        return TelemetryView(*views)
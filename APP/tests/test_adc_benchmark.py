@@ -0,0 +1,77 @@
+import unittest
+import sys
+import types
+from unittest import mock
+sys.path.append('../APP')
+import numpy as np
+import adc_benchmark
+import telemetry
+
+
+def result(adc_samples: int, loop_hz: float, noise_mm: float) -> adc_benchmark.BenchmarkResult:
+    return adc_benchmark.BenchmarkResult(adc_samples, loop_hz, np.array([noise_mm / 2, noise_mm, noise_mm / 3]), np.zeros(3), 1000)
+
+
+class TestAdcBenchmark(unittest.TestCase):
+
+    def test_recommend(self):
+        results = [result(8, 2000, 0.05), result(32, 2000, 0.009), result(64, 2000, 0.006), result(110, 1515, 0.004)]
+        self.assertEqual(adc_benchmark.recommend(results, 0.01).adc_samples, 32)
+        self.assertEqual(adc_benchmark.recommend(results, 0.005).adc_samples, 110)
+        self.assertIsNone(adc_benchmark.recommend(results, 0.001))
+        self.assertAlmostEqual(results[3].acquisition_us, 660)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now_s = 100.0
+
+    def monotonic(self) -> float:
+        return self.now_s
+
+
+def synthetic_batch(first_time_us: int, noise_mm: np.ndarray, messages: int = 10) -> telemetry.RawDatastreamBatch:
+    """Messages 500 us apart except for one dropped, keys alternating around their rest heights by noise_mm"""
+    device_time_us = first_time_us + 500 * np.arange(messages)
+    device_time_us[-1] += 1000
+    sign = np.where(np.arange(messages) % 2 == 0, 1.0, -1.0)[:, np.newaxis]
+    height_mm = np.array([4.0, 4.1, 4.2]) + sign * noise_mm
+    raw_adc = 1800 + 100 * (height_mm - 4.0)
+    return telemetry.RawDatastreamBatch(np.zeros(messages), device_time_us, raw_adc * 1024, raw_adc, height_mm, np.zeros((messages, 3), dtype=bool))
+
+
+class TestMeasure(unittest.TestCase):
+
+    def test_measure(self):
+        clock = FakeClock()
+        fluxpad = types.SimpleNamespace(adc_samples=[], set_adc_samples=lambda samples: fluxpad.adc_samples.append(samples))
+        stream_closed = []
+
+        def stream_raw(fluxpad, calibrations, rate_hz):
+            start_s = clock.now_s
+            try:
+                for batch_index in range(100):
+                    # Noisy while the new sample count settles
+                    settling = clock.now_s - start_s < adc_benchmark.SETTLE_S
+                    yield synthetic_batch(batch_index * 6000, np.array([1.0, 1.0, 1.0]) if settling else np.array([0.01, 0.002, 0.0]))
+                    clock.now_s += 0.05
+            finally:
+                stream_closed.append(True)
+
+        with mock.patch.object(telemetry, "stream_raw", stream_raw), \
+                mock.patch.object(telemetry, "read_calibrations", lambda fluxpad: [(1000, 1800)] * 3), \
+                mock.patch.object(adc_benchmark, "time", clock):
+            result = adc_benchmark.measure(fluxpad, 32, duration_s=0.5)
+
+        self.assertEqual(fluxpad.adc_samples, [32])
+        self.assertEqual(stream_closed, [True])
+        # Batches 4 to 14 fall in the measuring window after the settle time
+        self.assertEqual(result.message_count, 110)
+        # The dropped messages leave longer gaps, the median loop period is still 500 us
+        self.assertAlmostEqual(result.loop_hz, 2000)
+        np.testing.assert_allclose(result.noise_mm, [0.01, 0.002, 0.0], atol=1e-9)
+        np.testing.assert_allclose(result.noise_adc, [1.0, 0.2, 0.0], atol=1e-6)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
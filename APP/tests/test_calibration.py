@@ -0,0 +1,67 @@
+import unittest
+import sys
+sys.path.append('../APP')
+import numpy as np
+import calibration
+
+
+class TestCalibration(unittest.TestCase):
+
+    def test_welford(self):
+        values = np.random.default_rng(0).normal(1650, 3, 500)
+        one_by_one = calibration.Welford()
+        for value in values:
+            one_by_one.update(value)
+        batched = calibration.Welford()
+        batched.update_many(values[:123])
+        batched.update_many(values[123:])
+
+        for welford in (one_by_one, batched):
+            self.assertEqual(welford.count, 500)
+            self.assertAlmostEqual(welford.get_mean(), values.mean(), places=9)
+            self.assertAlmostEqual(welford.get_variance(), values.var(ddof=1), places=6)
+
+    def test_rejects_outliers(self):
+        samples = np.random.default_rng(1).normal(1100, 2, 400)
+        samples[::50] = 1600  # Key bumped for a few samples
+        stats = calibration.robust_statistics(samples)
+        self.assertEqual(stats.rejected_count, 8)
+        self.assertAlmostEqual(stats.mean, 1100, delta=0.5)
+        self.assertLess(stats.standard_deviation, 3)
+
+    def test_constant_samples(self):
+        stats = calibration.robust_statistics([1834.5] * 50 + [1835.0] * 10)
+        self.assertEqual(stats.rejected_count, 0)
+        self.assertEqual(stats.mad, 0)
+
+    def test_find_plateaus(self):
+        rng = np.random.default_rng(2)
+        # Released, pressed to the bottom and held, released, half pressed, released again
+        moves = [(1800, 0, 300), (1000, 60, 200), (1800, 40, 200), (1400, 30, 50), (1800, 30, 100)]  # Level, samples moving, samples held
+        trace = []
+        previous = 1800
+        for level, moving, held in moves:
+            trace.append(np.linspace(previous, level, moving, endpoint=False))
+            trace.append(np.full(held, float(level)))
+            previous = level
+        trace = np.concatenate(trace)
+        trace += rng.normal(0, 3, len(trace))
+        trace[::97] = 0  # Glitches
+
+        plateaus = calibration.find_plateaus(trace)
+        self.assertTrue(plateaus.is_complete)
+        self.assertAlmostEqual(plateaus.up.mean, 1800, delta=1)
+        self.assertAlmostEqual(plateaus.down.mean, 1000, delta=1)
+
+        # Not pressed all the way yet, then still at the bottom
+        self.assertIsNone(calibration.find_plateaus(trace[:330]).down)
+        self.assertFalse(calibration.find_plateaus(trace[:500]).released)
+
+    def test_check_statistics(self):
+        self.assertIsNone(calibration.check_statistics(calibration.robust_statistics([1800, 1801, 1799]), True))
+        self.assertIn("too high", calibration.check_statistics(calibration.robust_statistics([1800, 1801, 1799]), False))
+        self.assertIn("too low", calibration.check_statistics(calibration.robust_statistics([1000, 1001, 999]), True))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,55 @@
+import unittest
+import pathlib
+import sys
+import tempfile
+sys.path.append('../APP')
+import calibration
+import calibration_store
+
+
+def stats(mean: float) -> calibration.CalibrationStatistics:
+    return calibration.CalibrationStatistics(mean, 2.0, mean, 1.0, 200, 0)
+
+
+class TestCalibrationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.store = calibration_store.CalibrationStore(pathlib.Path(self.directory.name) / "history" / "calibration.sqlite3")
+
+    def tearDown(self):
+        self.store.close()
+        self.directory.cleanup()
+
+    def test_drift_since_last_calibration(self):
+        self.store.record_calibration("A", 3, True, stats(1800), time_s=100)
+        self.store.record_calibration("A", 3, False, stats(1100), time_s=101)
+        self.assertIsNone(self.store.drift("A", 3))
+
+        self.store.record_rest_sample("A", 3, stats(1805), time_s=200)
+        self.store.record_rest_sample("A", 3, stats(1812), time_s=300)
+        drift = self.store.drift("A", 3)
+        self.assertEqual(drift.drift_adc, 12)
+        self.assertEqual(drift.sampled_time, 300)
+
+        # Re-calibrated since, old samples no longer count
+        self.store.record_calibration("A", 3, True, stats(1812), time_s=400)
+        self.assertIsNone(self.store.drift("A", 3))
+        self.assertEqual([record.mean for record in self.store.calibrations("A", 3)], [1800, 1100, 1812])
+        self.assertIsNone(self.store.drift("B", 3))
+
+    def test_drifted(self):
+        for serial_number, rest in (("A", 1830), ("B", 1805), ("C", 1760)):
+            for key_id in (2, 3, 4):
+                self.store.record_calibration(serial_number, key_id, True, stats(1800), time_s=100)
+                self.store.record_rest_sample(serial_number, key_id, stats(rest if key_id == 3 else 1801), time_s=200)
+        # Sampled before its last calibration
+        self.store.record_calibration("D", 3, True, stats(1800), time_s=300)
+        self.store.record_rest_sample("D", 3, stats(1900), time_s=200)
+
+        drifted = self.store.drifted(threshold_adc=20)
+        self.assertEqual([(drift.serial_number, drift.key_id, drift.drift_adc) for drift in drifted], [("C", 3, -40), ("A", 3, 30)])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
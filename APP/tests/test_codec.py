@@ -0,0 +1,93 @@
+import unittest
+import sys
+sys.path.append('../APP')
+import codec
+import fluxpad_interface
+
+
+class TestBinaryCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.codec = codec.BinaryCodec()
+
+    def decode_all(self, decoder, data: bytes):
+        return [self.codec.decode(frame) for frame in decoder.feed(data)]
+
+    def test_round_trip(self):
+        data = {"cmd": "w", "tkn": 7, "key": 2, "h_a": 0.25, "rt": True, "d_a": 12, "l_d": 150000, "rgb_c1": 0xFF8000, "rgb_s": 30.5}
+        decoder = self.codec.new_frame_decoder()
+        self.assertEqual(self.decode_all(decoder, self.codec.encode(data)), [data])
+
+    def test_adc_samples_override(self):
+        # Up to Fluxpad.ADC_SAMPLES_MAX
+        data = {"cmd": "w", "tkn": 9, "adc_n": 1024}
+        decoder = self.codec.new_frame_decoder()
+        self.assertEqual(self.decode_all(decoder, self.codec.encode(data)), [data])
+
+    def test_settings_crc(self):
+        data = {"cmd": "r", "tkn": 10, "crc": 0xCBF43926}
+        decoder = self.codec.new_frame_decoder()
+        self.assertEqual(self.decode_all(decoder, self.codec.encode(data)), [data])
+
+    def test_datastream_lists(self):
+        data = {"t": 4294967000, "adc": [1834.5, 1650.0, 1100.25], "ht": [2.5, 4.0, -0.125], "p": [1, 0, 0]}
+        decoder = self.codec.new_frame_decoder()
+        self.assertEqual(self.decode_all(decoder, self.codec.encode(data)), [data])
+        # The same keys as single values, eg. an analog read, keep their own field ids
+        data = {"cmd": "r", "key": 2, "adc": 1834.5, "ht": 2.5}
+        self.assertEqual(self.decode_all(decoder, self.codec.encode(data)), [data])
+        with self.assertRaises(ValueError):
+            self.codec.encode({"k_t": [1, 2]})
+
+    def test_truncated_list(self):
+        payload = self.codec.encode({"adc": [1.0, 2.0, 3.0]})[4:-1]
+        with self.assertRaises(ValueError):
+            self.codec.decode(payload[:-2])
+
+    def test_raw_datastream(self):
+        decoder = self.codec.new_frame_decoder()
+        for data in ({"cmd": "w", "tkn": 11, "dstrm_raw": True}, {"t": 1000, "raw": "0672000676000444a0", "p": 0b101}):
+            self.assertEqual(self.decode_all(decoder, self.codec.encode(data)), [data])
+
+    def test_every_message_key(self):
+        # A value of the type the struct format of the field takes
+        values = {"c": "r", "B": 1, "H": 1000, "I": 100000, "q": 1.5, "?": True, "f": 20.5, "s": "0672"}
+        keys = [value for name, value in vars(fluxpad_interface.MessageKey).items() if name.isupper()]
+        decoder = self.codec.new_frame_decoder()
+        for key in keys:
+            field = self.codec._FIELDS_BY_KEY.get(key)
+            if field is None:
+                field = self.codec._LIST_FIELDS_BY_KEY[key]
+            format = field.format.replace(codec.LIST_SUFFIX, "")
+            value = [values[format]] * 3 if field.format.endswith(codec.LIST_SUFFIX) else values[format]
+            with self.subTest(key=key):
+                self.assertEqual(self.decode_all(decoder, self.codec.encode({key: value})), [{key: value}])
+
+    def test_error_string(self):
+        data = {"error": "INVALID_KEY_ID"}
+        decoder = self.codec.new_frame_decoder()
+        self.assertEqual(self.decode_all(decoder, self.codec.encode(data)), [data])
+
+    def test_q22_10_truncates_like_firmware(self):
+        decoder = self.codec.new_frame_decoder()
+        decoded, = self.decode_all(decoder, self.codec.encode({"p_a": 0.2}))
+        self.assertEqual(decoded["p_a"], 204 / 1024)
+
+    def test_unknown_key(self):
+        with self.assertRaises(ValueError):
+            self.codec.encode({"not_a_key": 1})
+
+    def test_skips_noise_and_bad_frames(self):
+        frame = self.codec.encode({"cmd": "r", "tkn": 3, "adc": 1834.5})
+        corrupted = bytearray(frame)
+        corrupted[-2] ^= 0xFF
+        data = b"Loop freq: 2000.000000\n" + bytes(corrupted) + b"\xa5" + frame
+        decoder = self.codec.new_frame_decoder()
+        frames = []
+        for i in range(len(data)):
+            frames += self.decode_all(decoder, data[i:i + 1])
+        self.assertEqual(frames, [{"cmd": "r", "tkn": 3, "adc": 1834.5}])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,46 @@
+import unittest
+import sys
+sys.path.append('../APP')
+import numpy as np
+import fixed_point
+
+
+class TestFixedPoint(unittest.TestCase):
+
+    # calibration down, calibration up, reading, calibrated reading, height, all Q22.10 from the firmware code
+    FIRMWARE_RESULTS = np.array([
+        (1126400, 1689600, 0, 4290209792, 10240),
+        (1126400, 1689600, 1480000, 2292677, 3717),
+        (1126400, 1689600, 2960000, 9342859, 10240),
+        (1834000, 3000000, 245680, 4291920945, 10240),
+        (1834000, 3000000, 1725680, 359019, 1067),
+        (1834000, 3000000, 3205680, 3764390, 9400),
+        (3000000, 1200000, 491360, 4347356, 10240),
+        (3000000, 1200000, 1971360, 2141432, 3534),
+        (3000000, 1200000, 3451360, 4294902805, 10240),
+    ])
+
+    def test_matches_firmware(self):
+        down, up, reading, calibrated, height = self.FIRMWARE_RESULTS.T
+        np.testing.assert_array_equal(fixed_point.apply_calibration(reading, down, up), calibrated)
+        np.testing.assert_array_equal(fixed_point.reading_to_height(reading, down, up), height)
+
+    def test_lut_points(self):
+        counts = fixed_point.int_to_q22_10(np.arange(0, 4097, 256))
+        np.testing.assert_array_equal(fixed_point.adc_counts_to_distance_mm(counts), fixed_point.ADC_TO_DIST_LUT)
+
+    def test_conversions(self):
+        self.assertEqual(fixed_point.to_q22_10(0.2), 204)
+        self.assertEqual(fixed_point.to_q22_10(2.79), 2856)
+        self.assertEqual(fixed_point.round_to_q22_10(2.099609), 2150)
+        self.assertEqual(fixed_point.q22_10_to_float(2150), np.float32(2.099609375))
+        self.assertEqual(fixed_point.take_avg_reading([[1, 2, 2]]).tolist(), [1706])
+
+    def test_raw_adc_to_height(self):
+        # The reference positions land on the reference heights when calibration matches them
+        height = fixed_point.raw_adc_to_height_mm([594.0, 3214.0], calibration_down_adc=594, calibration_up_adc=3214)
+        np.testing.assert_allclose(height, [2.0, 6.0], atol=0.01)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,123 @@
+import unittest
+import os
+import sys
+import tempfile
+sys.path.append('../APP')
+import numpy as np
+import fluxlog
+import fluxpad_interface
+
+
+class TestFluxlog(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "capture.fluxlog")
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def record(self, count: int, close: bool = True):
+        recorder = fluxlog.FluxlogRecorder(self.path, chunk_records=16)
+        for i in range(count):
+            recorder.append(i * 0.001, i * 1000, [i, 0, 0], [i / 100, 1, 2], [i % 2, 0, 1])
+        if close:
+            recorder.close()
+        else:
+            recorder.flush()
+        return recorder
+
+    def test_round_trip(self):
+        self.record(100)
+        with fluxlog.FluxlogReader(self.path) as reader:
+            self.assertTrue(reader.is_complete)
+            self.assertEqual(len(reader), 100)
+            self.assertEqual(reader.key_ids, (2, 3, 4))
+            self.assertEqual(len(reader.index), 7)
+            self.assertEqual(reader.records["raw_adc"][:, 0].tolist(), list(range(100)))
+            self.assertEqual(reader.records["pressed"][5].tolist(), [1, 0, 1])
+
+    def test_time_range(self):
+        self.record(100)
+        with fluxlog.FluxlogReader(self.path) as reader:
+            records = reader.time_range(0.0305, 0.050)
+            self.assertEqual(records["device_time_us"].tolist(), [i * 1000 for i in range(31, 50)])
+            records = reader.time_range(40000, 45000, device_time=True)
+            self.assertEqual(records["device_time_us"].tolist(), [i * 1000 for i in range(40, 45)])
+            self.assertEqual(len(reader.time_range(-1, 0)), 0)
+            self.assertEqual(len(reader.time_range(0, 10)), 100)
+            self.assertFalse(records.flags.writeable)
+
+    def test_unclosed_recording(self):
+        recorder = self.record(50, close=False)
+        with fluxlog.FluxlogReader(self.path) as reader:
+            self.assertFalse(reader.is_complete)
+            self.assertEqual(len(reader), 50)
+            self.assertEqual(reader.time_range(0.020, 0.040)["device_time_us"][0], 20000)
+        recorder.close()
+
+    def test_truncated_while_closing(self):
+        self.record(50)
+        with open(self.path, "rb") as file:
+            data = file.read()
+        records_end = fluxlog.HEADER_SIZE + 50 * fluxlog.record_dtype(3).itemsize
+        # Cut anywhere in the index or trailer
+        for size in range(records_end, len(data)):
+            with open(self.path, "wb") as file:
+                file.write(data[:size])
+            with fluxlog.FluxlogReader(self.path) as reader:
+                self.assertFalse(reader.is_complete)
+                self.assertEqual(len(reader), 50, f"Cut at {size}")
+                self.assertEqual(reader.index["first_record"].tolist(), [0, 16, 32, 48])
+                self.assertEqual(reader.find(0.049), 49)
+
+        # Last record torn inside its host time, then zeros where the next chunk should have been
+        record_size = fluxlog.record_dtype(3).itemsize
+        with open(self.path, "wb") as file:
+            file.write(data[:records_end - record_size + 3] + bytes(10 * record_size))
+        with fluxlog.FluxlogReader(self.path) as reader:
+            self.assertEqual(len(reader), 49)
+            self.assertEqual(reader.records["device_time_us"][-1], 48000)
+
+    def test_host_time_only(self):
+        with fluxlog.FluxlogRecorder(self.path, chunk_records=4) as recorder:
+            for i in range(10):
+                message = fluxpad_interface.AnalogReadMessage({"key": 2 + i % 3, "adc": 1800.0 + i, "ht": 1.0})
+                recorder.append_analog_read(message, host_time_s=i * 0.01)
+        with fluxlog.FluxlogReader(self.path) as reader:
+            self.assertEqual(len(reader.time_range(0.02, 0.05)), 3)
+            with self.assertRaises(ValueError):
+                reader.find(0, device_time=True)
+
+    def test_device_time_skips_host_time_only_records(self):
+        recorder = fluxlog.FluxlogRecorder(self.path, chunk_records=4)
+        message = fluxpad_interface.AnalogReadMessage({"key": 3, "adc": 1800.0, "ht": 1.0})
+        for i in range(20):
+            if i % 3 == 0:
+                # Polled reads in between start some of the chunks
+                recorder.append_analog_read(message, host_time_s=i * 0.001)
+            else:
+                recorder.append(i * 0.001, i * 1000, [i, 0, 0], [0, 0, 0], [0, 0, 0])
+        recorder.close()
+        with fluxlog.FluxlogReader(self.path) as reader:
+            self.assertEqual(reader.index["device_time_us"][0], fluxlog.NO_DEVICE_TIME)
+            self.assertEqual(reader.find(0, device_time=True), 1)
+            self.assertEqual(reader.find(5500, device_time=True), 7)
+            self.assertEqual(reader.find(12000, device_time=True), 13)
+            self.assertEqual(reader.find(19500, device_time=True), 20)
+            records = reader.time_range(4000, 11000, device_time=True)
+            self.assertEqual(records["device_time_us"].tolist(), [4000, 5000, -1, 7000, 8000, -1, 10000])
+
+    def test_analog_read(self):
+        message = fluxpad_interface.AnalogReadMessage({"key": 3, "adc": 1834.5, "ht": 1.25})
+        with fluxlog.FluxlogRecorder(self.path) as recorder:
+            recorder.append_analog_read(message, host_time_s=1.0)
+        with fluxlog.FluxlogReader(self.path) as reader:
+            record = reader.records[0]
+            self.assertEqual(record["raw_adc"][1], 1834.5)
+            self.assertTrue(np.isnan(record["height_mm"][0]))
+            self.assertEqual(record["device_time_us"], fluxlog.NO_DEVICE_TIME)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,628 @@
+import unittest
+import asyncio
+import json
+import os
+import queue
+import threading
+import time
+import select
+from unittest import mock
+from typing import Callable, List, Optional
+import sys
+sys.path.append('../APP')
+import fluxpad_interface
+import settings_schema
+
+
+class TestFrameDecoder(unittest.TestCase):
+
+    def decode(self, decoder: fluxpad_interface.FrameDecoder, data: bytes):
+        return [json.loads(bytes(frame)) for frame in decoder.feed(data)]
+
+    def test_skips_noise(self):
+        decoder = fluxpad_interface.FrameDecoder()
+        frames = self.decode(decoder, b'Loop freq: 2000.000000\n{"cmd":"v","V":2,"tkn":3}0.1 0.2 0.3  \n{"tkn":4}')
+        self.assertEqual(frames, [{"cmd": "v", "V": 2, "tkn": 3}, {"tkn": 4}])
+
+    def test_nested_braces_and_strings(self):
+        decoder = fluxpad_interface.FrameDecoder()
+        frames = self.decode(decoder, b'{"a":{"b":[1,{"c":2}]},"s":"}{\\"}"}')
+        self.assertEqual(frames, [{"a": {"b": [1, {"c": 2}]}, "s": '}{"}'}])
+
+    def test_split_across_feeds(self):
+        decoder = fluxpad_interface.FrameDecoder()
+        data = b'noise{"cmd":"r","s":"a\\"b}","key":2}{"tkn":5}'
+        frames = []
+        for i in range(len(data)):
+            frames += self.decode(decoder, data[i:i + 1])
+        self.assertEqual(frames, [{"cmd": "r", "s": 'a"b}', "key": 2}, {"tkn": 5}])
+
+    def test_small_buffer_compacts(self):
+        decoder = fluxpad_interface.FrameDecoder(buffer_size=32)
+        frames = self.decode(decoder, b'{"tkn":1}' * 20)
+        self.assertEqual(frames, [{"tkn": 1}] * 20)
+
+    def test_drops_oversized_frame(self):
+        decoder = fluxpad_interface.FrameDecoder(buffer_size=16)
+        frames = self.decode(decoder, b'{"a":"' + b'x' * 40 + b'"}{"b":1}')
+        self.assertEqual(frames, [{"b": 1}])
+
+
+class TestMessages(unittest.TestCase):
+
+    def test_set_zeros(self):
+        message = fluxpad_interface.AnalogReadMessage()
+        message.key_id = 3
+        message.set_zeros()
+        self.assertEqual(message.data, {"key": 0, "adc": 0, "ht": 0})
+
+    def test_field_validation(self):
+        message = fluxpad_interface.AnalogSettingsMessage()
+        message.actuate_point = 1.5
+        message.key_type = 1
+        self.assertEqual(message.data, {"p_a": 1.5, "k_t": 1})
+        with self.assertRaises(AssertionError):
+            message.actuate_point = 1
+        with self.assertRaises(AssertionError):
+            message.actuate_point = -0.5
+        with self.assertRaises(AssertionError):
+            message.key_code = 0x10000
+        with self.assertRaises(AssertionError):
+            message.key_type = 9
+
+    def test_read_only_field_requests_value(self):
+        message = fluxpad_interface.AnalogReadMessage({"adc": 1834.5})
+        self.assertEqual(message.raw_adc, 1834.5)
+        message.raw_adc = 12
+        self.assertEqual(message.data, {"adc": 0})
+
+
+class TestSettingsDiff(unittest.TestCase):
+
+    def test_changed_values(self):
+        message = fluxpad_interface.AnalogSettingsMessage()
+        message.key_id = 2
+        message.actuate_hysteresis = 0.2
+        message.release_hysteresis = 0.4
+        message.rapid_trigger = True
+        device_values = {"h_a": 0.19921875, "h_r": 0.2, "rt": True}
+
+        changed = fluxpad_interface.FluxpadSettings.get_changed_values(message, device_values)
+        self.assertEqual(changed, {"h_r": 0.4})
+
+    def test_unknown_device_values(self):
+        message = fluxpad_interface.RGBSettingsMessage()
+        message.speed = 20
+        message.mode = 1
+
+        changed = fluxpad_interface.FluxpadSettings.get_changed_values(message, None)
+        self.assertEqual(changed, {"rgb_s": 20, "rgb_m": 1})
+
+    def test_device_state_follows_serial_number(self):
+        settings = fluxpad_interface.FluxpadSettings()
+        settings.load_from_dict(settings_schema.default_settings())
+        settings.assume_device_state(fluxpad_interface.Fluxpad("/dev/ttyACM0", "E6614C311B4B7A28"))
+        self.assertTrue(settings.matches_device_state(fluxpad_interface.Fluxpad("/dev/ttyACM1", "E6614C311B4B7A28")))
+        # Another fluxpad plugged into the same port has been told none of it
+        other = fluxpad_interface.Fluxpad("/dev/ttyACM0", "E6614C311B4B7A29")
+        self.assertFalse(settings.matches_device_state(other))
+        settings._use_device(other)
+        self.assertEqual(settings._device_state, [None] * len(settings._device_state))
+
+        # Without a serial number only the port tells fluxpads apart
+        settings.assume_device_state(fluxpad_interface.Fluxpad("/dev/ttyACM0"))
+        self.assertTrue(settings.matches_device_state(fluxpad_interface.Fluxpad("/dev/ttyACM0")))
+        self.assertFalse(settings.matches_device_state(fluxpad_interface.Fluxpad("/dev/ttyACM1")))
+
+
+class LoopbackPort:
+    """Stands in for the serial port of a Fluxpad, the test plays the firmware.
+    Written frames are decoded into requests, replies are read back by the reader thread"""
+
+    def __init__(self, auto_reply: bool = False):
+        self.port = "loopback"
+        self.timeout = 0.02
+        self.is_open = True
+        self.requests: "queue.Queue[dict]" = queue.Queue()
+        self._auto_reply = auto_reply
+        self._decoder = fluxpad_interface.FrameDecoder()
+        self._incoming = bytearray()
+        self._incoming_changed = threading.Condition()
+        self._cancel_read = False
+        self._unplugged = False
+
+    @property
+    def in_waiting(self):
+        with self._incoming_changed:
+            return len(self._incoming)
+
+    def readinto(self, view: memoryview) -> int:
+        with self._incoming_changed:
+            if not self._incoming and not self._cancel_read:
+                self._incoming_changed.wait(self.timeout)
+            self._cancel_read = False
+            if self._unplugged:
+                raise fluxpad_interface.serial.SerialException("Device unplugged")
+            size = min(len(view), len(self._incoming))
+            view[:size] = self._incoming[:size]
+            del self._incoming[:size]
+            return size
+
+    def write(self, data: bytes) -> int:
+        for frame in self._decoder.feed(data):
+            request = json.loads(bytes(frame))
+            self.requests.put(request)
+            if self._auto_reply:
+                # Writes are echoed back like the firmware does
+                self.reply(request)
+        return len(data)
+
+    def reply(self, message: dict):
+        with self._incoming_changed:
+            self._incoming += json.dumps(message).encode()
+            self._incoming_changed.notify_all()
+
+    def unplug(self):
+        with self._incoming_changed:
+            self._unplugged = True
+            self._incoming_changed.notify_all()
+
+    def cancel_read(self):
+        with self._incoming_changed:
+            self._cancel_read = True
+            self._incoming_changed.notify_all()
+
+    def close(self):
+        self.is_open = False
+
+
+def wait_until(condition: Callable[[], object], timeout_s: float = 1.0) -> bool:
+    deadline_s = time.monotonic() + timeout_s
+    while not condition():
+        if time.monotonic() > deadline_s:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+def loopback_fluxpad(auto_reply: bool = False) -> fluxpad_interface.Fluxpad:
+    fluxpad = fluxpad_interface.Fluxpad("loopback")
+    fluxpad.port = LoopbackPort(auto_reply)
+    return fluxpad
+
+
+class TestPipelining(unittest.TestCase):
+
+    def setUp(self):
+        self.fluxpad = loopback_fluxpad()
+        self.port = self.fluxpad.port
+
+    def submit_reads(self, count: int):
+        futures = [self.fluxpad.submit_read_request(fluxpad_interface.BaseMessage({"key": key_id})) for key_id in range(count)]
+        requests = [self.port.requests.get(timeout=1.0) for _ in futures]
+        return futures, requests
+
+    def test_out_of_order_responses(self):
+        with self.fluxpad.pipelined():
+            futures, requests = self.submit_reads(5)
+            self.assertEqual(len({request["tkn"] for request in requests}), 5)
+            for request in reversed(requests):
+                self.port.reply({"cmd": "r", "tkn": request["tkn"], "key": request["key"], "adc": 100 * request["key"]})
+            responses = [future.result(timeout=1.0) for future in futures]
+        self.assertEqual([response.data["adc"] for response in responses], [0, 100, 200, 300, 400])
+        self.assertEqual(len(self.fluxpad.incoming_msgs), 0)
+
+    def test_request_expires(self):
+        self.fluxpad.REQUEST_TIMEOUT_S = 0.1
+        with self.fluxpad.pipelined():
+            start_s = time.monotonic()
+            futures, requests = self.submit_reads(1)
+            self.assertIsInstance(futures[0].exception(timeout=1.0), TimeoutError)
+            self.assertGreaterEqual(time.monotonic() - start_s, 0.1)
+            self.assertEqual(self.fluxpad._pending_requests, {})
+
+            # A late response is no longer anyone's, and the in flight slots are all free again
+            self.port.reply({"cmd": "r", "tkn": requests[0]["tkn"]})
+            self.assertTrue(wait_until(lambda: self.fluxpad.incoming_msgs))
+            self.assertEqual(self.fluxpad.incoming_msgs[0].data, {"cmd": "r", "tkn": requests[0]["tkn"]})
+            self.submit_reads(self.fluxpad.MAX_IN_FLIGHT)
+
+    def test_wait_for_response_timeout_frees_token(self):
+        self.fluxpad.REQUEST_TIMEOUT_S = 0.1
+        with self.fluxpad.pipelined():
+            with self.assertRaises(TimeoutError):
+                self.fluxpad.send_read_request(fluxpad_interface.BaseMessage({"key": 0}))
+            self.assertEqual(self.fluxpad._pending_requests, {})
+
+    def test_token_wraps_and_skips_tokens_in_flight(self):
+        self.fluxpad.last_token = 254
+        with self.fluxpad.pipelined():
+            futures, requests = self.submit_reads(2)
+            self.assertEqual([request["tkn"] for request in requests], [255, 1])
+            # Tokens 255 and 1 are still waiting on a response, so the next request can't reuse them
+            self.fluxpad.last_token = 254
+            later_futures, later_requests = self.submit_reads(1)
+            self.assertEqual(later_requests[0]["tkn"], 2)
+
+            for request in requests + later_requests:
+                self.port.reply({"cmd": "r", "tkn": request["tkn"], "key": request["key"]})
+            keys = [future.result(timeout=1.0).data["key"] for future in futures + later_futures]
+        self.assertEqual(keys, [0, 1, 0])
+
+    def test_pending_requests_fail_when_reader_stops(self):
+        with self.fluxpad.pipelined():
+            futures, _ = self.submit_reads(3)
+        for future in futures:
+            self.assertIsInstance(future.exception(timeout=1.0), ConnectionError)
+
+        with self.fluxpad.pipelined():
+            futures, _ = self.submit_reads(1)
+            self.port.unplug()
+            self.assertIsInstance(futures[0].exception(timeout=1.0), ConnectionError)
+            self.fluxpad._reader_thread.join(timeout=1.0)
+            self.assertFalse(self.fluxpad.is_pipelined)
+        with self.assertRaises(RuntimeError):
+            self.fluxpad.submit_read_request(fluxpad_interface.BaseMessage({"key": 0}))
+
+    def test_unsolicited_messages(self):
+        with self.fluxpad.pipelined():
+            futures, requests = self.submit_reads(1)
+            self.port.reply({"msg": "calibrating"})
+            self.port.reply({"cmd": "r", "tkn": requests[0]["tkn"] + 1})
+            self.port.reply({"cmd": "r", "tkn": requests[0]["tkn"], "key": 0})
+            futures[0].result(timeout=1.0)
+            self.assertTrue(wait_until(lambda: len(self.fluxpad.incoming_msgs) == 2))
+        self.assertEqual([message.data for message in self.fluxpad.incoming_msgs], [{"msg": "calibrating"}, {"cmd": "r", "tkn": requests[0]["tkn"] + 1}])
+
+
+def datastream_message(time_us: int, values: List[float]) -> dict:
+    return {"t": time_us, "adc": [1000 + value for value in values], "ht": values, "p": [value > 2 for value in values]}
+
+
+class TestStream(unittest.TestCase):
+
+    def setUp(self):
+        self.fluxpad = loopback_fluxpad(auto_reply=True)
+        self.fluxpad.STREAM_TIMEOUT_S = 0.2
+        self.addCleanup(self.fluxpad.close)
+
+    def feed_when_streaming(self, messages: List[dict], stream_count: int = 1):
+        """Hand datastream messages to the fluxpad as the reader would, once stream_count streams are open"""
+        def feed():
+            wait_until(lambda: len(self.fluxpad._stream_queues) >= stream_count)
+            for message in messages:
+                self.fluxpad._on_datastream_message(time.monotonic(), message)
+        feeder = threading.Thread(target=feed)
+        feeder.start()
+        self.addCleanup(feeder.join)
+
+    def datastream_rates(self) -> List[int]:
+        rates = []
+        while not self.fluxpad.port.requests.empty():
+            request = self.fluxpad.port.requests.get()
+            if "dstrm_freq" in request:
+                rates.append(request["dstrm_freq"])
+        return rates
+
+    def test_device_time_unwraps(self):
+        times_us = [(1 << 32) - 300, (1 << 32) - 100, 50, 250, 100]
+        self.feed_when_streaming([datastream_message(time_us, [0.0, 1.0, 2.0]) for time_us in times_us])
+        stream = self.fluxpad.stream()
+        samples = [next(stream) for _ in times_us]
+        stream.close()
+        self.assertEqual([sample.device_time_us for sample in samples],
+                         [(1 << 32) - 300, (1 << 32) - 100, (1 << 32) + 50, (1 << 32) + 250, (2 << 32) + 100])
+
+    def test_key_id_subset(self):
+        self.feed_when_streaming([datastream_message(10, [0.5, 1.5, 2.5])])
+        stream = self.fluxpad.stream(key_ids=(4, 2))
+        sample = next(stream)
+        stream.close()
+        self.assertEqual(sample.key_ids, (4, 2))
+        self.assertEqual(sample.height_mm, (2.5, 0.5))
+        self.assertEqual(sample.raw_adc, (1002.5, 1000.5))
+        self.assertEqual(sample.pressed, (True, False))
+
+    def test_turned_off_when_last_stream_closes(self):
+        self.feed_when_streaming([datastream_message(10, [0.0, 0.0, 0.0])])
+        first = self.fluxpad.stream(rate_hz=500)
+        next(first)
+        self.feed_when_streaming([datastream_message(20, [1.0, 1.0, 1.0])] * 2, stream_count=2)
+        second = self.fluxpad.stream(rate_hz=500)
+        self.assertEqual(next(second).device_time_us, 20)
+        self.assertEqual(self.datastream_rates(), [500, 500])
+
+        first.close()
+        self.assertEqual(self.datastream_rates(), [])
+        self.assertTrue(self.fluxpad.is_pipelined)
+        # Still streaming after the other one is gone
+        self.feed_when_streaming([datastream_message(30, [2.0, 2.0, 2.0])])
+        self.assertEqual(next(second).device_time_us, 20)
+        self.assertEqual(next(second).device_time_us, 30)
+        second.close()
+        self.assertEqual(self.datastream_rates(), [0])
+        self.assertFalse(self.fluxpad.is_pipelined)
+
+    def test_timeout_when_messages_stop(self):
+        self.feed_when_streaming([datastream_message(10, [0.0, 0.0, 0.0])])
+        stream = self.fluxpad.stream()
+        next(stream)
+        with self.assertRaises(TimeoutError):
+            next(stream)
+        # The generator is done and has turned datastream mode off
+        self.assertEqual(self.datastream_rates(), [1000, 0])
+        self.assertEqual(self.fluxpad._stream_queues, [])
+
+
+class PtyFirmware:
+    """Plays the firmware on the far end of a pty, handler turns each request into the replies to send"""
+
+    def __init__(self, handler: Callable[[dict], List[dict]]):
+        self.handler = handler
+        # The slave end is held open too, the master reads EIO whenever nothing has it open
+        self._master_fd, self._slave_fd = os.openpty()
+        self.port = os.ttyname(self._slave_fd)
+        self._decoder = fluxpad_interface.FrameDecoder()
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            try:
+                select.select([self._master_fd], [], [])
+                data = os.read(self._master_fd, 4096)
+            except OSError:
+                return
+            for frame in self._decoder.feed(data):
+                for reply in self.handler(json.loads(bytes(frame))):
+                    os.write(self._master_fd, json.dumps(reply).encode())
+
+    def close(self):
+        os.close(self._master_fd)
+        os.close(self._slave_fd)
+        self._thread.join(timeout=1.0)
+
+
+@unittest.skipUnless(hasattr(os, "openpty"), "Needs a pty")
+class TestAsyncFluxpad(unittest.TestCase):
+
+    def setUp(self):
+        self.requests = []
+        self.held_requests = []
+        self.firmware: Optional[PtyFirmware] = None
+
+    def tearDown(self):
+        if self.firmware is not None:
+            self.firmware.close()
+
+    def run_with(self, handler: Callable[[dict], List[dict]], test: Callable):
+        self.firmware = PtyFirmware(handler)
+
+        async def run():
+            async with fluxpad_interface.AsyncFluxpad(self.firmware.port) as fluxpad:
+                fluxpad.REQUEST_TIMEOUT_S = 0.2
+                return await test(fluxpad)
+        return asyncio.run(run())
+
+    def reply_in_reverse(self, request: dict) -> List[dict]:
+        # Hold requests and answer each batch of four last first
+        self.held_requests.append(request)
+        if len(self.held_requests) < 4:
+            return []
+        replies = [{**held, "adc": 100 * held["key"]} for held in reversed(self.held_requests)]
+        self.held_requests.clear()
+        return replies
+
+    def test_concurrent_requests(self):
+        write_threads = set()
+
+        async def test(fluxpad):
+            port_write = fluxpad.port.write
+            fluxpad.port.write = lambda data: write_threads.add(threading.current_thread()) or port_write(data)
+            return await asyncio.gather(*(fluxpad.send_read_request(fluxpad_interface.BaseMessage({"key": key_id})) for key_id in range(12)))
+
+        responses = self.run_with(self.reply_in_reverse, test)
+        self.assertEqual([response.data["adc"] for response in responses], [100 * key_id for key_id in range(12)])
+        # Written off the event loop, always from the same thread
+        self.assertEqual(len(write_threads), 1)
+        self.assertIsNot(write_threads.pop(), threading.main_thread())
+
+    def test_timeout(self):
+        async def test(fluxpad):
+            ignored = asyncio.ensure_future(fluxpad.send_read_request(fluxpad_interface.BaseMessage({"key": 7})))
+            answered = await fluxpad.send_read_request(fluxpad_interface.BaseMessage({"key": 0}))
+            with self.assertRaises(asyncio.TimeoutError):
+                await ignored
+            self.assertEqual(fluxpad._pending_requests, {})
+            return answered
+
+        response = self.run_with(lambda request: [] if request["key"] == 7 else [request], test)
+        self.assertEqual(response.data["key"], 0)
+
+    def test_reader_failure(self):
+        async def test(fluxpad):
+            pending = asyncio.ensure_future(fluxpad.send_read_request(fluxpad_interface.BaseMessage({"key": 0})))
+            await asyncio.sleep(0.05)
+            # The device goes away with a request in flight
+            self.firmware.close()
+            self.firmware = None
+            with self.assertRaises(OSError):
+                await pending
+
+        self.run_with(lambda request: [], test)
+
+    def test_close_fails_pending_requests(self):
+        async def test(fluxpad):
+            pending = asyncio.ensure_future(fluxpad.send_read_request(fluxpad_interface.BaseMessage({"key": 0})))
+            await asyncio.sleep(0.05)
+            await fluxpad.close()
+            with self.assertRaises(ConnectionError):
+                await pending
+            with self.assertRaises(ConnectionError):
+                await fluxpad.send_read_request(fluxpad_interface.BaseMessage({"key": 0}))
+
+        self.run_with(lambda request: [], test)
+
+
+class FakeFluxpad:
+    """Stands in for a Fluxpad whose port opens without hardware"""
+
+    failing_ports = set()  # Ports that fail to open
+
+    def __init__(self, port: str = "fake", serial_number: Optional[str] = None):
+        self.port = fluxpad_interface.serial.Serial()
+        self.port.port = port
+        self.serial_number = serial_number
+        self.is_open = False
+
+    def open(self):
+        if self.port.port in self.failing_ports:
+            raise fluxpad_interface.serial.SerialException(f"could not open port {self.port.port}")
+        self.is_open = True
+
+    def negotiate_codec(self):
+        pass
+
+    def start_reader(self):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class TestFluxpadSession(unittest.TestCase):
+
+    def test_jobs_run_in_order_on_one_thread(self):
+        fluxpad = FakeFluxpad()
+        session = fluxpad_interface.FluxpadSession(fluxpad)
+        session.start()
+        futures = [session.submit(lambda i=i: (i, threading.current_thread().name, fluxpad.is_open)) for i in range(10)]
+        results = [future.result(timeout=1.0) for future in futures]
+        session.stop()
+
+        self.assertEqual([result[0] for result in results], list(range(10)))
+        self.assertEqual({result[1] for result in results}, {"fluxpadsession"})
+        self.assertTrue(all(result[2] for result in results))
+        self.assertFalse(fluxpad.is_open)
+
+    def test_submit_after_stop(self):
+        session = fluxpad_interface.FluxpadSession(FakeFluxpad())
+        session.start()
+        session.stop()
+        with self.assertRaises(ConnectionError):
+            session.submit(lambda: None)
+
+
+class TestFluxpadManager(unittest.TestCase):
+
+    def setUp(self):
+        self.ports = dict()
+        self.events = []
+        patches = [
+            mock.patch.object(fluxpad_interface, "find_fluxpad_ports", lambda: dict(self.ports)),
+            mock.patch.object(fluxpad_interface, "Fluxpad", FakeFluxpad),
+            mock.patch.object(FakeFluxpad, "failing_ports", set()),
+            mock.patch.object(fluxpad_interface.FluxpadSession, "OPEN_RETRY_S", 0.0),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+        self.manager = fluxpad_interface.FluxpadManager(
+            on_connect=lambda serial_number, session: self.events.append(("connect", serial_number, session.fluxpad.port.port)),
+            on_disconnect=lambda serial_number: self.events.append(("disconnect", serial_number)),
+            use_hotplug=False)
+        self.addCleanup(self.manager.stop)
+
+    def test_add_remove_and_move(self):
+        self.ports["A"] = "/dev/ttyACM0"
+        self.manager.rescan()
+        session_a = self.manager.get_session("A")
+        self.ports["B"] = "/dev/ttyACM1"
+        self.manager.rescan()
+        self.manager.rescan()
+        self.assertEqual(self.events, [("connect", "A", "/dev/ttyACM0"), ("connect", "B", "/dev/ttyACM1")])
+        self.assertTrue(session_a.run(lambda: session_a.fluxpad.is_open))
+
+        # Replugged into another port
+        self.events.clear()
+        self.ports["A"] = "/dev/ttyACM2"
+        self.manager.rescan()
+        self.assertEqual(self.events, [("disconnect", "A"), ("connect", "A", "/dev/ttyACM2")])
+        self.assertFalse(session_a.is_running)
+        self.assertFalse(session_a.fluxpad.is_open)
+        self.assertIsNot(self.manager.get_session("A"), session_a)
+
+        self.events.clear()
+        del self.ports["B"]
+        self.manager.rescan()
+        self.assertEqual(self.events, [("disconnect", "B")])
+        self.assertEqual(list(self.manager.sessions), ["A"])
+
+        self.events.clear()
+        self.manager.stop()
+        self.assertEqual(self.events, [("disconnect", "A")])
+        self.assertEqual(self.manager.sessions, {})
+
+    def test_worker_picks_up_changes(self):
+        self.manager.LISTEN_PERIOD_S = 0.01
+        self.ports["A"] = "/dev/ttyACM0"
+        self.manager.start()
+        self.assertEqual(self.events, [("connect", "A", "/dev/ttyACM0")])
+        del self.ports["A"]
+        self.assertTrue(wait_until(lambda: len(self.events) == 2))
+        self.assertEqual(self.events[1], ("disconnect", "A"))
+
+    def test_submit_all_with_stopped_session(self):
+        self.ports.update({"A": "/dev/ttyACM0", "B": "/dev/ttyACM1"})
+        self.manager.rescan()
+        self.manager.get_session("B").stop()
+        futures = self.manager.submit_all(lambda fluxpad, suffix: fluxpad.port.port + suffix, "!")
+        self.assertEqual(futures["A"].result(timeout=1.0), "/dev/ttyACM0!")
+        self.assertIsInstance(futures["B"].exception(timeout=1.0), ConnectionError)
+
+    def test_run_all_error(self):
+        self.ports.update({"A": "/dev/ttyACM0", "B": "/dev/ttyACM1", "C": "/dev/ttyACM2"})
+        self.manager.rescan()
+        ran = []
+
+        def job(fluxpad):
+            ran.append(fluxpad.serial_number)
+            if fluxpad.serial_number == "B":
+                raise ValueError("Bad settings")
+            return fluxpad.serial_number
+
+        with self.assertRaisesRegex(ValueError, "Bad settings"):
+            self.manager.run_all(job)
+        # The others still ran to the end
+        self.assertEqual(sorted(ran), ["A", "B", "C"])
+        self.assertEqual(self.manager.run_all(lambda fluxpad: fluxpad.serial_number), {"A": "A", "B": "B", "C": "C"})
+
+    def test_failed_open_is_retried(self):
+        FakeFluxpad.failing_ports.add("/dev/ttyACM0")
+        self.ports["A"] = "/dev/ttyACM0"
+        self.manager.rescan()
+        session = self.manager.get_session("A")
+        with self.assertRaises(ConnectionError):
+            session.run(lambda: None)
+        self.assertIsInstance(session.open_error, fluxpad_interface.serial.SerialException)
+
+        # Still failing, dropped and tried again on every scan
+        self.manager.rescan()
+        self.assertEqual(self.events, [("connect", "A", "/dev/ttyACM0"), ("disconnect", "A"), ("connect", "A", "/dev/ttyACM0")])
+        self.assertFalse(session.is_running)
+
+        with self.assertRaises(ConnectionError):
+            self.manager.get_session("A").run(lambda: None)
+
+        FakeFluxpad.failing_ports.clear()
+        self.manager.rescan()
+        session = self.manager.get_session("A")
+        self.assertTrue(session.run(lambda: session.fluxpad.is_open))
+        self.assertIsNone(session.open_error)
+        self.events.clear()
+        self.manager.rescan()
+        self.assertEqual(self.events, [])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,61 @@
+import unittest
+import struct
+import threading
+import time
+import sys
+sys.path.append('../APP')
+import hotplug
+
+
+class TestTtyEvents(unittest.TestCase):
+
+    def test_kernel_event(self):
+        uevent = b"add@/devices/usb1/1-1/1-1:1.0/tty/ttyACM0\x00ACTION=add\x00DEVPATH=/devices/usb1/1-1/1-1:1.0/tty/ttyACM0\x00SUBSYSTEM=tty\x00DEVNAME=ttyACM0\x00"
+        self.assertTrue(hotplug.TtyEventMonitor.is_tty_event(uevent))
+        self.assertFalse(hotplug.TtyEventMonitor.is_tty_event(uevent.replace(b"SUBSYSTEM=tty", b"SUBSYSTEM=usb")))
+        self.assertFalse(hotplug.TtyEventMonitor.is_tty_event(uevent.replace(b"ACTION=add", b"ACTION=change")))
+
+    def test_udev_event(self):
+        properties = b"ACTION=remove\x00SUBSYSTEM=tty\x00DEVNAME=/dev/ttyACM0\x00"
+        header = hotplug.UDEV_HEADER_PREFIX + struct.pack(">I", 0xfeedcafe) + struct.pack("=IIIIIII", 40, 40, len(properties), 0, 0, 0, 0x41434b00)
+        self.assertTrue(hotplug.TtyEventMonitor.is_tty_event(header + properties))
+
+
+class ScriptedMonitor(hotplug.TtyEventMonitor):
+    """Monitor whose wait() returns the given results in turn instead of reading uevents"""
+
+    def __init__(self, results):
+        self.results = list(results)
+        self.wait_count = 0
+
+    def wait(self, timeout=None) -> bool:
+        self.wait_count += 1
+        if self.results:
+            return self.results.pop(0)
+        time.sleep(timeout)
+        return False
+
+
+class TestWaitForTtyEvent(unittest.TestCase):
+
+    def test_other_uevents_keep_waiting(self):
+        monitor = ScriptedMonitor([False, False, False, True])
+        self.assertTrue(monitor.wait_for_tty_event(5.0, threading.Event()))
+        self.assertEqual(monitor.wait_count, 4)
+
+    def test_timeout(self):
+        monitor = ScriptedMonitor([False] * 3)
+        start_s = time.monotonic()
+        self.assertFalse(monitor.wait_for_tty_event(0.05, threading.Event()))
+        self.assertGreaterEqual(time.monotonic() - start_s, 0.05)
+
+    def test_stop_request(self):
+        monitor = ScriptedMonitor([False] * 3)
+        stop_request = threading.Event()
+        stop_request.set()
+        self.assertFalse(monitor.wait_for_tty_event(5.0, stop_request))
+        self.assertEqual(monitor.wait_count, 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
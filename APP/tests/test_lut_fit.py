@@ -0,0 +1,65 @@
+import unittest
+import pathlib
+import sys
+import tempfile
+sys.path.append('../APP')
+import numpy as np
+import fixed_point
+import fluxlog
+import lut_fit
+
+CALIBRATION_DOWN = 1100.0
+CALIBRATION_UP = 1650.0
+
+
+def key_curve_mm() -> np.ndarray:
+    """A key whose magnet is a bit off from the stock table, same at the calibrated points"""
+    stock = np.asarray(fixed_point.ADC_TO_DIST_LUT_MM)
+    return stock + 0.3 * np.sin(np.pi * (stock - 2) / 4) * ((stock > 2) & (stock < 6))
+
+
+def sweep_readings(height_mm: np.ndarray) -> np.ndarray:
+    """Raw ADC readings of the key at the given heights"""
+    counts = np.interp(height_mm, key_curve_mm(), lut_fit.TABLE_KNOTS_ADC)
+    scale = (CALIBRATION_UP - CALIBRATION_DOWN) / (fixed_point.REFERENCE_UP_ADC - fixed_point.REFERENCE_DOWN_ADC)
+    return CALIBRATION_DOWN + (counts - fixed_point.REFERENCE_DOWN_ADC) * scale
+
+
+class TestLutFit(unittest.TestCase):
+
+    def test_isotonic(self):
+        np.testing.assert_allclose(lut_fit.isotonic(np.array([1.0, 3.0, 2.0, 4.0]), np.ones(4)), [1, 2.5, 2.5, 4])
+        np.testing.assert_allclose(lut_fit.isotonic(np.array([1.0, 3.0, 2.0]), np.array([1.0, 1.0, 3.0])), [1, 2.25, 2.25])
+
+    def test_fit_beats_stock_table(self):
+        height_mm = np.linspace(6, 2, 4000)
+        raw_adc = sweep_readings(height_mm) + np.random.default_rng(0).normal(0, 1, len(height_mm))
+        sweep = lut_fit.Sweep(raw_adc, height_mm, CALIBRATION_DOWN, CALIBRATION_UP)
+        fit = lut_fit.fit_key(sweep, 2)
+
+        self.assertTrue(np.all(np.diff(fit.table_mm) >= 0))
+        self.assertGreater(fit.stock_error.max_mm, 0.2)
+        self.assertLess(fit.fitted_error.rms_mm, fit.stock_error.rms_mm / 4)
+        # No samples up there, stays at the stock values
+        np.testing.assert_allclose(fit.table_mm[-2:], fixed_point.ADC_TO_DIST_LUT_MM[-2:], atol=0.01)
+
+    def test_constant_speed_sweep_from_recording(self):
+        # Rest, slow press to the bottom, held there
+        height_mm = np.concatenate([np.full(500, 6.0), np.linspace(6, 2, 3000), np.full(500, 2.0)])
+        raw_adc = sweep_readings(height_mm) + np.random.default_rng(1).normal(0, 1, len(height_mm))
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "sweep.fluxlog"
+            with fluxlog.FluxlogRecorder(path, key_ids=(2,)) as recorder:
+                for i, reading in enumerate(raw_adc):
+                    recorder.append(i / 2000, i * 500, [reading], [0.0], [False])
+            sweep = lut_fit.load_sweep(path, 2)
+
+        self.assertAlmostEqual(sweep.calibration_up, sweep_readings(np.array([6.0]))[0], delta=0.5)
+        self.assertAlmostEqual(sweep.calibration_down, sweep_readings(np.array([2.0]))[0], delta=0.5)
+        self.assertAlmostEqual(len(sweep.raw_adc), 3000, delta=150)
+        fit = lut_fit.fit_key(sweep, 2)
+        self.assertLess(fit.fitted_error.rms_mm, 0.05)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,110 @@
+import unittest
+import pathlib
+import sys
+import tempfile
+import time
+import os
+import types
+from unittest import mock
+sys.path.append('../APP')
+import fluxpad_interface
+import profile_library
+
+
+def make_settings(actuate_point: float, rgb_mode: int = 1) -> fluxpad_interface.FluxpadSettings:
+    settings = fluxpad_interface.FluxpadSettings()
+    for key_id, key_settings in enumerate(settings.key_settings_list):
+        key_settings.data = {"cmd": "r", "key": key_id, "k_t": 1, "k_c": 4}
+    for key_settings in settings.key_settings_list[2:5]:
+        key_settings.actuate_point = actuate_point
+        key_settings.rapid_trigger = True
+    settings.rgb_settings.data = {"rgb_m": rgb_mode, "rgb_c1": 0xFF0000}
+    return settings
+
+
+class TestProfileLibrary(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = pathlib.Path(self.directory.name)
+        self.library = profile_library.ProfileLibrary(self.path)
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def block_count(self) -> int:
+        return len(list((self.path / "blocks").glob("*.json")))
+
+    def test_save_and_load(self):
+        settings = make_settings(2.5)
+        profile = self.library.save("fps", settings)
+        # Reopened from disk
+        loaded = profile_library.ProfileLibrary(self.path).load("fps")
+        for key_id, (expected, actual) in enumerate(zip(settings.key_settings_list, loaded.key_settings_list)):
+            self.assertEqual(actual.key_id, key_id)
+            self.assertEqual(fluxpad_interface.FluxpadSettings.get_setting_values(actual), fluxpad_interface.FluxpadSettings.get_setting_values(expected))
+        self.assertEqual(loaded.rgb_settings.data, settings.rgb_settings.data)
+        self.assertEqual(self.library.save("fps copy", loaded).profile_hash, profile.profile_hash)
+
+    def test_blocks_are_shared(self):
+        self.library.save("a", make_settings(2.5))
+        # Keys set up the same share a block, whatever their key id
+        blocks = self.block_count()
+        self.assertEqual(blocks, 3)
+        # Only the analog keys differ
+        self.library.save("b", make_settings(1.0))
+        self.assertEqual(self.block_count(), blocks + 1)
+        self.library.save("c", make_settings(1.0, rgb_mode=2))
+        self.assertEqual(self.block_count(), blocks + 2)
+
+        self.library.delete("c")
+        self.assertEqual(self.block_count(), blocks + 1)
+        self.library.delete("a")
+        self.assertEqual(self.block_count(), blocks)
+        self.assertEqual(self.library.names(), ["b"])
+
+    def test_switch_writes_only_differences(self):
+        self.library.save("a", make_settings(2.5))
+        self.library.save("b", make_settings(1.0))
+        fluxpad = types.SimpleNamespace(serial_number="E6614C311B4B7A28", port=types.SimpleNamespace(port="/dev/ttyACM0"))
+        settings = self.library.load("a")
+        settings.assume_device_state(fluxpad)
+
+        self.library.load_into("b", settings)
+        changed = [settings.get_changed_values(message, device_values) for message, device_values in zip(settings._all_settings(), settings._device_state)]
+        self.assertEqual([key_id for key_id, values in enumerate(changed) if values], [2, 3, 4])
+        self.assertEqual(changed[2], {"p_a": 1.0})
+
+    def test_concurrent_changes_are_kept(self):
+        # Another process with the library open from before either change
+        other = profile_library.ProfileLibrary(self.path)
+        self.library.save("a", make_settings(2.5))
+        other.save("b", make_settings(1.0))
+        self.assertEqual(profile_library.ProfileLibrary(self.path).names(), ["a", "b"])
+
+        # Sharing blocks with a profile the deleting process doesn't know about yet
+        other.save("c", make_settings(2.5, rgb_mode=3))
+        self.library.delete("a")
+        reopened = profile_library.ProfileLibrary(self.path)
+        self.assertEqual(reopened.names(), ["b", "c"])
+        self.assertEqual(reopened.load("c").key_settings_list[2].actuate_point, 2.5)
+        self.assertFalse((self.path / "index.lock").exists())
+
+    def test_lock(self):
+        lock_path = self.path / "index.lock"
+        lock_path.write_text("12345")
+        with mock.patch.object(profile_library, "LOCK_TIMEOUT_S", 0.05):
+            with self.assertRaises(TimeoutError):
+                self.library.save("a", make_settings(2.5))
+        self.assertEqual(self.library.names(), [])
+
+        # Left behind by a process that died holding it
+        stale_time = time.time() - profile_library.LOCK_STALE_S - 1
+        os.utime(lock_path, (stale_time, stale_time))
+        self.library.save("a", make_settings(2.5))
+        self.assertEqual(profile_library.ProfileLibrary(self.path).names(), ["a"])
+        self.assertFalse(lock_path.exists())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
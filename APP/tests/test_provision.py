@@ -0,0 +1,161 @@
+import unittest
+import concurrent.futures
+import contextlib
+import io
+import pathlib
+import sys
+import tempfile
+import types
+from unittest import mock
+sys.path.append('../APP')
+import fluxpad_interface
+import provision
+import settings_schema
+
+
+class FakeFluxpad:
+    """Stands in for a Fluxpad at the request level, keeps what is written to it like the firmware does.
+    Everything opened on the same port shares that port's storage"""
+
+    storage = dict()  # Setting values by key id or "rgb", per port
+    writes = dict()  # Write requests answered, per port
+    failing_writes = dict()  # Writes after which a port stops answering them
+    failing_ports = set()  # Ports that fail to open
+
+    def __init__(self, port: str, serial_number=None):
+        self.port = types.SimpleNamespace(port=port, is_open=False)
+        self.serial_number = serial_number
+        self.storage.setdefault(port, dict())
+        self.writes.setdefault(port, 0)
+
+    def open(self):
+        if self.port.port in self.failing_ports:
+            raise fluxpad_interface.serial.SerialException(f"could not open port {self.port.port}")
+        self.port.is_open = True
+
+    def close(self):
+        self.port.is_open = False
+
+    @contextlib.contextmanager
+    def pipelined(self):
+        yield self
+
+    def _stored_values(self, message) -> dict:
+        return self.storage[self.port.port].setdefault(message.data.get(fluxpad_interface.MessageKey.KEY_ID, "rgb"), dict())
+
+    def submit_read_request(self, message) -> concurrent.futures.Future:
+        stored_values = self._stored_values(message)
+        future = concurrent.futures.Future()
+        future.set_result(type(message)({key: stored_values.get(key, value) for key, value in message.data.items()}))
+        return future
+
+    def submit_write_request(self, message) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        if self.writes[self.port.port] >= self.failing_writes.get(self.port.port, float("inf")):
+            future.set_exception(TimeoutError("No response"))
+            return future
+        self.writes[self.port.port] += 1
+        self._stored_values(message).update(fluxpad_interface.FluxpadSettings.get_setting_values(message))
+        future.set_result(message)
+        return future
+
+    def wait_for_response(self, future: concurrent.futures.Future):
+        return future.result()
+
+
+def make_profile() -> fluxpad_interface.FluxpadSettings:
+    profile = fluxpad_interface.FluxpadSettings()
+    profile.load_from_dict(settings_schema.default_settings())
+    for key_id, key_settings in enumerate(profile.key_settings_list):
+        key_settings.key_code = 4 + key_id
+    profile.rgb_settings.mode = 1
+    return profile
+
+
+class TestProvision(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.profile_path = pathlib.Path(self.directory.name) / "profile.json"
+        make_profile().save_to_file(self.profile_path)
+        self.ports = {"A": "/dev/ttyACM0", "B": "/dev/ttyACM1"}
+        patches = [
+            mock.patch.object(fluxpad_interface, "find_fluxpad_ports", lambda: dict(self.ports)),
+            mock.patch.object(fluxpad_interface, "Fluxpad", FakeFluxpad),
+            mock.patch.object(FakeFluxpad, "storage", dict()),
+            mock.patch.object(FakeFluxpad, "writes", dict()),
+            mock.patch.object(FakeFluxpad, "failing_writes", dict()),
+            mock.patch.object(FakeFluxpad, "failing_ports", set()),
+        ]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def run_main(self, *argv: str):
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(io.StringIO()):
+            exit_code = provision.main([*argv])
+        return exit_code, stdout.getvalue()
+
+    def test_verify_save_verify(self):
+        exit_code, output = self.run_main(str(self.profile_path))
+        self.assertEqual(exit_code, 0)
+        self.assertIn("2/2 fluxpads provisioned", output)
+        self.assertEqual(len([line for line in output.splitlines() if line.endswith("  OK")]), 2)
+        profile = make_profile()
+        for port in self.ports.values():
+            self.assertEqual(FakeFluxpad.storage[port][3], fluxpad_interface.FluxpadSettings.get_setting_values(profile.key_settings_list[3]))
+            self.assertEqual(FakeFluxpad.storage[port]["rgb"], profile.rgb_settings.data)
+            self.assertEqual(FakeFluxpad.writes[port], len(profile.key_settings_list) + 1)
+
+        # Already provisioned, the first verify finds nothing to write
+        exit_code, output = self.run_main(str(self.profile_path))
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(FakeFluxpad.writes["/dev/ttyACM0"], len(profile.key_settings_list) + 1)
+
+        # Only what differs is written
+        FakeFluxpad.storage["/dev/ttyACM1"][2]["p_a"] = 1.0
+        exit_code, output = self.run_main(str(self.profile_path), "--serial", "B")
+        self.assertEqual(exit_code, 0)
+        self.assertIn("1/1 fluxpads provisioned", output)
+        self.assertEqual(FakeFluxpad.writes["/dev/ttyACM1"], len(profile.key_settings_list) + 2)
+        self.assertEqual(FakeFluxpad.storage["/dev/ttyACM1"][2]["p_a"], 2.5)
+
+    def test_fluxpad_failing_partway(self):
+        self.ports["C"] = "/dev/ttyACM2"
+        FakeFluxpad.failing_writes["/dev/ttyACM1"] = 3
+        FakeFluxpad.failing_ports.add("/dev/ttyACM2")
+        exit_code, output = self.run_main(str(self.profile_path))
+        self.assertEqual(exit_code, 1)
+        self.assertIn("1/3 fluxpads provisioned", output)
+        lines = {line.split()[0]: line for line in output.splitlines()[1:-1]}
+        self.assertTrue(lines["A"].endswith("  OK"))
+        # The writes after the first three went unanswered, the read back shows which
+        self.assertIn("MISMATCH Key ID 3: k_c is 0, expected 7", lines["B"])
+        self.assertIn("RGB settings: rgb_m is 0, expected 1", lines["B"])
+        self.assertNotIn("Key ID 2", lines["B"])
+        self.assertIn("ERROR SerialException: could not open port /dev/ttyACM2", lines["C"])
+        self.assertEqual(FakeFluxpad.storage["/dev/ttyACM0"][6]["k_c"], 10)
+
+    def test_no_fluxpads(self):
+        self.ports.clear()
+        self.assertEqual(self.run_main(str(self.profile_path))[0], 1)
+
+    def test_bad_profile(self):
+        self.profile_path.write_text('{"key_settings": [')
+        stderr = io.StringIO()
+        with self.assertRaises(SystemExit) as context, contextlib.redirect_stderr(stderr):
+            provision.main([str(self.profile_path)])
+        self.assertEqual(context.exception.code, 2)
+        self.assertIn("Can't load profile", stderr.getvalue())
+        self.assertNotIn("Traceback", stderr.getvalue())
+
+        self.profile_path.write_text('{"version": 2, "key_settings": [], "rgb_settings": {}}')
+        with self.assertRaises(SystemExit), contextlib.redirect_stderr(stderr):
+            provision.main([str(self.profile_path)])
+        self.assertIn("no settings for key ids", stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
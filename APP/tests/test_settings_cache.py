@@ -0,0 +1,58 @@
+import unittest
+import sys
+import tempfile
+import types
+sys.path.append('../APP')
+import fluxpad_interface
+import settings_cache
+
+
+def fake_fluxpad(settings_crc):
+    """Just enough of a connected fluxpad to check a cache against"""
+    return types.SimpleNamespace(serial_number="E6614C311B4B7A28", port=types.SimpleNamespace(port="/dev/ttyACM0", is_open=True),
+                                 get_version=lambda: 2, get_settings_crc=lambda: settings_crc)
+
+
+class TestSettingsCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.cache = settings_cache.SettingsCache(self.directory.name)
+        self.settings = fluxpad_interface.FluxpadSettings()
+        for key_id, key_settings in enumerate(self.settings.key_settings_list):
+            key_settings.key_id = key_id
+        self.settings.key_settings_list[2].data = {"key": 2, "k_t": 1, "k_c": 4, "p_a": 2.5, "rt": True}
+        self.settings.rgb_settings.data = {"rgb_m": 1, "rgb_c1": 0xFF0000}
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_round_trip(self):
+        self.assertIsNone(self.cache.load("E6614C311B4B7A28"))
+        self.cache.store("E6614C311B4B7A28", 2, 0x1234ABCD, self.settings, time_s=100)
+        cached = self.cache.load("E6614C311B4B7A28")
+        self.assertEqual(cached.settings_crc, 0x1234ABCD)
+        self.assertEqual(cached.to_fluxpad_settings().to_dict(), self.settings.to_dict())
+
+        self.assertTrue(cached.is_current(2, 0x1234ABCD))
+        self.assertFalse(cached.is_current(2, 0x1234ABCE))
+        self.assertFalse(cached.is_current(3, 0x1234ABCD))
+        self.assertFalse(cached._replace(settings_crc=None).is_current(2, None))
+
+        self.cache.remove("E6614C311B4B7A28")
+        self.assertIsNone(self.cache.load("E6614C311B4B7A28"))
+
+    def test_current_cache_skips_reading(self):
+        self.cache.store("E6614C311B4B7A28", 2, 77, self.settings)
+        fluxpad = fake_fluxpad(77)
+        settings, from_cache = settings_cache.load_current_settings(fluxpad, self.cache)
+        self.assertTrue(from_cache)
+        self.assertEqual(settings.to_dict(), self.settings.to_dict())
+        # Known to be what the fluxpad has, nothing left to write
+        self.assertTrue(settings.matches_device_state(fluxpad))
+        settings.key_settings_list[2].actuate_point = 1.5
+        self.assertFalse(settings.matches_device_state(fluxpad))
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,88 @@
+import unittest
+import pathlib
+import sys
+import tempfile
+sys.path.append('../APP')
+import fluxpad_interface
+import settings_schema
+
+SCHEMA = fluxpad_interface.FluxpadSettings.FILE_SCHEMA
+
+
+def version_1_file() -> dict:
+    """Layout FluxpadSettings.save_to_file wrote before files had a version, straight from a read"""
+    key_settings = [{"cmd": "r", "tkn": 7, **settings} for settings in settings_schema.DEFAULT_KEY_SETTINGS]
+    return {"key_settings": key_settings, "rgb_settings": {"cmd": "r", "tkn": 8, **settings_schema.DEFAULT_RGB_SETTINGS, "rgb_m": 1, "rgb_s": 20.0}}
+
+
+class TestSettingsSchema(unittest.TestCase):
+
+    def test_migrate_version_1(self):
+        root = SCHEMA.load(version_1_file())
+        self.assertEqual(root["version"], settings_schema.SCHEMA_VERSION)
+        self.assertEqual(root["key_settings"][0], settings_schema.DEFAULT_KEY_SETTINGS[0])
+        self.assertNotIn("cmd", root["rgb_settings"])
+
+    def test_migrate_version_0(self):
+        # Before RGB settings, just the list of keys
+        key_settings = version_1_file()["key_settings"]
+        root = SCHEMA.load(key_settings)
+        self.assertEqual(root["rgb_settings"], settings_schema.DEFAULT_RGB_SETTINGS)
+        self.assertEqual(len(root["key_settings"]), 7)
+        self.assertEqual(SCHEMA.load({"key_settings": key_settings}), root)
+
+    def test_reports_every_error(self):
+        root = SCHEMA.load(version_1_file())
+        root["key_settings"][2]["p_a"] = "2.5"
+        root["key_settings"][3]["rt"] = 1
+        root["key_settings"][4]["d_a"] = 300
+        root["key_settings"][0]["h_a"] = 0.2  # Digital keys have no hysteresis
+        root["key_settings"][1]["k_t"] = 9
+        del root["key_settings"][6]
+        root["rgb_settings"]["rgb_c1"] = float("nan")
+        with self.assertRaises(settings_schema.SettingsFileError) as context:
+            SCHEMA.load(root, "profile.json")
+        self.assertEqual(context.exception.errors, [
+            "key_settings[0].h_a: unknown setting",
+            "key_settings[1].k_t (key_type): must be one of [0, 1, 2, 3], got 9",
+            "key_settings[2].p_a (actuate_point): must be float, got '2.5'",
+            "key_settings[3].rt (rapid_trigger): must be bool, got 1",
+            "key_settings[4].d_a (actuate_debounce): must be at most 255, got 300",
+            "key_settings: no settings for key ids [6]",
+            "rgb_settings.rgb_c1 (color1): must be finite, got nan",
+        ])
+        self.assertIn("profile.json", str(context.exception))
+
+        with self.assertRaises(settings_schema.SettingsFileError):
+            SCHEMA.load({**root, "version": 3})
+
+    def test_reports_missing_fields(self):
+        root = settings_schema.default_settings()
+        del root["key_settings"][3]["p_a"]
+        del root["key_settings"][3]["l_m"]
+        del root["key_settings"][5]["k_c"]
+        del root["rgb_settings"]["rgb_b"]
+        with self.assertRaises(settings_schema.SettingsFileError) as context:
+            SCHEMA.load(root)
+        self.assertEqual(context.exception.errors, [
+            "key_settings[3].p_a (actuate_point): missing",
+            "key_settings[3].l_m (mode): missing",
+            "key_settings[5].k_c (key_code): missing",
+            "rgb_settings.rgb_b (brightness): missing",
+        ])
+
+    def test_file_round_trip(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "settings.json"
+            settings = fluxpad_interface.FluxpadSettings()
+            settings.load_from_dict(SCHEMA.load(version_1_file()))
+            settings.save_to_file(path)
+            loaded = fluxpad_interface.FluxpadSettings()
+            loaded.load_from_file(path)
+        self.assertEqual(loaded.to_dict(), settings.to_dict())
+        self.assertEqual(SCHEMA.validate(loaded.to_dict()), [])
+        self.assertEqual(loaded.key_settings_list[3].actuate_point, 2.5)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
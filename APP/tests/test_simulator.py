@@ -0,0 +1,93 @@
+import unittest
+import sys
+sys.path.append('../APP')
+import numpy as np
+import fluxpad_interface
+import fixed_point
+import simulator
+
+
+def simulate_per_sample(height, time_ms, switch: simulator.SwitchSettings):
+    """Line by line port of AnalogSwitch::mainLoopService to check the vectorized version against"""
+    is_pressed = False
+    max_height, min_height = 0, 0xFFFFFFFF
+    last_pressed_time_ms = last_released_time_ms = int(time_ms[0])
+    pressed = []
+    for current, now in zip(height.tolist(), time_ms.tolist()):
+        should_actuate = current < switch.actuation_point
+        should_release = current > switch.release_point
+        if not is_pressed:
+            if current > max_height:
+                max_height = min(switch.release_point, current)
+            if switch.rapid_trigger:
+                if not ((abs(max_height - current) > switch.press_hysteresis or should_actuate) and not should_release):
+                    last_released_time_ms = now
+            elif not should_actuate:
+                last_released_time_ms = now
+            if now - last_released_time_ms > switch.press_debounce_ms:
+                is_pressed = True
+                max_height, min_height = 0, 0xFFFFFFFF
+        else:
+            if current < min_height:
+                min_height = max(switch.actuation_point, current)
+            if switch.rapid_trigger:
+                if not ((abs(current - min_height) > switch.release_hysteresis or should_release) and not should_actuate):
+                    last_pressed_time_ms = now
+            elif not should_release:
+                last_pressed_time_ms = now
+            if now - last_pressed_time_ms > switch.release_debounce_ms:
+                is_pressed = False
+                max_height, min_height = 0, 0xFFFFFFFF
+        pressed.append(is_pressed)
+    return np.array(pressed)
+
+
+def random_trace(rng: np.random.Generator, samples: int) -> np.ndarray:
+    """Key pressed up and down to random depths at random speeds, with sensor noise"""
+    speed = np.repeat(rng.uniform(0.002, 0.05, samples // 100 + 1), 100)[:samples]
+    phase = np.cumsum(speed)
+    depth = np.repeat(rng.uniform(0.5, 6, samples // 300 + 1), 300)[:samples]
+    height = 6 - depth * (1 - np.cos(phase)) / 2 + rng.normal(0, 0.03, samples)
+    return np.clip(height, 0, 10)
+
+
+class TestSimulator(unittest.TestCase):
+
+    def settings(self, **values) -> fluxpad_interface.AnalogSettingsMessage:
+        message = fluxpad_interface.AnalogSettingsMessage()
+        for name, value in values.items():
+            setattr(message, name, value)
+        return message
+
+    def test_matches_firmware_logic(self):
+        rng = np.random.default_rng(1)
+        height = random_trace(rng, 20000)
+        time_ms = np.arange(len(height)) // 2
+        for rapid_trigger in (True, False):
+            for debounce in (0, 1, 6):
+                message = self.settings(rapid_trigger=rapid_trigger, actuate_debounce=debounce, release_debounce=debounce)
+                result = simulator.simulate(height, message)
+                expected = simulate_per_sample(fixed_point.to_q22_10(height), time_ms, simulator.SwitchSettings.from_message(message))
+                np.testing.assert_array_equal(result.pressed, expected)
+                self.assertGreater(len(result.press_indexes), 20)
+                changes = np.flatnonzero(np.diff(expected.astype(int)))
+                np.testing.assert_array_equal(np.sort(np.concatenate([result.press_indexes, result.release_indexes])), changes + 1)
+
+    def test_rapid_trigger_press_and_release(self):
+        # Press down past the hysteresis, come back up a little, go down again
+        height = np.concatenate([np.linspace(6, 4, 100), np.linspace(4, 4.5, 50), np.linspace(4.5, 3.5, 50)])
+        message = self.settings(rapid_trigger=True, actuate_hysteresis=0.2, release_hysteresis=0.2, actuate_debounce=0, release_debounce=0)
+        result = simulator.simulate(height, message)
+        self.assertEqual(len(result.press_indexes), 2)
+        self.assertEqual(len(result.release_indexes), 1)
+        self.assertTrue(result.pressed[-1])
+
+    def test_defaults_for_missing_settings(self):
+        switch = simulator.SwitchSettings.from_message(self.settings(actuate_point=1.0))
+        self.assertEqual(switch.actuation_point, 1024)
+        self.assertEqual(switch.press_hysteresis, 204)
+        self.assertEqual(switch.release_debounce_ms, 6)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
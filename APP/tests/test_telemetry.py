@@ -0,0 +1,70 @@
+import unittest
+import sys
+sys.path.append('../APP')
+import numpy as np
+import telemetry
+
+
+def fill(buffer: telemetry.TelemetryBuffer, count: int):
+    for i in range(count):
+        buffer.append(i * 0.001, i * 1000, [i, i + 1, i + 2], [i / 10, 0, 0], [i % 2, 0, 1])
+
+
+class TestTelemetryBuffer(unittest.TestCase):
+
+    def test_partial(self):
+        buffer = telemetry.TelemetryBuffer(8)
+        fill(buffer, 5)
+        view = buffer.last(10)
+        self.assertEqual(len(buffer), 5)
+        self.assertEqual(view.device_time_us.tolist(), [0, 1000, 2000, 3000, 4000])
+        self.assertEqual(view.raw_adc.shape, (5, 3))
+
+    def test_wraps_without_copying(self):
+        buffer = telemetry.TelemetryBuffer(8)
+        fill(buffer, 21)
+        view = buffer.last(8)
+        self.assertEqual(len(buffer), 8)
+        self.assertEqual(buffer.total_count, 21)
+        self.assertEqual(view.device_time_us.tolist(), [i * 1000 for i in range(13, 21)])
+        self.assertEqual(view.raw_adc[:, 1].tolist(), list(range(14, 22)))
+        self.assertEqual(view.pressed[:, 0].tolist(), [i % 2 == 1 for i in range(13, 21)])
+        self.assertTrue(np.shares_memory(view.raw_adc, buffer._raw_adc))
+        self.assertFalse(view.height_mm.flags.writeable)
+
+    def test_last_seconds(self):
+        buffer = telemetry.TelemetryBuffer(100)
+        fill(buffer, 250)
+        view = buffer.last_seconds(0.010)
+        self.assertEqual(view.device_time_us.tolist(), [i * 1000 for i in range(239, 250)])
+        view = buffer.last_seconds(0.005, device_time=True)
+        self.assertEqual(len(view), 6)
+        self.assertEqual(len(buffer.last_seconds(10)), 100)
+
+    def test_append_batch_wraps(self):
+        buffer = telemetry.TelemetryBuffer(8)
+        fill(buffer, 5)
+        count = 6
+        batch = telemetry.RawDatastreamBatch(
+            np.arange(5, 5 + count) * 0.001,
+            np.arange(5, 5 + count) * 1000,
+            np.zeros((count, 3), dtype=np.int64),
+            np.tile(np.arange(5, 5 + count)[:, np.newaxis], 3),
+            np.zeros((count, 3)),
+            np.zeros((count, 3), dtype=bool),
+        )
+        buffer.append_batch(batch)
+        self.assertEqual(buffer.last(8).device_time_us.tolist(), [i * 1000 for i in range(3, 11)])
+        buffer.append_batch(batch._replace(device_time_us=np.arange(20) * 1000, host_time_s=np.zeros(20), raw_adc=np.zeros((20, 3)), height_mm=np.zeros((20, 3)), pressed=np.zeros((20, 3), dtype=bool)))
+        self.assertEqual(buffer.last(8).device_time_us.tolist(), [i * 1000 for i in range(12, 20)])
+
+
+class TestRawReadings(unittest.TestCase):
+
+    def test_decode(self):
+        readings = telemetry.decode_raw_readings(["1caa001cc0001c9700", "000000FFFFFF000400"], 3)
+        self.assertEqual(readings.tolist(), [[1834 * 1024 + 512, 1840 * 1024, 1829 * 1024 + 768], [0, 0xFFFFFF, 1024]])
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
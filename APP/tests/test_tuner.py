@@ -0,0 +1,84 @@
+import unittest
+import pathlib
+import sys
+import tempfile
+sys.path.append('../APP')
+import numpy as np
+import tuner
+
+
+def keystroke_trace(strokes: int, noise_mm: float = 0.0) -> tuner.Trace:
+    """Key pressed to 2 mm and released again 5 times a second at 2000 Hz"""
+    time_s = np.arange(strokes * 400) / 2000
+    height_mm = 4 + 2 * np.cos(2 * np.pi * 5 * time_s)
+    height_mm += np.random.default_rng(0).normal(0, noise_mm, len(time_s))
+    return tuner.Trace(height_mm, (time_s * 1000).astype(np.int64), time_s)
+
+
+class TestTuner(unittest.TestCase):
+
+    def test_finds_keystrokes(self):
+        keystrokes = tuner.find_keystrokes(keystroke_trace(20, noise_mm=0.02))
+        self.assertEqual(len(keystrokes.start_indexes), 20)
+        # Each starts at the top of a keystroke, give or take the noise on the flat top
+        phase = keystrokes.start_indexes % 400
+        self.assertTrue(np.all(np.minimum(phase, 400 - phase) < 10))
+
+    def test_score(self):
+        trace = keystroke_trace(20)
+        keystrokes = tuner.find_keystrokes(trace)
+        good = tuner.score(trace, keystrokes, tuner.TuningParameters(2.5, 5.5, 0.2, 0.2, 1, 6))
+        self.assertEqual((good.missed, good.chatter, good.presses), (0, 0, 20))
+        # Actuation point below the bottom of every keystroke and a hysteresis bigger than the travel
+        never = tuner.score(trace, keystrokes, tuner.TuningParameters(1.0, 5.5, 5.0, 0.2, 1, 6))
+        self.assertEqual(never.missed, 20)
+        self.assertGreater(never.score, good.score)
+
+    def test_tune_and_save(self):
+        trace = keystroke_trace(10, noise_mm=0.05)
+        candidates = list(tuner.grid_search_space({
+            "actuate_point": (1.5, 2.5, 0.5),
+            "release_point": (5.0, 5.0, 1),
+            "actuate_hysteresis": (0.1, 0.3, 0.1),
+            "release_hysteresis": (0.1, 0.3, 0.1),
+            "actuate_debounce": (0, 1, 1),
+            "release_debounce": (0, 6, 6),
+        }))
+        results = tuner.tune(trace, candidates, max_workers=2)
+        self.assertEqual(len(results), len(candidates))
+        self.assertEqual([result.score for result in results], sorted(result.score for result in results))
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = pathlib.Path(directory) / "tuned.json"
+            tuner.save_best(results[0], [2, 4], path)
+            settings = tuner.FluxpadSettings()
+            settings.load_from_file(path)
+        self.assertEqual(settings.key_settings_list[4].actuate_point, results[0].parameters.actuate_point)
+        self.assertEqual(settings.key_settings_list[2].key_id, 2)
+        # A whole profile, every field reads back. Keys not tuned keep the fluxpad defaults
+        for message in [*settings.key_settings_list, settings.rgb_settings]:
+            for field in message.get_fields():
+                getattr(message, field.name)
+        self.assertEqual(settings.key_settings_list[3].actuate_point, 2.5)
+        self.assertEqual(settings.key_settings_list[4].key_code, 0x06)
+
+    def test_save_on_base(self):
+        with tempfile.TemporaryDirectory() as directory:
+            base_path = pathlib.Path(directory) / "base.json"
+            base = tuner.FluxpadSettings()
+            base.load_from_dict(tuner.settings_schema.default_settings())
+            base.key_settings_list[3].actuate_point = 1.0
+            base.rgb_settings.mode = 0
+            base.save_to_file(base_path)
+            path = pathlib.Path(directory) / "tuned.json"
+            parameters = tuner.TuningParameters(2.0, 5.0, 0.3, 0.3, 0, 6)
+            tuner.save_best(tuner.TuningResult(parameters, 0, 0, 0, 0, 0), [2], path, base_path)
+            settings = tuner.FluxpadSettings()
+            settings.load_from_file(path)
+        self.assertEqual(settings.key_settings_list[2].actuate_point, 2.0)
+        self.assertEqual(settings.key_settings_list[3].actuate_point, 1.0)
+        self.assertEqual(settings.rgb_settings.mode, 0)
+
+
+if __name__ == "__main__":
+    unittest.main(verbosity=2)
@@ -0,0 +1,285 @@
+"""Search analog key settings against a recorded height trace using every core.
+
+Each combination of settings is run through the simulator and scored on how fast it presses,
+how many keystrokes it misses and how often it chatters. The best one is saved as a settings
+file fluxapp can load.
+
+usage: python tuner.py capture.fluxlog --key 2 [--grid | --samples N] [--output tuned.json]
+"""
+import argparse
+import concurrent.futures
+import itertools
+import logging
+import os
+import pathlib
+import sys
+import time
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+import numpy as np
+
+import fluxlog
+import fixed_point
+import settings_schema
+import simulator
+from fluxpad_interface import AnalogSettingsMessage, FluxpadSettings
+
+# Score is the mean actuation latency in ms plus these penalties per keystroke
+MISSED_PRESS_PENALTY_MS = 100.0
+CHATTER_PENALTY_MS = 50.0
+
+# A keystroke is any movement down of at least this much after coming up by as much
+DEFAULT_STROKE_MM = 0.5
+SMOOTHING_SAMPLES = 8
+
+DEFAULT_RANDOM_SAMPLES = 1000
+DEFAULT_RANGES: Dict[str, Tuple[float, float, float]] = {  # start, stop, step
+    "actuate_point": (0.5, 3.5, 0.25),
+    "release_point": (1.0, 5.5, 0.5),
+    "actuate_hysteresis": (0.1, 0.6, 0.1),
+    "release_hysteresis": (0.1, 0.6, 0.1),
+    "actuate_debounce": (0, 3, 1),
+    "release_debounce": (0, 6, 2),
+}
+INTEGER_PARAMETERS = ("actuate_debounce", "release_debounce")
+
+
+class Trace(NamedTuple):
+    height_mm: np.ndarray
+    time_ms: np.ndarray  # Firmware millis() of each sample for the simulator
+    time_s: np.ndarray  # Finer time of each sample to measure latency with
+
+
+class Keystrokes(NamedTuple):
+    start_indexes: np.ndarray  # Sample where each keystroke starts moving down
+
+
+class TuningParameters(NamedTuple):
+    actuate_point: float
+    release_point: float
+    actuate_hysteresis: float
+    release_hysteresis: float
+    actuate_debounce: int
+    release_debounce: int
+    rapid_trigger: bool = True
+
+    def is_valid(self) -> bool:
+        return self.actuate_point < self.release_point
+
+    def to_message(self, key_id: int) -> AnalogSettingsMessage:
+        message = AnalogSettingsMessage()
+        message.key_id = key_id
+        for name, value in self._asdict().items():
+            setattr(message, name, value)
+        return message
+
+
+class TuningResult(NamedTuple):
+    parameters: TuningParameters
+    score: float
+    mean_latency_ms: float
+    missed: int
+    chatter: int
+    presses: int
+
+
+def load_trace(path: pathlib.Path, key_id: int) -> Trace:
+    """Heights of one key from a .fluxlog recording, skipping samples without it"""
+    with fluxlog.FluxlogReader(path) as reader:
+        assert key_id in reader.key_ids, f"Key {key_id} not in recording, it has {reader.key_ids}"
+        records = reader.records[np.isfinite(reader.records["height_mm"][:, reader.key_ids.index(key_id)])]
+        height_mm = records["height_mm"][:, reader.key_ids.index(key_id)].astype(np.float64)
+        device_time_us = records["device_time_us"]
+        if len(records) and (device_time_us != fluxlog.NO_DEVICE_TIME).all():
+            time_s = (device_time_us - device_time_us[0]) / 1e6
+        else:
+            time_s = records["host_time_s"] - records["host_time_s"][0] if len(records) else np.zeros(0)
+    return Trace(height_mm, (time_s * 1000).astype(np.int64), np.asarray(time_s, dtype=np.float64))
+
+
+def find_keystrokes(trace: Trace, stroke_mm: float = DEFAULT_STROKE_MM) -> Keystrokes:
+    """Find where the player meant to press, the start of every downward movement of at least stroke_mm"""
+    kernel = np.ones(SMOOTHING_SAMPLES) / SMOOTHING_SAMPLES
+    padded = np.pad(trace.height_mm, (SMOOTHING_SAMPLES // 2, SMOOTHING_SAMPLES - 1 - SMOOTHING_SAMPLES // 2), mode="edge")
+    smoothed = np.convolve(padded, kernel, mode="valid")
+    # An ideal rapid trigger switch with no debounce, dead zones or noise presses at every stroke
+    stroke = int(fixed_point.to_q22_10(stroke_mm))
+    ideal = simulator.SwitchSettings(True, stroke, stroke, 0, np.iinfo(np.int64).max, 0, 0)
+    result = simulator.simulate(smoothed, ideal, time_ms=np.arange(len(smoothed)) * 2)
+
+    # The stroke started at the highest point since the key was last released
+    start_indexes = []
+    previous_release = 0
+    release_indexes = iter(result.release_indexes.tolist())
+    for press_index in result.press_indexes.tolist():
+        start_indexes.append(previous_release + int(smoothed[previous_release:press_index + 1].argmax()))
+        previous_release = next(release_indexes, len(smoothed))
+    return Keystrokes(np.array(start_indexes, dtype=np.intp))
+
+
+def score(trace: Trace, keystrokes: Keystrokes, parameters: TuningParameters) -> TuningResult:
+    """Simulate one combination of settings and score it, lower is better"""
+    switch = simulator.SwitchSettings.from_message(parameters.to_message(0))
+    result = simulator.simulate(trace.height_mm, switch, time_ms=trace.time_ms)
+    starts = keystrokes.start_indexes
+
+    # Each press belongs to the keystroke it happened in, presses before the first one are chatter too
+    strokes = np.searchsorted(starts, result.press_indexes, side="right") - 1
+    in_stroke = strokes >= 0
+    press_indexes = result.press_indexes[in_stroke]
+    strokes = strokes[in_stroke]
+    press_counts = np.bincount(strokes, minlength=len(starts))
+    missed = int(np.count_nonzero(press_counts == 0))
+    chatter = int(np.count_nonzero(~in_stroke)) + int(np.maximum(press_counts - 1, 0).sum())
+
+    # Latency from the start of each keystroke to its first press
+    pressed_strokes, first_presses = np.unique(strokes, return_index=True)
+    latencies_ms = (trace.time_s[press_indexes[first_presses]] - trace.time_s[starts[pressed_strokes]]) * 1000
+    mean_latency_ms = float(latencies_ms.mean()) if len(latencies_ms) else 0.0
+
+    stroke_count = max(len(starts), 1)
+    total = mean_latency_ms + (MISSED_PRESS_PENALTY_MS * missed + CHATTER_PENALTY_MS * chatter) / stroke_count
+    return TuningResult(parameters, total, mean_latency_ms, missed, chatter, len(result.press_indexes))
+
+
+# Set in each worker process by _init_worker so the trace is only sent once per process
+_worker_trace: Optional[Trace] = None
+_worker_keystrokes: Optional[Keystrokes] = None
+
+
+def _init_worker(trace: Trace, keystrokes: Keystrokes):
+    global _worker_trace, _worker_keystrokes
+    _worker_trace = trace
+    _worker_keystrokes = keystrokes
+
+
+def _score_batch(batch: List[TuningParameters]) -> List[TuningResult]:
+    return [score(_worker_trace, _worker_keystrokes, parameters) for parameters in batch]
+
+
+def frange(start: float, stop: float, step: float) -> List[float]:
+    """Inclusive range of rounded values so they save cleanly"""
+    return [float(round(value, 4)) for value in np.arange(start, stop + step / 2, step)]
+
+
+def grid_search_space(ranges: Dict[str, Tuple[float, float, float]], rapid_trigger: bool = True) -> Iterable[TuningParameters]:
+    names = list(ranges)
+    axes = [frange(*ranges[name]) for name in names]
+    for values in itertools.product(*axes):
+        parameters = dict(zip(names, values))
+        for name in INTEGER_PARAMETERS:
+            parameters[name] = int(parameters[name])
+        candidate = TuningParameters(rapid_trigger=rapid_trigger, **parameters)
+        if candidate.is_valid():
+            yield candidate
+
+
+def random_search_space(ranges: Dict[str, Tuple[float, float, float]], samples: int, rapid_trigger: bool = True, seed: Optional[int] = None) -> Iterable[TuningParameters]:
+    """Random points on the same grid, without repeats"""
+    rng = np.random.default_rng(seed)
+    axes = {name: frange(*ranges[name]) for name in ranges}
+    seen = set()
+    attempts = 0
+    while len(seen) < samples and attempts < samples * 20:
+        attempts += 1
+        parameters = {name: axis[rng.integers(len(axis))] for name, axis in axes.items()}
+        for name in INTEGER_PARAMETERS:
+            parameters[name] = int(parameters[name])
+        candidate = TuningParameters(rapid_trigger=rapid_trigger, **parameters)
+        if candidate.is_valid() and candidate not in seen:
+            seen.add(candidate)
+            yield candidate
+
+
+def tune(trace: Trace, candidates: Sequence[TuningParameters], stroke_mm: float = DEFAULT_STROKE_MM, max_workers: Optional[int] = None) -> List[TuningResult]:
+    """Score every candidate across a process pool, best first"""
+    keystrokes = find_keystrokes(trace, stroke_mm)
+    logging.info(f"Found {len(keystrokes.start_indexes)} keystrokes in {len(trace.height_mm)} samples")
+    max_workers = max_workers or os.cpu_count() or 1
+    # A few batches per worker keeps every core busy without paying for a round trip per candidate
+    batch_size = max(1, len(candidates) // (max_workers * 4))
+    batches = [list(candidates[i:i + batch_size]) for i in range(0, len(candidates), batch_size)]
+
+    results: List[TuningResult] = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, initializer=_init_worker, initargs=(trace, keystrokes)) as executor:
+        for batch_results in executor.map(_score_batch, batches):
+            results.extend(batch_results)
+    results.sort(key=lambda result: result.score)
+    return results
+
+
+def save_best(result: TuningResult, key_ids: Sequence[int], path: pathlib.Path, base: Optional[pathlib.Path] = None):
+    """Save the tuned settings for the given keys on top of the base profile, or of the fluxpad defaults without one"""
+    settings = FluxpadSettings()
+    if base is None:
+        settings.load_from_dict(settings_schema.default_settings())
+    else:
+        settings.load_from_file(base)
+    for key_id in key_ids:
+        message = settings.key_settings_list[key_id]
+        assert isinstance(message, AnalogSettingsMessage), f"Key {key_id} is not an analog key"
+        message.data.update(result.parameters.to_message(key_id).data)
+    settings.save_to_file(path)
+
+
+def format_results(results: List[TuningResult], count: int = 10) -> str:
+    lines = [f"{'Score':>8} {'Latency ms':>10} {'Missed':>6} {'Chatter':>7}  Settings"]
+    for result in results[:count]:
+        settings = ", ".join(f"{name}={value}" for name, value in result.parameters._asdict().items())
+        lines.append(f"{result.score:>8.2f} {result.mean_latency_ms:>10.2f} {result.missed:>6} {result.chatter:>7}  {settings}")
+    return "\n".join(lines)
+
+
+def parse_range(text: str) -> Tuple[float, float, float]:
+    """start:stop:step, or a single value"""
+    parts = [float(part) for part in text.split(":")]
+    if len(parts) == 1:
+        return parts[0], parts[0], 1.0
+    if len(parts) != 3:
+        raise argparse.ArgumentTypeError(f"Expected start:stop:step, got {text}")
+    return parts[0], parts[1], parts[2]
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Tune analog key settings against a recorded trace")
+    parser.add_argument("trace", type=pathlib.Path, help="Recording made with fluxlog.py")
+    parser.add_argument("--key", type=int, default=2, help="Analog key in the recording to tune (default 2)")
+    parser.add_argument("--apply-to", type=int, nargs="+", help="Keys to save the tuned settings to (default --key)")
+    parser.add_argument("--grid", action="store_true", help="Try every combination instead of a random search")
+    parser.add_argument("--samples", type=int, default=DEFAULT_RANDOM_SAMPLES, help=f"Combinations to try in a random search (default {DEFAULT_RANDOM_SAMPLES})")
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--no-rapid-trigger", action="store_true")
+    parser.add_argument("--stroke", type=float, default=DEFAULT_STROKE_MM, help=f"Smallest movement in mm that counts as a keystroke (default {DEFAULT_STROKE_MM})")
+    parser.add_argument("--workers", type=int, help="Processes to use (default every core)")
+    parser.add_argument("--base", type=pathlib.Path, help="Settings file to start from (default the fluxpad defaults)")
+    parser.add_argument("--output", type=pathlib.Path, default=pathlib.Path("tuned.json"))
+    for name, default in DEFAULT_RANGES.items():
+        parser.add_argument(f"--{name.replace('_', '-')}", type=parse_range, default=default, metavar="START:STOP:STEP")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    trace = load_trace(args.trace, args.key)
+    if len(trace.height_mm) == 0:
+        print(f"No samples of key {args.key} in {args.trace}", file=sys.stderr)
+        return 1
+    ranges = {name: getattr(args, name) for name in DEFAULT_RANGES}
+    rapid_trigger = not args.no_rapid_trigger
+    if args.grid:
+        candidates = list(grid_search_space(ranges, rapid_trigger))
+    else:
+        candidates = list(random_search_space(ranges, args.samples, rapid_trigger, args.seed))
+
+    start_s = time.perf_counter()
+    results = tune(trace, candidates, args.stroke, args.workers)
+    print(format_results(results))
+    print(f"Scored {len(results)} combinations in {time.perf_counter() - start_s:.1f} s")
+
+    save_best(results[0], args.apply_to or [args.key], args.output, args.base)
+    print(f"Saved best settings to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
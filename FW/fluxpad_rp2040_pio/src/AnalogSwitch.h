@@ -57,6 +57,7 @@ const q22_10_t reference_down_mm = FLOAT_TO_Q22_10(2.0f);
 const q22_10_t reference_up_adc = INT_TO_Q22_10(3214);
 const q22_10_t reference_down_adc = INT_TO_Q22_10(594);
 const size_t ADC_SAMPLES_N = 110;
+const size_t ADC_SAMPLES_MAX = 1024; // Sum of the samples has to fit in a q22_10_t
 
 /**
  * @brief Stores all operational settings for an analog switch
@@ -94,6 +95,7 @@ class AnalogSwitch {
     bool use_freerun_mode = true;
     ADCInput adc_input;
     WelfordAlgorithm welford;
+    size_t samples_n = ADC_SAMPLES_N; // Samples averaged per reading, only changed for benchmarking
 
     AnalogSwitchSettings_t settings;
 
@@ -129,7 +131,7 @@ class AnalogSwitch {
         // } else {
         //     takeAvgReading(settings.samples);
         // }
-        takeAvgReading(ADC_SAMPLES_N);
+        takeAvgReading(samples_n);
         // Serial.printf("current_reading: %lu, max_reading: %lu, min_reading:
         // %lu ", current_reading, max_reading, min_reading);
         // Serial.printf("press_hys: %lu, release_hys: %lu ",
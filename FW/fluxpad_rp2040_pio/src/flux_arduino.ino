@@ -118,9 +118,14 @@ KeyLighting keyLighting[] = {
 StaticJsonDocument<1024> request_msg;
 StaticJsonDocument<1024> response_msg;
 
-// bool datastream_mode = false;
-uint32_t datastream_period_ms = 0;
-uint32_t last_datatream_time_ms = 0;
+// Datastream mode, sends the analog key readings every datastream_period_us, 0 for off
+uint32_t datastream_period_us = 0;
+uint64_t last_datastream_time_us = 0;
+StaticJsonDocument<256> datastream_msg;
+bool datastream_raw = false; // Send packed raw readings only and leave the height conversion to the host
+constexpr size_t DATASTREAM_RAW_HEX_DIGITS = 6; // 24 bits per reading, enough for a Q22.10 12 bit ADC reading
+char datastream_raw_hex[sizeof(analogKeys) / sizeof(analogKeys[0]) * DATASTREAM_RAW_HEX_DIGITS + 1];
+constexpr int DATASTREAM_MIN_WRITE_SPACE = 128; // Skip samples rather than block the main loop on a full USB buffer
 
 void setup() {
 
@@ -254,7 +259,7 @@ void loop() {
     read_serial();
 
     // Send data out in datastream mode
-    // datastream_mode_service();
+    datastream_mode_service(curr_time_us);
 }
 
 void typeHIDKey(const KeyMapEntry_t *entry) {
@@ -351,6 +356,21 @@ bool saveFlashStorage(const StorageVars_t *_storage_vars) {
     return false;
 }
 
+/**
+ * @brief CRC-32 of the stored settings, so the host can tell if its cached copy is still current
+ */
+uint32_t storageCrc32(const StorageVars_t *_storage_vars) {
+    const uint8_t *data = reinterpret_cast<const uint8_t *>(_storage_vars);
+    uint32_t crc = 0xFFFFFFFFu;
+    for (size_t i = 0; i < sizeof(StorageVars_t); i++) {
+        crc ^= data[i];
+        for (int bit = 0; bit < 8; bit++) {
+            crc = (crc >> 1) ^ (0xEDB88320u & (0u - (crc & 1u)));
+        }
+    }
+    return ~crc;
+}
+
 void fillDefaultStorageVars(StorageVars_t *_storage_vars) {
 
     // Set Default keymap
@@ -467,17 +487,46 @@ void send_error_response_message(const char *error_string) {
 /**
  * @brief Datastream mode service function, called periodically in main loop
  *
+ * Sends {"t":<time us>,"adc":[...],"ht":[...],"p":[...]} with one entry per analog key,
+ * or {"t":<time us>,"raw":"<hex>","p":<bitmask>} in raw mode
  */
-void datastream_mode_service() {
-    // TODO implmement this
-
-    if (datastream_period_ms > 0) {
-        uint32_t curr_time_ms = millis();
-        if (curr_time_ms - last_datatream_time_ms >= datastream_period_ms) {
-            last_datatream_time_ms = curr_time_ms;
-            // Serial.write("");
+void datastream_mode_service(uint64_t curr_time_us) {
+
+    if (datastream_period_us == 0) {
+        return;
+    }
+    if (curr_time_us - last_datastream_time_us < datastream_period_us) {
+        return;
+    }
+    last_datastream_time_us = curr_time_us;
+
+    if (Serial.availableForWrite() < DATASTREAM_MIN_WRITE_SPACE) {
+        return;
+    }
+
+    datastream_msg.clear();
+    datastream_msg["t"] = static_cast<uint32_t>(curr_time_us);
+    if (datastream_raw) {
+        uint32_t pressed_mask = 0;
+        for (size_t i = 0; i < sizeof(analogKeys) / sizeof(analogKeys[0]); i++) {
+            snprintf(&datastream_raw_hex[i * DATASTREAM_RAW_HEX_DIGITS], DATASTREAM_RAW_HEX_DIGITS + 1, "%06lx",
+                     static_cast<unsigned long>(analogKeys[i].current_reading & 0xFFFFFF));
+            pressed_mask |= analogKeys[i].is_pressed ? (1u << i) : 0;
         }
+        datastream_msg["raw"] = datastream_raw_hex;
+        datastream_msg["p"] = pressed_mask;
+        serializeJson(datastream_msg, Serial);
+        return;
+    }
+    JsonArray adc = datastream_msg.createNestedArray("adc");
+    JsonArray height = datastream_msg.createNestedArray("ht");
+    JsonArray pressed = datastream_msg.createNestedArray("p");
+    for (AnalogSwitch &key : analogKeys) {
+        adc.add(Q22_10_TO_FLOAT(key.current_reading));
+        height.add(Q22_10_TO_FLOAT(key.current_height_mm));
+        pressed.add(key.is_pressed ? 1 : 0);
     }
+    serializeJson(datastream_msg, Serial);
 }
 
 /**
@@ -630,9 +679,25 @@ void read_serial() {
             }
         }
 
-        // Set datastream mode
+        // Set datastream mode, either as a period in ms or a frequency in hz
         if (request_msg.containsKey("dstrm")) {
-            datastream_period_ms = request_msg["dstrm"].as<unsigned int>();
+            datastream_period_us = request_msg["dstrm"].as<unsigned int>() * 1000u;
+        }
+        if (request_msg.containsKey("dstrm_freq")) {
+            uint32_t datastream_freq_hz = request_msg["dstrm_freq"].as<unsigned int>();
+            datastream_period_us = datastream_freq_hz == 0 ? 0 : HZ_TO_PERIOD_US(datastream_freq_hz);
+        }
+        if (request_msg.containsKey("dstrm_raw")) {
+            datastream_raw = request_msg["dstrm_raw"].as<bool>();
+        }
+
+        // Override the ADC samples averaged per reading until reset, 0 for the default. Not saved, for benchmarking
+        if (request_msg.containsKey("adc_n")) {
+            size_t samples_n = request_msg["adc_n"].as<unsigned int>();
+            samples_n = samples_n == 0 ? ADC_SAMPLES_N : min(samples_n, ADC_SAMPLES_MAX);
+            for (AnalogSwitch &key : analogKeys) {
+                key.samples_n = samples_n;
+            }
         }
 
         // RGB Lighting settings
@@ -775,6 +840,9 @@ void read_serial() {
         if (request_msg.containsKey("rgb_s")) {
             response_msg["rgb_s"] = storage_vars.rgbSettings.speed_bpm;
         }
+        if (request_msg.containsKey("crc")) {
+            response_msg["crc"] = storageCrc32(&storage_vars);
+        }
 
     }
 